@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: cache.py
+
+"""Local caches of remote files, keyed by remote_file_id."""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from fdfs_client.utils import fdfs_is_appender_fileid, fdfs_atomic_write
+
+
+class Disk_cache(object):
+    """
+    Read-through disk cache for downloaded files.
+
+    Normal file ids are immutable, so a cached copy never goes stale. Appender
+    file ids are mutable and never cached.
+    Eviction is segmented LRU: a new entry is put into probation segment, and
+    promoted to protected segment on its second hit. Protected segment is bounded
+    by protected_ratio of max_bytes, overflowed entries are demoted to probation.
+    Every entry is written via temp file plus rename. The index is written the same
+    way, and checked against the data files while loading, so a crash loses at most
+    recency information, never returns a broken file.
+    """
+
+    def __init__(self, cache_dir, max_bytes, protected_ratio=0.8, sync_interval=5):
+        '''
+        arguments:
+        @cache_dir: string, directory of cache, created if not exist
+        @max_bytes: long, byte size budget of all cached files
+        @protected_ratio: float, max ratio of protected segment
+        @sync_interval: int, seconds between writing index to disk
+        '''
+        self.cache_dir = cache_dir
+        self.data_dir = os.path.join(cache_dir, 'data')
+        self.index_filename = os.path.join(cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.protected_max_bytes = int(max_bytes * protected_ratio)
+        self.sync_interval = sync_interval
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._size = 0
+        self._protected_size = 0
+        self._dirty = False
+        self._last_sync = time.time()
+        self._lock = threading.RLock()
+        if not os.path.isdir(self.data_dir):
+            os.makedirs(self.data_dir)
+        self._load_index()
+
+    def _entry_filename(self, remote_file_id):
+        digest = hashlib.sha1(remote_file_id.encode()).hexdigest()
+        return os.path.join(self.data_dir, digest[:2], digest)
+
+    def _load_index(self):
+        '''Load index, drop entries without data file and data files without entry.'''
+        try:
+            with open(self.index_filename, 'rb') as f:
+                index = json.loads(f.read().decode())
+        except (IOError, OSError, ValueError):
+            index = {}
+        known = set()
+        for segment, entries in ((self._probation, index.get('probation', [])),
+                                 (self._protected, index.get('protected', []))):
+            for remote_file_id, size in entries:
+                filename = self._entry_filename(remote_file_id)
+                try:
+                    if os.stat(filename).st_size != size:
+                        continue
+                except OSError:
+                    continue
+                segment[remote_file_id] = size
+                known.add(filename)
+                self._size += size
+                if segment is self._protected:
+                    self._protected_size += size
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.tmp-'):
+                self._unlink(os.path.join(self.cache_dir, name))
+        for dirpath, dirnames, filenames in os.walk(self.data_dir):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if filename not in known:
+                    self._unlink(filename)
+        self._evict()
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            if self._probation:
+                remote_file_id, size = self._probation.popitem(last=False)
+            elif self._protected:
+                remote_file_id, size = self._protected.popitem(last=False)
+                self._protected_size -= size
+            else:
+                break
+            self._size -= size
+            self._unlink(self._entry_filename(remote_file_id))
+            self._dirty = True
+
+    def _discard(self, remote_file_id):
+        size = self._probation.pop(remote_file_id, None)
+        if size is None:
+            size = self._protected.pop(remote_file_id, None)
+            if size is None:
+                return False
+            self._protected_size -= size
+        self._size -= size
+        self._dirty = True
+        return True
+
+    def _touch(self, remote_file_id):
+        '''Record a hit, promote entry from probation to protected.'''
+        if remote_file_id in self._protected:
+            self._protected.move_to_end(remote_file_id)
+            return
+        size = self._probation.pop(remote_file_id)
+        self._protected[remote_file_id] = size
+        self._protected_size += size
+        while self._protected_size > self.protected_max_bytes and len(self._protected) > 1:
+            demoted_id, demoted_size = self._protected.popitem(last=False)
+            self._protected_size -= demoted_size
+            self._probation[demoted_id] = demoted_size
+        self._dirty = True
+
+    def _maybe_sync(self):
+        if self._dirty and time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        '''Write index to disk.'''
+        with self._lock:
+            index = {
+                'probation': list(self._probation.items()),
+                'protected': list(self._protected.items())
+            }
+            fdfs_atomic_write(self.index_filename, json.dumps(index).encode())
+            self._dirty = False
+            self._last_sync = time.time()
+
+    def open(self, remote_file_id):
+        '''
+        Open cached file of remote_file_id.
+        The file object stays readable even if the entry is evicted meanwhile.
+        @return file object opened in binary mode, None if not cached
+        '''
+        with self._lock:
+            if remote_file_id not in self._probation and \
+                    remote_file_id not in self._protected:
+                return None
+            try:
+                f = open(self._entry_filename(remote_file_id), 'rb')
+            except (IOError, OSError):
+                self._discard(remote_file_id)
+                return None
+            self._touch(remote_file_id)
+            self._maybe_sync()
+        return f
+
+    def get_buffer(self, remote_file_id):
+        '''@return bytes, None if not cached'''
+        f = self.open(remote_file_id)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def copy_to(self, remote_file_id, local_filename):
+        '''
+        Copy cached file to local_filename.
+        @return bool, False if not cached
+        '''
+        f = self.open(remote_file_id)
+        if f is None:
+            return False
+        with f:
+            with open(local_filename, 'wb') as out:
+                shutil.copyfileobj(f, out)
+        return True
+
+    def _put(self, remote_file_id, size, write_func):
+        if fdfs_is_appender_fileid(remote_file_id) or size > self.max_bytes:
+            return False
+        filename = self._entry_filename(remote_file_id)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        fd, tmp_filename = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_func(f)
+            with self._lock:
+                os.replace(tmp_filename, filename)
+                self._discard(remote_file_id)
+                self._probation[remote_file_id] = size
+                self._size += size
+                self._dirty = True
+                self._evict()
+                self._maybe_sync()
+        except:
+            self._unlink(tmp_filename)
+            raise
+        return True
+
+    def put_buffer(self, remote_file_id, file_buffer):
+        '''
+        Cache file content of remote_file_id.
+        @return bool, False if not cacheable
+        '''
+        return self._put(remote_file_id, len(file_buffer),
+                         lambda f: f.write(file_buffer))
+
+    def put_file(self, remote_file_id, local_filename):
+        '''
+        Cache a copy of local_filename as content of remote_file_id.
+        @return bool, False if not cacheable
+        '''
+        def write_func(f):
+            with open(local_filename, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        return self._put(remote_file_id, os.stat(local_filename).st_size, write_func)
+
+    def invalidate(self, remote_file_id):
+        '''Remove entry of remote_file_id.'''
+        with self._lock:
+            if self._discard(remote_file_id):
+                self._unlink(self._entry_filename(remote_file_id))
+                self._maybe_sync()
+
+    def clear(self):
+        '''Remove all entries.'''
+        with self._lock:
+            for remote_file_id in list(self._probation) + list(self._protected):
+                self._unlink(self._entry_filename(remote_file_id))
+            self._probation.clear()
+            self._protected.clear()
+            self._size = 0
+            self._protected_size = 0
+            self.sync()
+
+    def close(self):
+        if self._dirty:
+            self.sync()
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def size(self):
+        '''@return long, bytes of all cached files'''
+        return self._size
+
+
+class Memory_cache(object):
+    """
+    In-process cache for small files, keyed by remote_file_id.
+
+    Only files not bigger than max_item_size are admitted, so a few large files
+    can not flush many small hot ones. Entries are evicted in LRU order until
+    byte size of all entries fits in max_bytes.
+    Fdfs_client invalidates an entry when it deletes, modifies, appends or
+    truncates the file, changes made by other clients are not seen. So appender
+    files are only cached if cache_appender is set.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_item_size=32 * 1024,
+                 cache_appender=False):
+        '''
+        arguments:
+        @max_bytes: long, byte size budget of all cached files
+        @max_item_size: long, max size of one cached file
+        @cache_appender: bool, cache appender files too
+        '''
+        self.max_bytes = max_bytes
+        self.max_item_size = max_item_size
+        self.cache_appender = cache_appender
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, remote_file_id):
+        '''@return bytes, None if not cached'''
+        with self._lock:
+            file_buffer = self._entries.get(remote_file_id)
+            if file_buffer is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(remote_file_id)
+            self.hits += 1
+            return file_buffer
+
+    def put(self, remote_file_id, file_buffer):
+        '''
+        Cache file content of remote_file_id.
+        @return bool, False if not admitted
+        '''
+        size = len(file_buffer)
+        if size > self.max_item_size or size > self.max_bytes:
+            return False
+        if not self.cache_appender and fdfs_is_appender_fileid(remote_file_id):
+            return False
+        file_buffer = bytes(file_buffer)
+        with self._lock:
+            old = self._entries.pop(remote_file_id, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[remote_file_id] = file_buffer
+            self._size += size
+            while self._size > self.max_bytes:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, remote_file_id):
+        '''Remove entry of remote_file_id.'''
+        with self._lock:
+            file_buffer = self._entries.pop(remote_file_id, None)
+            if file_buffer is not None:
+                self._size -= len(file_buffer)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        '''@return long, bytes of all cached files'''
+        return self._size
+
+    def stats(self):
+        '''
+        @return dictionary {
+            'Hits'          : hits,
+            'Misses'        : misses,
+            'Hit ratio'     : hits / (hits + misses),
+            'Evictions'     : evictions,
+            'Invalidations' : invalidations,
+            'Items'         : count of cached files,
+            'Size'          : bytes of cached files
+        }
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'Hits': self.hits,
+                'Misses': self.misses,
+                'Hit ratio': float(self.hits) / lookups if lookups else 0.0,
+                'Evictions': self.evictions,
+                'Invalidations': self.invalidations,
+                'Items': len(self._entries),
+                'Size': self._size
+            }
@@ -8,17 +8,39 @@
   date: 2012-06-21
 """
 
+import io
+import os
+import time
+import logging
+import tempfile
+import hashlib
+import threading
 from fdfs_client.tracker_client import *
 from fdfs_client.storage_client import *
 from fdfs_client.exceptions import *
+from fdfs_client.cache import Disk_cache, Memory_cache
+from fdfs_client.topology import Cluster_topology, Upload_scheduler, Topology_service
+from fdfs_client.hedge import Hedge_policy
+from fdfs_client.resumable import Transfer_journal
+from fdfs_client.delta import Block_manifest
+from fdfs_client.registry import registry
+from fdfs_client.deadline import Deadline, current_deadline, with_deadline, backoff_sleep
+from fdfs_client.remote_file import Remote_file
+from fdfs_client.codec import (
+    get_codec, codec_meta, codec_of, compress_buffer, compress_file,
+    decompress_buffer, Decompressing_writer
+)
+
+logger = logging.getLogger(__name__)
 
 
 def get_tracker_conf(conf_path='client.conf'):
+    from fdfs_client.config import Fdfs_ConfigParser
     cf = Fdfs_ConfigParser()
     tracker = {}
     try:
         cf.read(conf_path)
-        timeout = cf.getint('__config__', 'connect_timeout')
+        timeout = cf.getfloat('__config__', 'connect_timeout')
         tracker_list = cf.get('__config__', 'tracker_server')
         if isinstance(tracker_list, str):
             tracker_list = [tracker_list]
@@ -29,11 +51,107 @@ def get_tracker_conf(conf_path='client.conf'):
         tracker['host_tuple'] = tuple(tracker_ip_list)
         tracker['timeout']    = timeout
         tracker['name']       = 'Tracker Pool'
+        tracker['transport']  = get_transport_conf(cf, timeout, 'tracker_')
+        tracker['storage_transport'] = get_transport_conf(cf, timeout, 'storage_')
+        tracker['warm_up']    = get_warm_up_conf(cf)
+        tracker['topology']   = get_topology_conf(cf)
     except:
         raise
     return tracker
 
 
+def get_warm_up_conf(cf):
+    '''
+    Read connection pre-warming options of client.conf, all are optional:
+        warm_up                      open connections in Fdfs_client(), default false
+        warm_up_tracker_connections  default 1
+        warm_up_storage_connections  per ACTIVE storage server, default 1
+        warm_up_timeout              time budget in seconds, default 5
+    @return dictionary of keyword arguments of Fdfs_client.warm_up and 'enabled'
+    '''
+    section = '__config__'
+
+    def opt(name, getter, default):
+        if not cf.has_option(section, name):
+            return default
+        return getter(section, name)
+
+    return {
+        'enabled': opt('warm_up', cf.getboolean, False),
+        'tracker_conns': opt('warm_up_tracker_connections', cf.getint, 1),
+        'storage_conns': opt('warm_up_storage_connections', cf.getint, 1),
+        'timeout': opt('warm_up_timeout', cf.getfloat, 5.0),
+    }
+
+
+def get_topology_conf(cf):
+    '''
+    Read options of Topology_service of client.conf, all are optional:
+        topology_refresh_interval  seconds between refreshes, default 30
+        topology_snapshot_file     file to persist last snapshot, default none
+    @return dictionary of keyword arguments of Topology_service
+    '''
+    section = '__config__'
+    conf = {'interval': 30, 'snapshot_filename': None}
+    if cf.has_option(section, 'topology_refresh_interval'):
+        conf['interval'] = cf.getint(section, 'topology_refresh_interval')
+    if cf.has_option(section, 'topology_snapshot_file'):
+        conf['snapshot_filename'] = cf.get(section, 'topology_snapshot_file')
+    return conf
+
+
+def get_transport_conf(cf, timeout, prefix=''):
+    '''
+    Read socket options and I/O sizing of client.conf, all are optional:
+        connect_timeout     seconds, may be a fraction as the timeouts below
+        network_timeout     read and write timeout in seconds
+        read_timeout        overrides network_timeout for reads
+        write_timeout       overrides network_timeout for writes
+        tcp_nodelay         default true
+        tcp_keepalive       default false, keepalive_idle, keepalive_interval
+                            and keepalive_count set its timings
+        so_sndbuf, so_rcvbuf socket buffer sizes in bytes
+        io_chunk_size       fixed I/O chunk size in bytes, 0 means adaptive
+        io_min_chunk_size, io_max_chunk_size bounds of adaptive chunk size
+        io_read_buffer_size bytes of one fill of read buffer of a connection
+    A key prefixed by prefix, e.g. tracker_read_timeout or storage_io_chunk_size,
+    overrides the plain key for the pool the options are read for.
+    @return Transport_options object
+    '''
+    section = '__config__'
+
+    def opt(name, getter, default=None):
+        for key in (prefix + name, name):
+            if cf.has_option(section, key):
+                return getter(section, key)
+        return default
+
+    network_timeout = opt('network_timeout', cf.getfloat)
+    chunk_size = opt('io_chunk_size', cf.getint, 0)
+    options = {
+        'tcp_nodelay': opt('tcp_nodelay', cf.getboolean, True),
+        'keepalive': opt('tcp_keepalive', cf.getboolean, False),
+        'keepalive_idle': opt('keepalive_idle', cf.getint),
+        'keepalive_interval': opt('keepalive_interval', cf.getint),
+        'keepalive_count': opt('keepalive_count', cf.getint),
+        'sndbuf': opt('so_sndbuf', cf.getint),
+        'rcvbuf': opt('so_rcvbuf', cf.getint),
+        'connect_timeout': opt('connect_timeout', cf.getfloat, timeout),
+        'read_timeout': opt('read_timeout', cf.getfloat, network_timeout),
+        'write_timeout': opt('write_timeout', cf.getfloat, network_timeout),
+        'adaptive': not chunk_size,
+    }
+    if chunk_size:
+        options['chunk_size'] = chunk_size
+    for key, name in (('min_chunk_size', 'io_min_chunk_size'),
+                      ('max_chunk_size', 'io_max_chunk_size'),
+                      ('read_buffer_size', 'io_read_buffer_size')):
+        value = opt(name, cf.getint)
+        if value:
+            options[key] = value
+    return Transport_options(**options)
+
+
 class Fdfs_client(object):
     """
     Class Fdfs_client implemented Fastdfs client protol ver 3.08.
@@ -42,27 +160,327 @@ class Fdfs_client(object):
     connection pool to manage connection to server.
     """
 
-    def __init__(self, conf_path='/etc/fdfs/client.conf', poolclass=ConnectionPool):
-        self.trackers = get_tracker_conf(conf_path)
-        self.tracker_pool = poolclass(**self.trackers)
+    def __init__(self, conf_path='/etc/fdfs/client.conf', poolclass=ConnectionPool, disk_cache=None,
+                 mem_cache=None, route_direct=False, upload_schedule=False, hedge=None,
+                 shared=False, topology_service=False):
+        '''
+        arguments:
+        @conf_path: string, path of client.conf
+        @poolclass: class of connection pool
+        @disk_cache: Disk_cache, read-through cache of downloads, can be null
+        @mem_cache: Memory_cache, cache of small files for download_to_buffer, can be null
+        @route_direct: bool, send downloads and updates to source storage server
+                       decoded from file id, without query tracker server. File
+                       ids of servers with use_storage_id encode a server id, not
+                       an ip, they and ips unknown to topology go through tracker.
+        @upload_schedule: bool, choose storage server for upload from cached group
+                          and server capacity, without query tracker server
+        @hedge: Hedge_policy, hedge download_to_buffer across replicas, can be null
+        @shared: bool, share parsed conf, tracker pool and storage pools with other
+                 shared clients of the same conf_path and poolclass. Call close(),
+                 or use the client as context manager, to release them.
+        @topology_service: bool, refresh cluster topology in background, see
+                           Topology_service. route_direct and upload_schedule
+                           then read it instead of query tracker server.
+        '''
+        def make_pools():
+            trackers = get_tracker_conf(conf_path)
+            conn_kwargs = dict((k, v) for k, v in trackers.items()
+                               if k not in ('warm_up', 'topology', 'storage_transport'))
+            return trackers, poolclass(**conn_kwargs)
+        self._shared = None
+        if shared:
+            self._shared = registry.acquire(conf_path, poolclass, make_pools)
+            self.trackers = self._shared.trackers
+            self.tracker_pool = self._shared.tracker_pool
+            self.storages = self._shared.storages
+            self._storages_lock = self._shared.lock
+        else:
+            self.trackers, self.tracker_pool = make_pools()
+            self.storages = {}
+            self._storages_lock = threading.Lock()
+        self._closed = False
         self.timeout  = self.trackers['timeout']
-        self.storages = {}
+        # options of storage pools, the tracker pool has its own
+        self.transport = self.trackers['storage_transport']
+        self.disk_cache = disk_cache
+        self.mem_cache = mem_cache
+        # count of invalidations, see _cache_put
+        self._cache_epoch = 0
+        self.topology_service = None
+        if topology_service:
+            self.topology_service = Topology_service(self.tracker_pool, **self.trackers['topology'])
+            self.topology_service.start()
+        self.topology = Cluster_topology(self.tracker_pool, service=self.topology_service) \
+            if route_direct else None
+        self.scheduler = Upload_scheduler(self.tracker_pool, service=self.topology_service) \
+            if upload_schedule else None
+        self.hedge = hedge
+        warm_up_conf = self.trackers.get('warm_up')
+        if warm_up_conf and warm_up_conf['enabled']:
+            self.warm_up()
         return None
 
     def __del__(self):
         try:
-            self.pool.destroy()
-            self.pool = None
+            self.close()
         except:
             pass
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Release pools, shared ones are destroyed once the last shared client of
+        them is closed. The client can not be used afterwards.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        if self.topology_service is not None:
+            self.topology_service.stop()
+        if self._shared is not None:
+            registry.release(self._shared)
+            return
+        with self._storages_lock:
+            storages = list(self.storages.values())
+            self.storages.clear()
+        for store in storages:
+            store.pool.destroy()
+        self.tracker_pool.destroy()
+
+    def warm_up(self, tracker_conns=None, storage_conns=None, timeout=None):
+        '''
+        Open connections before the first request, so it does not pay for handshakes.
+        Opens tracker_conns tracker connections, lists all groups and servers, then
+        opens storage_conns connections to every ACTIVE storage server, in parallel.
+        It returns when done or timeout seconds passed, connections still being
+        opened then are added to their pools in background. Failures are logged
+        to the fdfs_client.client logger and do not raise.
+        Arguments default to warm_up_* options of client.conf.
+        arguments:
+        @tracker_conns: int
+        @storage_conns: int, per storage server
+        @timeout: float, seconds
+        @return dictionary {
+            'Tracker connections' : count of idle tracker connections,
+            'Storage servers'     : count of ACTIVE storage servers,
+            'Storage connections' : count of idle storage connections,
+            'Complete'            : bool, all done within timeout, without failure
+        }
+        '''
+        conf = self.trackers['warm_up']
+        tracker_conns = conf['tracker_conns'] if tracker_conns is None else tracker_conns
+        storage_conns = conf['storage_conns'] if storage_conns is None else storage_conns
+        timeout = conf['timeout'] if timeout is None else timeout
+        deadline = time.time() + timeout
+        threads = []
+        servers = []
+        errors = []
+
+        def spawn(func, *args):
+            def target():
+                try:
+                    func(*args)
+                except (FDFSError, socket.error) as e:
+                    logger.warning('warm up failed: %s', e)
+                    errors.append(e)
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        def discover():
+            self.tracker_pool.warm_up(tracker_conns)
+            tc = Tracker_client(self.tracker_pool)
+            for gi in tc.tracker_list_all_groups()['Groups']:
+                for si in tc.tracker_list_servers(gi.group_name)['Servers']:
+                    if parse_storage_status(si.status) != 'ACTIVE':
+                        continue
+                    store_serv = Storage_server()
+                    store_serv.ip_addr = si.ip_addr
+                    store_serv.port = si.storage_port
+                    store_serv.group_name = gi.group_name
+                    servers.append(store_serv)
+                    spawn(self.get_storage(store_serv).pool.warm_up, storage_conns)
+
+        spawn(discover)
+        complete = True
+        # threads grows while discover runs, the loop picks up spawned ones
+        for t in threads:
+            t.join(max(0, deadline - time.time()))
+            if t.is_alive():
+                complete = False
+                break
+        return {
+            'Tracker connections': self.tracker_pool.idle_count(),
+            'Storage servers': len(servers),
+            'Storage connections': sum(self.get_storage(store_serv).pool.idle_count()
+                                       for store_serv in list(servers)),
+            'Complete': complete and not errors
+        }
+
     def get_storage(self, store_serv):
-        store = self.storages.get((store_serv.ip_addr, store_serv.port), None)
+        key = (store_serv.ip_addr, store_serv.port)
+        store = self.storages.get(key, None)
         if store is None:
-            store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-            self.storages[(store_serv.ip_addr, store_serv.port)] = store
+            with self._storages_lock:
+                store = self.storages.get(key, None)
+                if store is None:
+                    store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout,
+                                           self.transport)
+                    self.storages[key] = store
         return store
 
+    def _invalidate_cache(self, remote_file_id):
+        # bumped first, so a download filling the cache meanwhile drops its entry
+        self._cache_epoch += 1
+        if self.disk_cache is not None:
+            self.disk_cache.invalidate(remote_file_id)
+        if self.mem_cache is not None:
+            self.mem_cache.invalidate(remote_file_id)
+
+    def _cache_put(self, remote_file_id, epoch, put, *args):
+        '''
+        Call put(remote_file_id, *args) of a cache, with content got while cache
+        epoch was epoch. If any file was invalidated since, the content may be older
+        than that update, and the entry is dropped again.
+        '''
+        put(remote_file_id, *args)
+        if self._cache_epoch != epoch:
+            self._invalidate_cache(remote_file_id)
+
+    def _update_call(self, remote_file_id, func):
+        '''
+        _storage_call of an update of remote_file_id, delete, append, modify or
+        truncate. Cached content of the file is dropped once the call returns or
+        fails, a failed update may have been done as well.
+        '''
+        try:
+            return self._storage_call(remote_file_id, False, func)
+        finally:
+            self._invalidate_cache(remote_file_id)
+
+    def _direct_store_serv(self, remote_file_id):
+        '''
+        Get source storage server of remote_file_id from file id and cached topology.
+        @return Storage_server object, None if server is unknown or not ACTIVE
+        '''
+        if self.topology is None:
+            return None
+        file_id = parse_remote_fileid(remote_file_id)
+        # a server id, with use_storage_id, is not resolved to ip
+        if file_id is None or not file_id.source_ip_addr:
+            return None
+        si = self.topology.get_active_server(file_id.group_name, file_id.source_ip_addr)
+        if si is None:
+            return None
+        store_serv = Storage_server()
+        store_serv.ip_addr = si.ip_addr
+        store_serv.port = si.storage_port
+        store_serv.group_name = file_id.group_name
+        return store_serv
+
+    def _direct_replicas(self, remote_file_id):
+        '''
+        Get storage servers able to serve remote_file_id from cached topology: the
+        source server first, then the other ACTIVE servers of its group synced past
+        its create time, as tracker_query_storage_fetch_all would answer.
+        @return list of Storage_server, empty if none is known
+        '''
+        if self.topology is None:
+            return []
+        file_id = parse_remote_fileid(remote_file_id)
+        if file_id is None:
+            return []
+        try:
+            servers = self.topology.get_servers(file_id.group_name)
+        except DeadlineExceeded:
+            raise
+        except (ConnectionError, ResponseError, DataError):
+            return []
+        replicas = []
+        for si in (servers or {}).values():
+            if parse_storage_status(si.status) != 'ACTIVE':
+                continue
+            source = si.ip_addr == file_id.source_ip_addr
+            # both times are isoformat strings, as Storage_info keeps them
+            if not source and si.last_synced_time <= file_id.create_time:
+                continue
+            store_serv = Storage_server()
+            store_serv.ip_addr = si.ip_addr
+            store_serv.port = si.storage_port
+            store_serv.group_name = file_id.group_name
+            if source:
+                replicas.insert(0, store_serv)
+            else:
+                replicas.append(store_serv)
+        return replicas
+
+    def _storage_call(self, remote_file_id, fetch, func):
+        '''
+        Call func(tc, store_serv, store) on storage server of remote_file_id.
+        In route_direct mode the source storage server is used without query
+        tracker server. It falls back to tracker if the server is unknown or can
+        not be connected, and a fetch is retried through tracker on any
+        ConnectionError, while an update is not, since it may be done already.
+        arguments:
+        @remote_file_id: string
+        @fetch: bool, True for download, False for update, delete and meta data
+        @func: function(tc, store_serv, store)
+        @return result of func
+        '''
+        tc = Tracker_client(self.tracker_pool)
+        store_serv = self._direct_store_serv(remote_file_id)
+        if store_serv is not None:
+            store = self.get_storage(store_serv)
+            try:
+                if fetch:
+                    return func(tc, store_serv, store)
+                store.pool.release(store.pool.get_connection())
+            except DeadlineExceeded:
+                raise
+            except ConnectionError:
+                self.topology.mark_failed(store_serv.group_name, store_serv.ip_addr)
+            else:
+                return func(tc, store_serv, store)
+        group_name, remote_filename = split_remote_fileid(remote_file_id)
+        if fetch:
+            store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
+        else:
+            store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
+        return func(tc, store_serv, self.get_storage(store_serv))
+
+    def _upload_call(self, group_name, func):
+        '''
+        Call func(tc, store_serv, store) on storage server chosen for upload.
+        In upload_schedule mode the server is chosen locally, it falls back to
+        query tracker server if the cached view is stale, or the upload fails.
+        arguments:
+        @group_name: string, can be null
+        @func: function(tc, store_serv, store)
+        @return result of func
+        '''
+        tc = Tracker_client(self.tracker_pool)
+        if self.scheduler is not None:
+            store_serv = self.scheduler.choose(group_name)
+            if store_serv is not None:
+                try:
+                    return func(tc, store_serv, self.get_storage(store_serv))
+                except DeadlineExceeded:
+                    raise
+                except (ConnectionError, ResponseError, DataError):
+                    self.scheduler.mark_failed(store_serv)
+        if group_name:
+            store_serv = tc.tracker_query_storage_stor_with_group(group_name)
+        else:
+            store_serv = tc.tracker_query_storage_stor_without_group()
+        return func(tc, store_serv, self.get_storage(store_serv))
+
     def get_store_serv(self, remote_file_id):
         '''
         Get store server info by remote_file_id.
@@ -78,6 +496,7 @@ class Fdfs_client(object):
         store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
         return store_serv
 
+    @with_deadline
     def upload_by_filename(self, filename, meta_dict = None):
         """
         Upload a file to Storage server.
@@ -101,10 +520,11 @@ class Fdfs_client(object):
         isfile, errmsg = fdfs_check_file(filename)
         if not isfile:
             raise DataError(errmsg + '(uploading)')
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_without_group()
-        return self.get_storage(store_serv).storage_upload_by_filename(tc, store_serv, filename, meta_dict)
+        return self._upload_call(None, lambda tc, store_serv, store:
+                                 store.storage_upload_by_filename(tc, store_serv, filename,
+                                                                  meta_dict))
       
+    @with_deadline
     def upload_by_filename_with_group(self, filename, group_name, meta_dict = None):
         """
         Upload a file to Storage server.
@@ -126,22 +546,22 @@ class Fdfs_client(object):
             'Storage IP'      : storage_ip
         } if success else None
         """
-        group_name = group_name.encode('utf-8')
         isfile, errmsg = fdfs_check_file(filename)
         if not isfile:
             raise DataError(errmsg + '(uploading)')
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_with_group(group_name)
-        return self.get_storage(store_serv).storage_upload_by_filename(tc, store_serv, filename, meta_dict)
+        return self._upload_call(group_name, lambda tc, store_serv, store:
+                                 store.storage_upload_by_filename(tc, store_serv, filename,
+                                                                  meta_dict))
       
+    @with_deadline
     def upload_by_file(self, filename, meta_dict=None):
         isfile, errmsg = fdfs_check_file(filename)
         if not isfile:
             raise DataError(errmsg + '(uploading)')
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_without_group()
-        return self.get_storage(store_serv).storage_upload_by_file(tc, store_serv, filename, meta_dict)
+        return self._upload_call(None, lambda tc, store_serv, store:
+                                 store.storage_upload_by_file(tc, store_serv, filename, meta_dict))
 
+    @with_deadline
     def upload_by_buffer(self, filebuffer, file_ext_name=None, meta_dict=None):
         """
         Upload a buffer to Storage server.
@@ -165,11 +585,63 @@ class Fdfs_client(object):
         """
         if not filebuffer:
             raise DataError('[-] Error: argument filebuffer can not be null.')
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_without_group()
-        return self.get_storage(store_serv).storage_upload_by_buffer(tc, store_serv, filebuffer, \
-                                              file_ext_name, meta_dict)
+        return self._upload_call(None, lambda tc, store_serv, store:
+                                 store.storage_upload_by_buffer(tc, store_serv, filebuffer,
+                                                                file_ext_name, meta_dict))
 
+    @with_deadline
+    def upload_compressed_by_buffer(self, filebuffer, file_ext_name=None, meta_dict=None,
+                                    codec='zlib'):
+        """
+        Upload a buffer compressed by codec. Codec name and original size are
+        recorded in meta data, download_decompressed_* restore the content.
+        arguments:
+        @filebuffer: bytes
+        @file_ext_name: string
+        @meta_dict: dictionary, can be null
+        @codec: string, name of codec registered in fdfs_client.codec, or a codec
+        @return dict as upload_by_buffer, with 'Original size'
+        """
+        if not filebuffer:
+            raise DataError('[-] Error: argument filebuffer can not be null.')
+        codec = get_codec(codec)
+        meta = dict(meta_dict or {})
+        meta.update(codec_meta(codec, len(filebuffer)))
+        ret_dict = self.upload_by_buffer(compress_buffer(codec, filebuffer), file_ext_name, meta)
+        ret_dict['Original size'] = appromix(len(filebuffer))
+        return ret_dict
+
+    @with_deadline
+    def upload_compressed_by_filename(self, filename, meta_dict=None, codec='zlib'):
+        """
+        Upload a file compressed by codec, as upload_compressed_by_buffer.
+        The storage protocol needs the size before the content, so the file is
+        compressed a chunk at a time into a temporary file, then uploaded from it.
+        arguments:
+        @filename: string
+        @meta_dict: dictionary, can be null
+        @codec: string or codec
+        @return dict as upload_by_filename, with 'Original size'
+        """
+        isfile, errmsg = fdfs_check_file(filename)
+        if not isfile:
+            raise DataError(errmsg + '(uploading)')
+        codec = get_codec(codec)
+        # keep extension name of filename for the remote file
+        fd, tmp_filename = tempfile.mkstemp(prefix='fdfs-', suffix='-' + os.path.basename(filename))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                original_size = compress_file(codec, filename, f)
+            meta = dict(meta_dict or {})
+            meta.update(codec_meta(codec, original_size))
+            ret_dict = self.upload_by_filename(tmp_filename, meta)
+        finally:
+            os.unlink(tmp_filename)
+        ret_dict['Local file name'] = filename
+        ret_dict['Original size'] = appromix(original_size)
+        return ret_dict
+
+    @with_deadline
     def upload_slave_by_filename(self, filename, remote_file_id, prefix_name, \
                                  meta_dict=None):
         """
@@ -201,18 +673,15 @@ class Fdfs_client(object):
         if not prefix_name:
             raise DataError('[-] Error: prefix_name can not be null.')
         group_name, remote_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_with_group(group_name)
-        store = self.get_storage(store_serv)
-        try:
-            ret_dict = store.storage_upload_slave_by_filename(tc, store_serv, filename, \
-                                                              prefix_name, remote_filename, \
-                                                              meta_dict=None)
-        except:
-            raise
+        # slave file is stored beside its master
+        ret_dict = self._storage_call(remote_file_id, False, lambda tc, store_serv, store:
+                                      store.storage_upload_slave_by_filename(tc, store_serv, filename,
+                                                                             prefix_name, remote_filename,
+                                                                             meta_dict))
         ret_dict['Status'] = 'Upload slave file successed.'
         return ret_dict
 
+    @with_deadline
     def upload_slave_by_file(self, filename, remote_file_id, prefix_name, \
                              meta_dict=None):
         """
@@ -244,25 +713,23 @@ class Fdfs_client(object):
         if not prefix_name:
             raise DataError('[-] Error: prefix_name can not be null.')
         group_name, remote_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_with_group(group_name)
-        store = self.get_storage(store_serv)
-        try:
-            ret_dict = store.storage_upload_slave_by_file(tc, store_serv, filename, \
-                                                          prefix_name, remote_filename, \
-                                                          meta_dict=None)
-        except:
-            raise
+        # slave file is stored beside its master
+        ret_dict = self._storage_call(remote_file_id, False, lambda tc, store_serv, store:
+                                      store.storage_upload_slave_by_file(tc, store_serv, filename,
+                                                                         prefix_name, remote_filename,
+                                                                         meta_dict))
         ret_dict['Status'] = 'Upload slave file successed.'
         return ret_dict
 
+    @with_deadline
     def upload_slave_by_buffer(self, filebuffer, remote_file_id, \
-                               meta_dict=None, file_ext_name=None):
+                               meta_dict=None, file_ext_name=None, prefix_name=None):
         """
         Upload slave file by buffer
         arguments:
         @filebuffer: string
         @remote_file_id: string
+        @prefix_name: string, appended to master file name
         @meta_dict: dictionary e.g.:{
             'ext_name'  : 'jpg',
             'file_size' : '10240B',
@@ -283,13 +750,49 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(uploading slave)')
         group_name, remote_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-        store = self.get_storage(store_serv)
-        return store.storage_upload_slave_by_buffer(tc, store_serv, filebuffer, \
-                                                    remote_filename, meta_dict, \
-                                                    file_ext_name)
+        return self._storage_call(remote_file_id, False, lambda tc, store_serv, store:
+                                  store.storage_upload_slave_by_buffer(tc, store_serv, filebuffer,
+                                                                       remote_filename, meta_dict,
+                                                                       file_ext_name, prefix_name))
+
+    @with_deadline
+    def upload_with_slaves(self, master_buffer, slaves, file_ext_name=None, meta_dict=None,
+                           group_name=None):
+        """
+        Upload a master file and its slave files, e.g. an image and its thumbnails.
+        Storage server is chosen once, all uploads go over one connection, so it
+        takes N + 2 round trips instead of 2 + 2N. If any upload fails, the files
+        already uploaded are deleted.
+        arguments:
+        @master_buffer: bytes
+        @slaves: dictionary, prefix_name -> buffer, or (buffer, file_ext_name)
+                 if extension name differs from master
+        @file_ext_name: string, extension name of master
+        @meta_dict: dictionary, meta data of master, can be null
+        @group_name: string, can be null
+        @return dict {
+            'Group name'      : group_name,
+            'Remote file_id'  : remote_file_id of master,
+            'Slaves'          : dictionary, prefix_name -> remote_file_id,
+            'Status'          : 'Upload successed.',
+            'Uploaded size'   : upload_size,
+            'Storage IP'      : storage_ip
+        }
+        """
+        if not master_buffer:
+            raise DataError('[-] Error: argument master_buffer can not be null.')
+        slave_list = []
+        for prefix_name, slave in slaves.items():
+            filebuffer, slave_ext_name = slave if isinstance(slave, tuple) else (slave, None)
+            if not prefix_name or not filebuffer:
+                raise DataError('[-] Error: prefix_name and slave buffer can not be null.')
+            slave_list.append((prefix_name, filebuffer, slave_ext_name))
+        return self._upload_call(group_name, lambda tc, store_serv, store:
+                                 store.storage_upload_with_slaves(tc, store_serv, master_buffer,
+                                                                  slave_list, file_ext_name,
+                                                                  meta_dict))
 
+    @with_deadline
     def upload_appender_by_filename(self, local_filename, meta_dict=None):
         """
         Upload an appender file by filename.
@@ -313,12 +816,12 @@ class Fdfs_client(object):
         isfile, errmsg = fdfs_check_file(local_filename)
         if not isfile:
             raise DataError(errmsg + '(uploading appender)')
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_without_group()
-        store = self.get_storage(store_serv)
-        return store.storage_upload_appender_by_filename(tc, store_serv, \
-                                                         local_filename, meta_dict)
+        return self._upload_call(None, lambda tc, store_serv, store:
+                                 store.storage_upload_appender_by_filename(tc, store_serv,
+                                                                           local_filename,
+                                                                           meta_dict))
 
+    @with_deadline
     def upload_appender_by_file(self, local_filename, meta_dict=None):
         """
         Upload an appender file by file.
@@ -342,12 +845,11 @@ class Fdfs_client(object):
         isfile, errmsg = fdfs_check_file(local_filename)
         if not isfile:
             raise DataError(errmsg + '(uploading appender)')
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_without_group()
-        store = self.get_storage(store_serv)
-        return store.storage_upload_appender_by_file(tc, store_serv, \
-                                                     local_filename, meta_dict)
+        return self._upload_call(None, lambda tc, store_serv, store:
+                                 store.storage_upload_appender_by_file(tc, store_serv,
+                                                                       local_filename, meta_dict))
 
+    @with_deadline
     def upload_appender_by_buffer(self, filebuffer, file_ext_name=None, meta_dict=None):
         """
         Upload a buffer to Storage server.
@@ -366,13 +868,82 @@ class Fdfs_client(object):
         """
         if not filebuffer:
             raise DataError('[-] Error: argument filebuffer can not be null.')
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_stor_without_group()
-        store = self.get_storage(store_serv)
-        return store.storage_upload_appender_by_buffer(tc, store_serv, \
-                                                       filebuffer, meta_dict, \
-                                                       file_ext_name)
+        return self._upload_call(None, lambda tc, store_serv, store:
+                                 store.storage_upload_appender_by_buffer(tc, store_serv, filebuffer,
+                                                                         meta_dict, file_ext_name))
+
+    @with_deadline
+    def upload_resumable(self, local_filename, meta_dict=None, chunk_size=64 * 1024 * 1024,
+                         journal_filename=None):
+        """
+        Upload a large file as appender file, chunk by chunk, resumable after failure.
+        The file id and confirmed offset are kept in a local journal. Calling it again
+        after a failure or crash truncates the remote file back to the confirmed offset,
+        which drops a partly appended chunk, and sends only the remaining bytes. The
+        journal is removed once the upload is done. If the local file changed since the
+        journal was written, the partial remote file is deleted and upload starts over.
+        arguments:
+        @local_filename: string
+        @meta_dict: dictionary, can be null
+        @chunk_size: long, bytes per append request
+        @journal_filename: string, default is local_filename + '.fdfs-upload'
+        @return dict {
+            'Group name'      : group_name,
+            'Remote file_id'  : remote_file_id,
+            'Status'          : 'Upload successed.',
+            'Local file name' : local_filename,
+            'Uploaded size'   : upload_size,
+            'Storage IP'      : storage_ip
+        }
+        """
+        isfile, errmsg = fdfs_check_file(local_filename)
+        if not isfile:
+            raise DataError(errmsg + '(uploading resumable)')
+        journal = Transfer_journal(journal_filename or local_filename + '.fdfs-upload')
+        st = os.stat(local_filename)
+        if not st.st_size:
+            raise DataError('[-] Error: can not upload empty file.(uploading resumable)')
+        state = journal.load()
+        if state is not None and (state.get('size'), state.get('mtime')) != \
+                (st.st_size, st.st_mtime):
+            try:
+                self.delete_file(state['remote_file_id'])
+            except (FDFSError, KeyError):
+                pass
+            journal.remove()
+            state = None
+        with open(local_filename, 'rb') as f:
+            if state is not None:
+                remote_file_id, offset = state['remote_file_id'], state['offset']
+                ret = self.truncate_file(offset, remote_file_id)
+            else:
+                chunk = f.read(chunk_size)
+                ret = self.upload_appender_by_buffer(chunk, get_file_ext_name(local_filename),
+                                                     meta_dict)
+                remote_file_id, offset = ret['Remote file_id'], len(chunk)
+            state = {'remote_file_id': remote_file_id, 'size': st.st_size,
+                     'mtime': st.st_mtime, 'offset': offset}
+            journal.save(state)
+            f.seek(offset)
+            while offset < st.st_size:
+                chunk = f.read(min(chunk_size, st.st_size - offset))
+                if not chunk:
+                    raise DataError('[-] Error: local file is truncated while uploading.')
+                ret = self.append_by_buffer(chunk, remote_file_id)
+                offset += len(chunk)
+                state['offset'] = offset
+                journal.save(state)
+        journal.remove()
+        return {
+            'Group name': split_remote_fileid(remote_file_id)[0],
+            'Remote file_id': remote_file_id,
+            'Status': 'Upload successed.',
+            'Local file name': local_filename,
+            'Uploaded size': appromix(st.st_size),
+            'Storage IP': ret['Storage IP']
+        }
 
+    @with_deadline
     def delete_file(self, remote_file_id):
         """
         Delete a file from Storage server.
@@ -384,12 +955,12 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(in delete file)')
         group_name, remote_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-        store = self.get_storage(store_serv)
-        return store.storage_delete_file(tc, store_serv, remote_filename)
+        return self._update_call(remote_file_id, lambda tc, store_serv, store:
+                                 store.storage_delete_file(tc, store_serv, remote_filename))
 
-    def download_to_file(self, local_filename, remote_file_id, offset=0, down_bytes=0):
+    @with_deadline
+    def download_to_file(self, local_filename, remote_file_id, offset=0, down_bytes=0,
+                         verify=False):
         """
         Download a file from Storage server.
         arguments:
@@ -397,6 +968,9 @@ class Fdfs_client(object):
         @remote_file_id: string, file_id of file that is on storage server
         @offset: long
         @downbytes: long
+        @verify: bool, check CRC32 and size encoded in remote_file_id while receiving,
+                 retry on other replicas if corrupt. Only whole normal files are
+                 checked, as appender and slave file ids have no CRC32.
         @return dict {
             'Remote file_id'  : remote_file_id,
             'Content'         : local_filename,
@@ -408,21 +982,169 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(in download file)')
         group_name, remote_filename = tmp
-        if not down_bytes:
-            download_bytes = down_bytes
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_download_to_file(tc, store_serv, local_filename, offset, download_bytes,
-                                              remote_filename)
+        use_cache = self.disk_cache is not None and not offset and not down_bytes
+        epoch = self._cache_epoch
+        if use_cache and self.disk_cache.copy_to(remote_file_id, local_filename):
+            return {
+                'Remote file_id': remote_file_id,
+                'Content': local_filename,
+                'Download size': appromix(os.stat(local_filename).st_size),
+                'Storage IP': None
+            }
+        download_bytes = down_bytes
+        verify = verify and not offset and not down_bytes
+        ret_dict = self._download_call(remote_file_id, verify,
+                                       lambda tc, store_serv, store, verifier:
+                                       store.storage_download_to_file(tc, store_serv, local_filename,
+                                                                      offset, download_bytes,
+                                                                      remote_filename, verifier))
+        if use_cache:
+            self._cache_put(remote_file_id, epoch, self.disk_cache.put_file, local_filename)
+        return ret_dict
 
-    def download_to_buffer(self, remote_file_id, offset=0, down_bytes=0):
+    @with_deadline
+    def download_resumable(self, local_filename, remote_file_id, segment_size=64 * 1024 * 1024,
+                           retries=5, backoff=1, max_backoff=60, journal_filename=None):
+        """
+        Download a large file, resumable after failure.
+        An existing local_filename is taken as partial download. If a journal of
+        remote_file_id exists, the local file is cut to the offset it confirmed and
+        checked against the CRC32 of that part it recorded, otherwise the whole partial
+        file is kept. Download goes on from there in segments of segment_size, the
+        journal is saved after each. Connection errors are retried up to retries
+        times in a row, sleeping backoff seconds doubled each time up to max_backoff.
+        A backoff longer than the time left of a deadline raises DeadlineExceeded.
+        The result is checked against CRC32 and size encoded in remote_file_id, if
+        the check fails after resume, the download starts over once. Appender and
+        slave files have no CRC32 in file id, they are resumed from local file size
+        in a single request, without check.
+        arguments:
+        @local_filename: string
+        @remote_file_id: string
+        @segment_size: long, bytes per download request
+        @retries: int
+        @backoff: float, seconds
+        @max_backoff: float, seconds
+        @journal_filename: string, default is local_filename + '.fdfs-download'
+        @return dict {
+            'Remote file_id'  : remote_file_id,
+            'Content'         : local_filename,
+            'Download size'   : downloaded_size,
+            'Storage IP'      : storage_ip
+        }
+        """
+        file_id = parse_remote_fileid(remote_file_id)
+        if file_id is None:
+            raise DataError('[-] Error: remote_file_id is invalid.(in download resumable)')
+        group_name, remote_filename = file_id
+        journal = Transfer_journal(journal_filename or local_filename + '.fdfs-download')
+        verifier = Crc32_verifier(file_id) if file_id.crc32 is not None else None
+        offset = self._resume_offset(local_filename, remote_file_id, journal, verifier)
+        restarted = offset == 0
+        failures = 0
+        store_ip = None
+        with open(local_filename, 'r+b' if os.path.exists(local_filename) else 'w+b') as f:
+            f.truncate(offset)
+            while True:
+                if verifier is not None and offset >= file_id.file_size:
+                    try:
+                        verifier.verify(store_ip)
+                        break
+                    except IntegrityError:
+                        if restarted:
+                            raise
+                    # resumed partial file was bad, start over
+                    restarted = True
+                    offset = 0
+                    verifier = Crc32_verifier(file_id)
+                    f.truncate(0)
+                if verifier is not None:
+                    download_bytes = min(segment_size, file_id.file_size - offset)
+                else:
+                    download_bytes = 0
+                seg_offset = offset
+                checkpoint = (verifier.crc32, verifier.size) if verifier else None
+
+                def download(tc, store_serv, store):
+                    # _storage_call retries a failed direct download through tracker,
+                    # drop what the failed try wrote and fed to verifier
+                    f.seek(seg_offset)
+                    f.truncate()
+                    if verifier is not None:
+                        verifier.crc32, verifier.size = checkpoint
+                    return store.storage_download_to_file(tc, store_serv, f, seg_offset,
+                                                          download_bytes, remote_filename, verifier)
+
+                try:
+                    ret = self._storage_call(remote_file_id, True, download)
+                except DeadlineExceeded:
+                    raise
+                except ConnectionError:
+                    failures += 1
+                    if failures > retries:
+                        raise
+                    if verifier is not None:
+                        offset = seg_offset
+                        verifier.crc32, verifier.size = checkpoint
+                    else:
+                        offset = f.tell()
+                    f.truncate(offset)
+                    backoff_sleep(min(max_backoff, backoff * 2 ** (failures - 1)))
+                    continue
+                failures = 0
+                store_ip = ret['Storage IP']
+                if f.tell() == offset and download_bytes:
+                    raise DataError('[-] Error: storage server returned no data.(in download resumable)')
+                offset = f.tell()
+                if verifier is None:
+                    break
+                f.flush()
+                journal.save({'remote_file_id': remote_file_id, 'offset': offset,
+                              'crc32': verifier.crc32})
+        journal.remove()
+        return {
+            'Remote file_id': remote_file_id,
+            'Content': local_filename,
+            'Download size': appromix(offset),
+            'Storage IP': store_ip
+        }
+
+    def _resume_offset(self, local_filename, remote_file_id, journal, verifier):
+        '''
+        Offset to resume download to local_filename from, verifier is set to state of
+        content before it.
+        '''
+        try:
+            local_size = os.stat(local_filename).st_size
+        except OSError:
+            return 0
+        state = journal.load()
+        if state is not None and state.get('remote_file_id') == remote_file_id and \
+                0 <= state.get('offset', -1) <= local_size:
+            offset = state['offset']
+            if verifier is None:
+                return offset
+            if fdfs_file_crc32(local_filename, offset) == state.get('crc32'):
+                verifier.crc32, verifier.size = state['crc32'], offset
+                return offset
+            return 0
+        if verifier is None:
+            return local_size
+        if local_size > verifier.file_id.file_size:
+            return 0
+        verifier.crc32, verifier.size = fdfs_file_crc32(local_filename, local_size), local_size
+        return local_size
+
+    @with_deadline
+    def download_to_buffer(self, remote_file_id, offset=0, down_bytes=0, verify=False):
         """
         Download a file from Storage server and store in buffer.
         arguments:
         @remote_file_id: string, file_id of file that is on storage server
         @offset: long
         @down_bytes: long
+        @verify: bool, check CRC32 and size encoded in remote_file_id, retry on
+                 other replicas if corrupt, as download_to_file
         @return dict {
             'Remote file_id'  : remote_file_id,
             'Content'         : file_buffer,
@@ -434,16 +1156,349 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(in download file)')
         group_name, remote_filename = tmp
-        if not down_bytes:
-            download_bytes = down_bytes
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_fetch(group_name, remote_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
+        whole_file = not offset and not down_bytes
+        epoch = self._cache_epoch
         file_buffer = None
-        return store.storage_download_to_buffer(tc, store_serv, file_buffer, \
-                                                offset, download_bytes, \
-                                                remote_filename)
+        if whole_file and self.mem_cache is not None:
+            file_buffer = self.mem_cache.get(remote_file_id)
+        if file_buffer is None and whole_file and self.disk_cache is not None:
+            file_buffer = self.disk_cache.get_buffer(remote_file_id)
+            if file_buffer is not None and self.mem_cache is not None:
+                self._cache_put(remote_file_id, epoch, self.mem_cache.put, file_buffer)
+        if file_buffer is not None:
+            return {
+                'Remote file_id': remote_file_id,
+                'Content': file_buffer,
+                'Download size': appromix(len(file_buffer)),
+                'Storage IP': None
+            }
+        download_bytes = down_bytes
+
+        def download(tc, store_serv, store, verifier, on_connect=None, on_header=None):
+            return store.storage_download_to_buffer(tc, store_serv, None, offset, download_bytes,
+                                                    remote_filename, on_connect, on_header,
+                                                    verifier)
+
+        first_call = None
+        if self.hedge is not None:
+            first_call = lambda attempt: self._hedged_download_to_buffer(remote_file_id, attempt)
+        ret_dict = self._download_call(remote_file_id, verify and whole_file, download, first_call)
+        if whole_file and self.mem_cache is not None:
+            self._cache_put(remote_file_id, epoch, self.mem_cache.put, ret_dict['Content'])
+        if whole_file and self.disk_cache is not None:
+            self._cache_put(remote_file_id, epoch, self.disk_cache.put_buffer, ret_dict['Content'])
+        return ret_dict
+
+    @with_deadline
+    def download_decompressed_to_file(self, local_filename, remote_file_id, verify=False):
+        """
+        Download a file uploaded by upload_compressed_*, decompressed while it is
+        received. A file without codec in meta data is downloaded as it is.
+        arguments:
+        @local_filename: string
+        @remote_file_id: string
+        @verify: bool, check CRC32 of the compressed content, as download_to_file
+        @return dict as download_to_file, 'Download size' is decompressed size
+        """
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError('[-] Error: remote_file_id is invalid.(in download file)')
+        codec, original_size = codec_of(self.get_meta_data(remote_file_id))
+        if codec is None:
+            return self.download_to_file(local_filename, remote_file_id, verify=verify)
+        with open(local_filename, 'wb') as f:
+            ret_dict = self._download_decompressed(remote_file_id, f, codec, original_size, verify)
+        ret_dict['Content'] = local_filename
+        return ret_dict
+
+    @with_deadline
+    def download_decompressed_to_buffer(self, remote_file_id, verify=False):
+        """
+        Download a file uploaded by upload_compressed_*, and decompress it.
+        It is decompressed while received, the compressed content is not kept in
+        memory, unless the client has a cache: the compressed content is then
+        served from and put in the cache by download_to_buffer.
+        A file without codec in meta data is returned as it is.
+        @return dict as download_to_buffer, 'Content' is decompressed
+        """
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError('[-] Error: remote_file_id is invalid.(in download file)')
+        codec, original_size = codec_of(self.get_meta_data(remote_file_id))
+        if codec is None or self.mem_cache is not None or self.disk_cache is not None:
+            ret_dict = self.download_to_buffer(remote_file_id, verify=verify)
+            if codec is not None:
+                ret_dict['Content'] = decompress_buffer(codec, ret_dict['Content'], original_size)
+                ret_dict['Download size'] = appromix(len(ret_dict['Content']))
+            return ret_dict
+        out = io.BytesIO()
+        ret_dict = self._download_decompressed(remote_file_id, out, codec, original_size, verify)
+        ret_dict['Content'] = out.getvalue()
+        return ret_dict
+
+    def _download_decompressed(self, remote_file_id, fileobj, codec, original_size, verify):
+        '''
+        Download remote_file_id into binary file object fileobj, decompressed by
+        codec while it is received.
+        @return dict as download_to_file, 'Download size' is decompressed size
+        '''
+        group_name, remote_filename = split_remote_fileid(remote_file_id)
+        verify = verify and not fdfs_is_appender_fileid(remote_file_id)
+
+        def download(tc, store_serv, store, verifier):
+            # a retry on another replica starts over
+            fileobj.seek(0)
+            fileobj.truncate()
+            writer = Decompressing_writer(fileobj, codec)
+            ret = store.storage_download_to_file(tc, store_serv, writer, 0, 0,
+                                                 remote_filename, verifier)
+            writer.finish(original_size)
+            ret['Download size'] = appromix(writer.size)
+            return ret
+
+        return self._download_call(remote_file_id, verify, download)
+
+    def _check_not_compressed(self, remote_file_id, errmsg):
+        '''Raise DataError if meta data of remote_file_id records a codec.'''
+        codec, original_size = codec_of(self.get_meta_data(remote_file_id))
+        if codec is not None:
+            raise DataError('[-] Error: %s is compressed by %s, %s.'
+                            % (remote_file_id, codec.name, errmsg))
+
+    def _hedged_download_to_buffer(self, remote_file_id, download):
+        '''
+        Download to buffer from all replicas of the file, hedged by self.hedge.
+        download(tc, store_serv, store, on_connect, on_header) downloads from one replica.
+        In route_direct mode replicas are taken from cached topology, without query
+        tracker server, unless they are unknown or all of them fail.
+        '''
+        tc = Tracker_client(self.tracker_pool)
+
+        def run(replicas):
+            return self.hedge.run(replicas, lambda store_serv, on_connect, on_header:
+                                  download(tc, store_serv, self.get_storage(store_serv),
+                                           on_connect, on_header))
+
+        replicas = self._direct_replicas(remote_file_id)
+        if replicas:
+            try:
+                return run(replicas)
+            except (DeadlineExceeded, IntegrityError):
+                raise
+            except (ConnectionError, DataError):
+                # cached topology may be stale, refresh it and ask tracker server
+                self.topology.mark_failed(replicas[0].group_name, replicas[0].ip_addr)
+        group_name, remote_filename = split_remote_fileid(remote_file_id)
+        return run(tc.tracker_query_storage_fetch_all(group_name, remote_filename))
+
+    def _download_call(self, remote_file_id, verify, download, first_call=None):
+        '''
+        Download remote_file_id by download(tc, store_serv, store, verifier, ...).
+        With verify, each try gets a new Crc32_verifier, and a corrupt download is
+        retried on the other replicas of the file.
+        arguments:
+        @first_call: function(attempt), makes the first try by calling
+                     attempt(tc, store_serv, store, ...), default is _storage_call
+        '''
+        corrupt = []
+
+        def attempt(tc, store_serv, store, *args):
+            verifier = fdfs_crc32_verifier(remote_file_id) if verify else None
+            try:
+                return download(tc, store_serv, store, verifier, *args)
+            except IntegrityError:
+                corrupt.append(store_serv.ip_addr)
+                raise
+
+        try:
+            if first_call is not None:
+                return first_call(attempt)
+            return self._storage_call(remote_file_id, True, attempt)
+        except IntegrityError as e:
+            error = e
+        group_name, remote_filename = split_remote_fileid(remote_file_id)
+        tc = Tracker_client(self.tracker_pool)
+        for store_serv in tc.tracker_query_storage_fetch_all(group_name, remote_filename):
+            if store_serv.ip_addr in corrupt:
+                continue
+            try:
+                return attempt(tc, store_serv, self.get_storage(store_serv))
+            except (IntegrityError, ConnectionError) as e:
+                error = e
+        raise error
+
+    @with_deadline
+    def relay_download(self, remote_file_id, out_socket, offset=0, length=0, header=None,
+                       raw=False):
+        """
+        Download a file and send it to out_socket, e.g. for a proxy serving http
+        clients. On linux the body moves from storage socket to out_socket through a
+        pipe by os.splice, without copying it to user space, otherwise one buffer
+        is reused. If the server fails before anything is sent to out_socket, it is
+        retried on the server returned by tracker server.
+        A file uploaded by upload_compressed_* is sent decompressed while received,
+        content_length is its original size. A range of it can not be relayed.
+        arguments:
+        @remote_file_id: string, file_id of file that is on storage server
+        @out_socket: socket
+        @offset: long
+        @length: long, 0 for rest of file
+        @header: bytes sent before body, or function(content_length) returning them,
+                 e.g. the http response header, can be null
+        @raw: bool, send stored bytes without checking meta data for a codec,
+              which saves a request
+        @return dict {
+            'Remote file_id'  : remote_file_id,
+            'Download size'   : relayed_size,
+            'Storage IP'      : storage_ip
+        }
+        """
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError('[-] Error: remote_file_id is invalid.(in relay download)')
+        group_name, remote_filename = tmp
+        codec = original_size = None
+        if not raw:
+            codec, original_size = codec_of(self.get_meta_data(remote_file_id))
+            if codec is not None and (offset or length):
+                raise DataError('[-] Error: %s is compressed by %s, a range of it can not '
+                                'be relayed.' % (remote_file_id, codec.name))
+        state = {'sent': False}
+
+        def send_header(content_length):
+            data = header(content_length) if callable(header) else header
+            state['sent'] = True
+            return data if data is not None else b''
+
+        def relay(tc, store_serv):
+            store = self.get_storage(store_serv)
+            if codec is None:
+                return store.storage_relay_download(tc, store_serv, remote_filename, out_socket,
+                                                    offset, length, send_header)
+            with out_socket.makefile('wb') as out:
+                writer = Decompressing_writer(out, codec)
+                ret = store.storage_download_to_file(
+                    tc, store_serv, writer, 0, 0, remote_filename,
+                    on_header=lambda: out.write(send_header(original_size)))
+                writer.finish(original_size)
+            ret['Download size'] = appromix(writer.size)
+            del ret['Content']
+            return ret
+
+        tc = Tracker_client(self.tracker_pool)
+        store_serv = self._direct_store_serv(remote_file_id)
+        if store_serv is not None:
+            try:
+                return relay(tc, store_serv)
+            except DeadlineExceeded:
+                raise
+            except ConnectionError:
+                if state['sent']:
+                    raise
+                self.topology.mark_failed(store_serv.group_name, store_serv.ip_addr)
+        return relay(tc, tc.tracker_query_storage_fetch(group_name, remote_filename))
+
+    @with_deadline
+    def read_ranges(self, remote_file_id, ranges, gap=64 * 1024, max_request_size=16 * 1024 * 1024,
+                    spread=False, raw=False):
+        """
+        Read several ranges of a file with few requests. Ranges apart by at most gap
+        bytes are merged into one request, and the requests are pipelined on one
+        connection, or with spread, divided among the replicas of the file. Ranges
+        of a replica failed by a connection or data error, e.g. not synced yet, are
+        read again from another replica, DeadlineExceeded is raised at once.
+        Ranges are of stored bytes, DataError is raised for a file uploaded by
+        upload_compressed_*.
+        arguments:
+        @remote_file_id: string
+        @ranges: list of (offset, length)
+        @gap: int, max bytes read in vain between two merged ranges
+        @max_request_size: int, max size of a merged range
+        @spread: bool, download from all replicas in parallel
+        @raw: bool, read stored bytes without checking meta data for a codec,
+              which saves a request
+        @return list of memoryview, content of each range in order of ranges, all
+                slices of one buffer
+        """
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError('[-] Error: remote_file_id is invalid.(in read ranges)')
+        group_name, remote_filename = tmp
+        if not raw:
+            self._check_not_compressed(remote_file_id, 'ranges of it can not be read')
+        merged = fdfs_coalesce_ranges(ranges, gap, max_request_size)
+        requests = []
+        buffer_size = 0
+        for offset, length, indices in merged:
+            # download_bytes 0 means rest of file, empty ranges are not requested
+            if length:
+                requests.append((offset, length, buffer_size))
+            buffer_size += length
+        view = memoryview(bytearray(buffer_size))
+        results = [None] * len(ranges)
+        buffer_offset = 0
+        for offset, length, indices in merged:
+            for index in indices:
+                begin = buffer_offset + ranges[index][0] - offset
+                results[index] = view[begin:begin + ranges[index][1]]
+            buffer_offset += length
+
+        def download(batch):
+            return lambda tc, store_serv, store: store.storage_download_ranges(
+                tc, store_serv, remote_filename, batch, view)
+
+        if not requests:
+            return results
+        if not spread or len(requests) == 1:
+            self._storage_call(remote_file_id, True, download(requests))
+            return results
+        tc = Tracker_client(self.tracker_pool)
+        replicas = tc.tracker_query_storage_fetch_all(group_name, remote_filename)
+        failed = []
+        errors = []
+        expires = current_deadline()
 
+        def run(store_serv, batch):
+            try:
+                with Deadline(expires=expires):
+                    download(batch)(tc, store_serv, self.get_storage(store_serv))
+            except DeadlineExceeded as e:
+                errors.append(e)
+            except (ConnectionError, DataError) as e:
+                # e.g. a broken connection, or a replica the file is not synced to yet
+                failed.append((store_serv, batch, e))
+            except Exception as e:
+                errors.append(e)
+
+        threads = []
+        for i, store_serv in enumerate(replicas[:len(requests)]):
+            t = threading.Thread(target=run, args=(store_serv, requests[i::len(replicas)]))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        # ranges of a failed replica are read again from another one
+        failed_ips = set(store_serv.ip_addr for store_serv, batch, e in failed)
+        for store_serv, batch, error in failed:
+            for other in replicas:
+                if other.ip_addr in failed_ips:
+                    continue
+                try:
+                    download(batch)(tc, other, self.get_storage(other))
+                    break
+                except DeadlineExceeded:
+                    raise
+                except (ConnectionError, DataError) as e:
+                    failed_ips.add(other.ip_addr)
+                    error = e
+            else:
+                raise error
+        return results
+
+    @with_deadline
     def list_one_group(self, group_name):
         """
         List one group information.
@@ -454,6 +1509,7 @@ class Fdfs_client(object):
         tc = Tracker_client(self.tracker_pool)
         return tc.tracker_list_one_group(group_name)
 
+    @with_deadline
     def list_servers(self, group_name, storage_ip=None):
         """
         List all storage servers information in a group
@@ -467,6 +1523,7 @@ class Fdfs_client(object):
         tc = Tracker_client(self.tracker_pool)
         return tc.tracker_list_servers(group_name, storage_ip)
 
+    @with_deadline
     def list_all_groups(self):
         """
         List all group information.
@@ -478,6 +1535,7 @@ class Fdfs_client(object):
         tc = Tracker_client(self.tracker_pool)
         return tc.tracker_list_all_groups()
 
+    @with_deadline
     def get_meta_data(self, remote_file_id):
         """
         Get meta data of remote file.
@@ -489,11 +1547,61 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(in get meta data)')
         group_name, remote_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_get_metadata(tc, store_serv, remote_filename)
+        return self._storage_call(remote_file_id, False, lambda tc, store_serv, store:
+                                  store.storage_get_metadata(tc, store_serv, remote_filename))
+
+    @with_deadline
+    def query_file_info(self, remote_file_id):
+        """
+        Query file information from storage server.
+        arguments:
+        @remote_file_id: string
+        @return dictionary {
+            'File size'   : file_size,
+            'Create time' : timestamp,
+            'CRC32'       : crc32,
+            'Source IP'   : source_ip
+        }
+        """
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError('[-] Error: remote_file_id is invalid.(in query file info)')
+        group_name, remote_filename = tmp
+        return self._storage_call(remote_file_id, True, lambda tc, store_serv, store:
+                                  store.storage_query_file_info(tc, store_serv, remote_filename))
+
+    @with_deadline
+    def open_remote(self, remote_file_id, block_size=256 * 1024, cache_blocks=32, read_ahead=4,
+                    raw=False):
+        """
+        Open remote file for random access reads.
+        Size of normal files is decoded from remote_file_id, it is queried from
+        storage server for appender and slave files. Reads are of stored bytes,
+        DataError is raised for a file uploaded by upload_compressed_*.
+        A deadline keyword bounds opening only, meta data and size queries. Each
+        read is a download of its own, bounded by a Deadline block it is made in.
+        arguments:
+        @remote_file_id: string
+        @block_size: int, bytes per ranged download
+        @cache_blocks: int, blocks kept in memory
+        @read_ahead: int, blocks requested at once when reading sequentially
+        @raw: bool, open stored bytes without checking meta data for a codec,
+              which saves a request
+        @return Remote_file, a seekable io.RawIOBase
+        """
+        file_id = FileId(remote_file_id)
+        if not raw:
+            self._check_not_compressed(remote_file_id, 'it can not be read at random')
+        size = file_id.file_size
+        if size is None:
+            size = self.query_file_info(remote_file_id)['File size']
+
+        def fetch(offset, length):
+            return self.download_to_buffer(remote_file_id, offset, length)['Content']
 
+        return Remote_file(fetch, size, remote_file_id, block_size, cache_blocks, read_ahead)
+
+    @with_deadline
     def set_meta_data(self, remote_file_id, meta_dict, op_flag=STORAGE_SET_METADATA_FLAG_OVERWRITE):
         """
         Set meta data of remote file.
@@ -510,20 +1618,22 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(in set meta data)')
         group_name, remote_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
         try:
-            store_serv = tc.tracker_query_storage_update(group_name, remote_filename)
-            store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-            status = store.storage_set_metadata(tc, store_serv, remote_filename, meta_dict)
+            status, storage_ip = self._storage_call(remote_file_id, False, lambda tc, store_serv, store:
+                                                    (store.storage_set_metadata(tc, store_serv,
+                                                                                remote_filename,
+                                                                                meta_dict, op_flag),
+                                                     store_serv.ip_addr))
         except (ConnectionError, ResponseError, DataError):
             raise
         # if status == 2:
         #    raise DataError('[-] Error: remote file %s is not exist.' % remote_file_id)
         if status != 0:
             raise DataError('[-] Error: %d, %s' % (status, os.strerror(status)))
-        ret_dict = {'Status': 'Set meta data success.', 'Storage IP': store_serv.ip_addr}
+        ret_dict = {'Status': 'Set meta data success.', 'Storage IP': storage_ip}
         return ret_dict
 
+    @with_deadline
     def append_by_filename(self, local_filename, remote_fileid):
         isfile, errmsg = fdfs_check_file(local_filename)
         if not isfile:
@@ -532,12 +1642,11 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(append)')
         group_name, appended_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, appended_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_append_by_filename(tc, store_serv, local_filename, \
-                                                appended_filename)
+        return self._update_call(remote_fileid, lambda tc, store_serv, store:
+                                 store.storage_append_by_filename(tc, store_serv, local_filename,
+                                                                  appended_filename))
 
+    @with_deadline
     def append_by_file(self, local_filename, remote_fileid):
         isfile, errmsg = fdfs_check_file(local_filename)
         if not isfile:
@@ -546,12 +1655,11 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(append)')
         group_name, appended_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, appended_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_append_by_file(tc, store_serv, local_filename, \
-                                            appended_filename)
+        return self._update_call(remote_fileid, lambda tc, store_serv, store:
+                                 store.storage_append_by_file(tc, store_serv, local_filename,
+                                                              appended_filename))
 
+    @with_deadline
     def append_by_buffer(self, file_buffer, remote_fileid):
         if not file_buffer:
             raise DataError('[-] Error: file_buffer can not be null.')
@@ -559,13 +1667,12 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_file_id is invalid.(append)')
         group_name, appended_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, appended_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_append_by_buffer(tc, store_serv, file_buffer, \
-                                              appended_filename)
+        return self._update_call(remote_fileid, lambda tc, store_serv, store:
+                                 store.storage_append_by_buffer(tc, store_serv, file_buffer,
+                                                                appended_filename))
 
 
+    @with_deadline
     def truncate_file(self, truncated_filesize, appender_fileid):
         """
         Truncate file in Storage server.
@@ -582,12 +1689,82 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: appender_fileid is invalid.(truncate)')
         group_name, appender_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_truncate_file(tc, store_serv, trunc_filesize, \
-                                           appender_filename)
+        return self._update_call(appender_fileid, lambda tc, store_serv, store:
+                                 store.storage_truncate_file(tc, store_serv, trunc_filesize,
+                                                             appender_filename))
+
+    @with_deadline
+    def delta_sync(self, local_filename, appender_fileid, manifest_dir, block_size=64 * 1024):
+        """
+        Make appender file equal to local file, sending only changed blocks.
+        A manifest of block digests of the last synced version is kept in manifest_dir
+        per appender file id. Changed extents are sent by modify requests on one
+        connection, a shrunk file is truncated and a grown one appended. Without a
+        manifest, or if block_size changed, the whole file is sent.
+        Once the file is truncated, and before it is modified, the manifest is saved
+        cut to the truncated size with the changed blocks left out, so it never
+        describes more than the remote file holds. The full manifest is saved after
+        all requests succeed. A failed sync is completed by calling it again.
+        arguments:
+        @local_filename: string, new version of file
+        @appender_fileid: string, remote file id of appender file
+        @manifest_dir: string, directory of manifests
+        @block_size: int, bytes per block
+        @return: dictionary {
+            'Status'        : 'Delta sync successed.',
+            'Modified size' : modified_size,
+            'Appended size' : appended_size,
+            'Storage IP'    : storage_ip
+        }
+        """
+        isfile, errmsg = fdfs_check_file(local_filename)
+        if not isfile:
+            raise DataError(errmsg + '(delta sync)')
+        tmp = split_remote_fileid(appender_fileid)
+        if not tmp:
+            raise DataError('[-] Error: remote_fileid is invalid.(delta sync)')
+        group_name, appender_filename = tmp
+        manifest_filename = os.path.join(manifest_dir, hashlib.sha1(
+            appender_fileid.encode()).hexdigest() + '.json')
+        new = Block_manifest.from_file(appender_fileid, local_filename, block_size)
+        old = Block_manifest.load(manifest_filename)
+        if old is None or old.remote_file_id != appender_fileid or old.block_size != block_size:
+            old = Block_manifest(appender_fileid, block_size)
+            # remote content is unknown, rewrite it all
+            truncate_size = 0
+        else:
+            truncate_size = min(old.file_size, new.file_size)
+        extents = old.diff(new)
+
+        def sync(tc, store_serv, store):
+            with open(local_filename, 'rb') as f:
+                def read_extents():
+                    for offset, length in extents:
+                        f.seek(offset)
+                        yield offset, f.read(length)
+                # truncate first, so appending again after a failed sync is harmless
+                if new.file_size != old.file_size or not old.digests:
+                    store.storage_truncate_file(tc, store_serv, truncate_size, appender_filename)
+                old.unsynced(truncate_size, extents).save(manifest_filename)
+                ret = store.storage_modify_extents(tc, store_serv, read_extents(), appender_filename)
+                f.seek(truncate_size)
+                while True:
+                    chunk = f.read(4 * 1024 * 1024)
+                    if not chunk:
+                        break
+                    store.storage_append_by_buffer(tc, store_serv, chunk, appender_filename)
+            return ret['Storage IP']
+
+        storage_ip = self._update_call(appender_fileid, sync)
+        new.save(manifest_filename)
+        return {
+            'Status': 'Delta sync successed.',
+            'Modified size': appromix(sum(length for offset, length in extents)),
+            'Appended size': appromix(new.file_size - truncate_size),
+            'Storage IP': storage_ip
+        }
 
+    @with_deadline
     def modify_by_filename(self, filename, appender_fileid, offset=0):
         """
         Modify a file in Storage server by file.
@@ -608,12 +1785,11 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_fileid is invalid.(modify)')
         group_name, appender_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_modify_by_filename(tc, store_serv, filename, offset, \
-                                                filesize, appender_filename)
+        return self._update_call(appender_fileid, lambda tc, store_serv, store:
+                                 store.storage_modify_by_filename(tc, store_serv, filename, offset,
+                                                                  filesize, appender_filename))
 
+    @with_deadline
     def modify_by_file(self, filename, appender_fileid, offset=0):
         """
         Modify a file in Storage server by file.
@@ -634,12 +1810,11 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_fileid is invalid.(modify)')
         group_name, appender_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_modify_by_file(tc, store_serv, filename, offset, \
-                                            filesize, appender_filename)
+        return self._update_call(appender_fileid, lambda tc, store_serv, store:
+                                 store.storage_modify_by_file(tc, store_serv, filename, offset,
+                                                              filesize, appender_filename))
 
+    @with_deadline
     def modify_by_buffer(self, filebuffer, appender_fileid, offset=0):
         """
         Modify a file in Storage server by buffer.
@@ -659,8 +1834,6 @@ class Fdfs_client(object):
         if not tmp:
             raise DataError('[-] Error: remote_fileid is invalid.(modify)')
         group_name, appender_filename = tmp
-        tc = Tracker_client(self.tracker_pool)
-        store_serv = tc.tracker_query_storage_update(group_name, appender_filename)
-        store = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
-        return store.storage_modify_by_buffer(tc, store_serv, filebuffer, offset, \
-                                              filesize, appender_filename)
+        return self._update_call(appender_fileid, lambda tc, store_serv, store:
+                                 store.storage_modify_by_buffer(tc, store_serv, filebuffer, offset,
+                                                                filesize, appender_filename))
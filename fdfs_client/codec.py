@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: codec.py
+
+"""Compression codecs of stored files, recorded in meta data of the file."""
+
+import io
+import zlib
+from fdfs_client.exceptions import DataError
+
+# meta data keys of compressed files
+META_CODEC = 'fdfs_codec'
+META_ORIGINAL_SIZE = 'fdfs_original_size'
+
+
+class Zlib_codec(object):
+    """
+    zlib stream codec. A codec has a name, compressor() returning an object with
+    compress(data) and flush(), and decompressor() returning an object with
+    decompress(data), and flush() if it buffers output, as zlib and bz2 do.
+    """
+
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+CODECS = {Zlib_codec.name: Zlib_codec()}
+
+
+def register_codec(codec):
+    '''Make codec usable by name, for upload and for downloads recording it.'''
+    CODECS[codec.name] = codec
+
+
+def get_codec(codec):
+    '''@return codec of name, or codec itself if it is not a string'''
+    if not isinstance(codec, str):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise DataError('[-] Error: unknown codec %s.' % codec)
+
+
+def codec_meta(codec, original_size):
+    '''@return dictionary, meta data recording codec and original size'''
+    return {META_CODEC: codec.name, META_ORIGINAL_SIZE: str(original_size)}
+
+
+def codec_of(meta_dict):
+    '''@return (codec, original size) recorded in meta data, (None, None) if not compressed'''
+    name = meta_dict.get(META_CODEC)
+    if not name:
+        return None, None
+    size = meta_dict.get(META_ORIGINAL_SIZE)
+    return get_codec(name), int(size) if size else None
+
+
+def compress_buffer(codec, filebuffer):
+    '''@return bytes, filebuffer compressed by codec'''
+    compressor = codec.compressor()
+    return compressor.compress(filebuffer) + compressor.flush()
+
+
+def compress_file(codec, filename, fileobj, buffer_size=1024 * 1024):
+    '''
+    Compress file into a binary file object, a chunk at a time.
+    @return long, original size
+    '''
+    compressor = codec.compressor()
+    original_size = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                break
+            original_size += len(chunk)
+            fileobj.write(compressor.compress(chunk))
+    fileobj.write(compressor.flush())
+    return original_size
+
+
+class Decompressing_writer(object):
+    """
+    Binary file object taking compressed bytes, it writes them decompressed to
+    fileobj as they come. Passed to download functions, a file is decompressed
+    while being received.
+    """
+
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.decompressor = codec.decompressor()
+        self.size = 0
+
+    def write(self, data):
+        try:
+            out = self.decompressor.decompress(data)
+        except (zlib.error, ValueError, EOFError) as e:
+            raise DataError('[-] Error: while decompressing(%s).' % (e.args,))
+        if out:
+            self.fileobj.write(out)
+            self.size += len(out)
+        return len(data)
+
+    def finish(self, original_size=None):
+        '''
+        Write what decompressor buffered, and check the stream is complete.
+        @return long, decompressed size
+        '''
+        flush = getattr(self.decompressor, 'flush', None)
+        if flush is not None:
+            out = flush()
+            if out:
+                self.fileobj.write(out)
+                self.size += len(out)
+        if not getattr(self.decompressor, 'eof', True):
+            raise DataError('[-] Error: compressed stream is truncated.')
+        if original_size is not None and self.size != original_size:
+            raise DataError('[-] Error: decompressed size is not match, expect: %d, actual: %d'
+                            % (original_size, self.size))
+        return self.size
+
+
+def decompress_buffer(codec, filebuffer, original_size=None):
+    '''@return bytes, filebuffer decompressed by codec'''
+    out = io.BytesIO()
+    writer = Decompressing_writer(out, codec)
+    writer.write(filebuffer)
+    writer.finish(original_size)
+    return out.getvalue()
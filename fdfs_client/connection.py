@@ -3,18 +3,108 @@
 # filename: connection.py
 
 import socket
+import select
 import os
 import sys
 import time
+import logging
 import random
-from itertools import chain
+import threading
 from fdfs_client.exceptions import (
     FDFSError,
     ConnectionError,
     ResponseError,
     InvaildResponse,
-    DataError
+    DataError,
+    DeadlineExceeded
 )
+from fdfs_client.deadline import remaining
+
+logger = logging.getLogger(__name__)
+
+# start class Transport_options
+class Transport_options(object):
+    """
+    Socket options, timeouts and I/O chunk sizes of connections in a pool.
+
+    A timeout of None falls back to the timeout of the pool. With adaptive set,
+    each connection chooses its chunk size between min_chunk_size and
+    max_chunk_size from observed throughput, so that one chunk takes about
+    chunk_time seconds. Otherwise chunk_size is used. Reads smaller than
+    read_buffer_size are served from a per connection read buffer, filled by
+    one recv of that size.
+    """
+
+    def __init__(self, tcp_nodelay=True, keepalive=False, keepalive_idle=None,
+                 keepalive_interval=None, keepalive_count=None, sndbuf=None, rcvbuf=None,
+                 connect_timeout=None, read_timeout=None, write_timeout=None,
+                 adaptive=True, chunk_size=64 * 1024, min_chunk_size=4 * 1024,
+                 max_chunk_size=1024 * 1024, chunk_time=0.005, read_buffer_size=64 * 1024):
+        self.tcp_nodelay = tcp_nodelay
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.adaptive = adaptive
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.chunk_time = chunk_time
+        self.read_buffer_size = read_buffer_size
+
+    def apply(self, sock):
+        """Set socket options on a connected socket."""
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # keepalive timings are platform specific, skip the unsupported
+            for name, value in (('TCP_KEEPIDLE', self.keepalive_idle),
+                                ('TCP_KEEPINTVL', self.keepalive_interval),
+                                ('TCP_KEEPCNT', self.keepalive_count)):
+                if value and hasattr(socket, name):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+
+# end class Transport_options
+
+# start class Chunk_sizer
+class Chunk_sizer(object):
+    """Choose I/O chunk size of a connection from its observed throughput."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.size = transport.chunk_size
+        if transport.adaptive:
+            self.size = transport.min_chunk_size
+        self._throughput = 0.0
+
+    def observe(self, nbytes, elapsed):
+        '''Record nbytes transferred in elapsed seconds by one socket call.'''
+        if not self.transport.adaptive or nbytes <= 0:
+            return
+        rate = nbytes / max(elapsed, 1e-6)
+        if self._throughput:
+            self._throughput = 0.8 * self._throughput + 0.2 * rate
+        else:
+            self._throughput = rate
+        target = self._throughput * self.transport.chunk_time
+        size = self.transport.min_chunk_size
+        while size < target and size < self.transport.max_chunk_size:
+            size *= 2
+        self.size = min(size, self.transport.max_chunk_size)
+
+
+# end class Chunk_sizer
 
 # start class Connection
 class Connection(object):
@@ -23,10 +113,18 @@ class Connection(object):
     def __init__(self, **conn_kwargs):
         self.pid = os.getpid()
         self.host_tuple = conn_kwargs['host_tuple']
-        self.remote_port = conn_kwargs['port']
+        self.remote_port = None
         self.remote_addr = None
         self.timeout = conn_kwargs['timeout']
+        self.transport = conn_kwargs.get('transport') or Transport_options()
+        self.chunk_sizer = Chunk_sizer(self.transport)
         self._sock = None
+        self._sock_timeout = None
+        # read buffer, bytes from _rpos on are received and not read yet
+        self._rbuf = b''
+        self._rpos = 0
+        # socket timeout is cut to time left of a deadline
+        self._deadline_bound = False
 
     def __del__(self):
         try:
@@ -40,6 +138,11 @@ class Connection(object):
             return
         try:
             sock = self._connect()
+        except socket.timeout as e:
+            if self._deadline_bound:
+                raise DeadlineExceeded('[-] Error: deadline exceeded while connecting to %s:%s.'
+                                       % (self.remote_addr, self.remote_port))
+            raise ConnectionError(self._errormessage(e))
         except socket.error as e:
             raise ConnectionError(self._errormessage(e))
         self._sock = sock
@@ -49,17 +152,19 @@ class Connection(object):
         
     def _connect(self):
         '''Create TCP socket. The host is random one of host_tuple.'''
-        self.remote_addr = random.choice(self.host_tuple)
+        self.remote_addr, self.remote_port = random.choice(self.host_tuple)
         #print '[+] Connecting... remote: %s:%s' % (self.remote_addr, self.remote_port)
-        #sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #sock.settimeout(self.timeout)
-        sock = socket.create_connection((self.remote_addr, self.remote_port),self.timeout)
+        connect_timeout = self._bound_timeout(self.transport.connect_timeout or self.timeout)
+        sock = socket.create_connection((self.remote_addr, int(self.remote_port)), connect_timeout)
+        self.transport.apply(sock)
+        self._sock_timeout = connect_timeout
         return sock
 
     def disconnect(self):
         """Disconnect from fdfs server."""
         if self._sock is None:
             return
+        self._rbuf, self._rpos = b'', 0
         try:
             self._sock.close()
         except socket.error as e:
@@ -69,6 +174,134 @@ class Connection(object):
     def get_sock(self):
         return self._sock
 
+    def _bound_timeout(self, timeout):
+        '''@return timeout cut to time left of deadline, raise DeadlineExceeded if none'''
+        try:
+            left = remaining()
+        except DeadlineExceeded:
+            # a request may be half sent, connection can not be reused
+            self.disconnect()
+            raise
+        self._deadline_bound = left is not None and (timeout is None or left < timeout)
+        return left if self._deadline_bound else timeout
+
+    def check_deadline(self):
+        '''Raise DeadlineExceeded and close connection if deadline is over.'''
+        self._bound_timeout(None)
+
+    def _timed_out(self):
+        '''Called on socket.timeout, raise DeadlineExceeded if deadline caused it.'''
+        if self._deadline_bound:
+            self.disconnect()
+            raise DeadlineExceeded('[-] Error: deadline exceeded on %s:%s.'
+                                   % (self.remote_addr, self.remote_port))
+
+    def _settimeout(self, timeout):
+        timeout = self._bound_timeout(timeout or self.timeout)
+        if timeout != self._sock_timeout:
+            self._sock.settimeout(timeout)
+            self._sock_timeout = timeout
+
+    def chunk_size(self):
+        '''I/O chunk size of this connection.'''
+        return self.chunk_sizer.size
+
+    def sendall(self, data):
+        '''Send all data, with write timeout.'''
+        self._settimeout(self.transport.write_timeout)
+        start = time.time()
+        try:
+            self._sock.sendall(data)
+        except socket.timeout:
+            self._timed_out()
+            raise
+        self.chunk_sizer.observe(len(data), time.time() - start)
+
+    def _sock_recv(self, bufsize):
+        self._settimeout(self.transport.read_timeout)
+        start = time.time()
+        try:
+            data = self._sock.recv(bufsize)
+        except socket.timeout:
+            self._timed_out()
+            raise
+        self.chunk_sizer.observe(len(data), time.time() - start)
+        return data
+
+    def _sock_recv_into(self, buffer):
+        self._settimeout(self.transport.read_timeout)
+        start = time.time()
+        try:
+            nbytes = self._sock.recv_into(buffer)
+        except socket.timeout:
+            self._timed_out()
+            raise
+        self.chunk_sizer.observe(nbytes, time.time() - start)
+        return nbytes
+
+    def buffered(self):
+        '''@return int, bytes received into read buffer and not read yet'''
+        return len(self._rbuf) - self._rpos
+
+    def read_buffered(self, size):
+        '''@return bytes, at most size bytes of read buffer, without receiving'''
+        data = self._rbuf[self._rpos:self._rpos + size]
+        self._rpos += len(data)
+        if self._rpos == len(self._rbuf):
+            self._rbuf, self._rpos = b'', 0
+        return data
+
+    def _fill(self):
+        '''Receive once into read buffer. @Return bool, False on end of stream'''
+        data = self._sock_recv(self.transport.read_buffer_size)
+        if not data:
+            return False
+        self._rbuf = self._rbuf[self._rpos:] + data if self.buffered() else data
+        self._rpos = 0
+        return True
+
+    def recv(self, bufsize):
+        '''Receive at most bufsize bytes, with read timeout.
+           Bytes of read buffer come first, small reads are served by filling it.
+        '''
+        if not self.buffered() and bufsize < self.transport.read_buffer_size:
+            if not self._fill():
+                return b''
+        if self.buffered():
+            return self.read_buffered(bufsize)
+        return self._sock_recv(bufsize)
+
+    def recv_into(self, buffer):
+        '''Receive into buffer, with read timeout. @Return int, received size'''
+        if self.buffered():
+            data = self.read_buffered(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+        return self._sock_recv_into(buffer)
+
+    def recv_exact(self, size):
+        '''Receive exactly size bytes, with read timeout.
+           A response smaller than the read buffer takes one recv usually, bytes after
+           it are kept for the next read, e.g. next response of pipelined requests.
+           @Return bytes
+        '''
+        if size <= self.transport.read_buffer_size:
+            while self.buffered() < size:
+                if not self._fill():
+                    raise ConnectionError('[-] Error: socket closed on remote end, '
+                                          'expect: %d, actual: %d' % (size, self.buffered()))
+            return self.read_buffered(size)
+        response = bytearray(size)
+        view = memoryview(response)
+        total_size = 0
+        while total_size < size:
+            nbytes = self.recv_into(view[total_size:total_size + self.chunk_size()])
+            if not nbytes:
+                raise ConnectionError('[-] Error: socket closed on remote end, '
+                                      'expect: %d, actual: %d' % (size, total_size))
+            total_size += nbytes
+        return bytes(response)
+
     def _errormessage(self, exception):
         # args for socket.error can either be (errno, "message")
         # or just "message" """
@@ -84,7 +317,10 @@ class Connection(object):
 
 # start ConnectionPool
 class ConnectionPool(object):
-    """Generic Connection Pool"""
+    """Generic Connection Pool
+       It may be shared by threads, its state is guarded by a lock, a connection
+       is used by one thread at a time.
+    """
 
     def __init__(self, name='', conn_class=Connection,
                  max_conn=None, **conn_kwargs):
@@ -93,7 +329,9 @@ class ConnectionPool(object):
         self.conn_class = conn_class
         self.max_conn = max_conn or 2 ** 31
         self.conn_kwargs = conn_kwargs
+        self._lock = threading.Lock()
         self._conns_created = 0
+        self._conns_warming = 0
         self._conns_available = []
         self._conns_inuse = set()
         # print '[+] Create a connection pool success, name: %s.' % self.pool_name
@@ -105,92 +343,146 @@ class ConnectionPool(object):
 
     def make_conn(self):
         """Create a new connection."""
-        if self._conns_created >= self.max_conn:
-            raise ConnectionError('[-] Error: Too many connections.')
+        # take a slot first, so threads connecting at once do not pass max_conn
+        with self._lock:
+            if self._conns_created >= self.max_conn:
+                raise ConnectionError('[-] Error: Too many connections.')
+            self._conns_created += 1
         num_try = 3
-        while True:
-            try:
-                if num_try <= 0:
+        try:
+            while True:
+                try:
+                    if num_try <= 0:
+                        break
+                    conn_instance = self.conn_class(**self.conn_kwargs)
+                    conn_instance.connect()
                     break
-                conn_instance = self.conn_class(**self.conn_kwargs)
-                conn_instance.connect()
-                self._conns_created += 1
-                break
-            except ConnectionError as e:
-                print(e)
-                num_try -= 1
-                conn_instance = None
-        if num_try <= 0:
-            raise ConnectionError("Fail to connect with Fdfs-server after trying 3 times")
+                except DeadlineExceeded:
+                    raise
+                except ConnectionError as e:
+                    logger.debug('%s', e)
+                    num_try -= 1
+                    conn_instance = None
+            if num_try <= 0:
+                raise ConnectionError("Fail to connect with Fdfs-server after trying 3 times")
+        except Exception:
+            with self._lock:
+                self._conns_created -= 1
+            raise
         return conn_instance
 
     def get_connection(self):
         """Get a connection from pool."""
         self._check_pid()
-        try:
-            conn = self._conns_available.pop()
+        remaining()
+        with self._lock:
+            conn = self._conns_available.pop() if self._conns_available else None
             # print '[+] Get a connection from pool %s.' % self.pool_name
-            # print '\tLocal address is %s:%s.' % conn._sock.getsockname()
-            # print '\tRemote address is %s:%s' % (conn.remote_addr, conn.remote_port)
-        except IndexError:
+        if conn is None:
             conn = self.make_conn()
-        self._conns_inuse.add(conn)
+        with self._lock:
+            self._conns_inuse.add(conn)
         return conn
 
+    def warm_up(self, count):
+        """Open connections until count of them are idle in the pool.
+           Connections being opened by another warm_up count as idle.
+           @return int, count of connections opened
+        """
+        self._check_pid()
+        with self._lock:
+            need = max(0, count - len(self._conns_available) - self._conns_warming)
+            self._conns_warming += need
+        opened = 0
+        try:
+            while opened < need:
+                conn = self.make_conn()
+                with self._lock:
+                    self._conns_warming -= 1
+                    self._conns_available.append(conn)
+                opened += 1
+        finally:
+            with self._lock:
+                self._conns_warming -= need - opened
+        return opened
+
+    def idle_count(self):
+        """@return int, count of idle connections in the pool"""
+        with self._lock:
+            return len(self._conns_available)
+
     def remove(self, conn):
         """Remove connection from pool."""
-        if conn in self._conns_inuse:
-            self._conns_inuse.remove(conn)
-            self._conns_created -= 1
-        if conn in self._conns_available:
-            self._conns_available.remove(conn)
-            self._conns_created -= 1
+        with self._lock:
+            if conn in self._conns_inuse:
+                self._conns_inuse.remove(conn)
+                self._conns_created -= 1
+            if conn in self._conns_available:
+                self._conns_available.remove(conn)
+                self._conns_created -= 1
 
     def destroy(self):
         """Disconnect all connections in the pool."""
-        all_conns = chain(self._conns_inuse, self._conns_available)
+        with self._lock:
+            all_conns = list(self._conns_inuse) + self._conns_available
         for conn in all_conns:
             conn.disconnect()
             # print '[-] Destroy connection pool %s.' % self.pool_name
 
     def release(self, conn):
-        """Release the connection back to the pool."""
+        """Release the connection back to the pool.
+           A disconnected connection is dropped from the pool.
+        """
         self._check_pid()
         if conn.pid == self.pid:
-            self._conns_inuse.remove(conn)
-            self._conns_available.append(conn)
+            if conn.get_sock() is None:
+                self.remove(conn)
+                return
+            with self._lock:
+                self._conns_inuse.remove(conn)
+                self._conns_available.append(conn)
             # print '[-] Release connection back to pool %s.' % self.pool_name
 
 
 # end ConnectionPool class
 
-def tcp_recv_response(conn, bytes_size, buffer_size = 1024):
+def tcp_recv_response(conn, bytes_size, buffer_size = None):
     '''Receive response from server.
         It is not include tracker header.
         arguments:
         @conn: connection
         @bytes_size: int, will be received byte_stream size
-        @buffer_size: int, receive buffer size
+        @buffer_size: int, unused, conn.recv_exact chooses read sizes
         @Return: tuple,(response, received_size)
     '''
-    response = ''
-    total_size = 0
-    total_bytes_size = bytes_size
     try:
-        while 1:
-            if total_bytes_size - total_size <= buffer_size:
-                resp = conn._sock.recv(buffer_size)
-                response += resp
-                total_size += len(resp)
-                break
-            resp = conn._sock.recv(buffer_size)
-            response += resp
-            total_size += len(resp)
-            
+        response = conn.recv_exact(bytes_size)
     except (socket.error, socket.timeout) as e:
             raise ConnectionError('[-] Error: while reading from socket: (%s)' \
-                                    % e.args)
-    return (response, total_size)
+                                    % (e.args,))
+    return (response, bytes_size)
+
+def tcp_recv_into(conn, view):
+    '''Receive response from server into a writable buffer, until it is full.
+        It is not include tracker header.
+        arguments:
+        @conn: connection
+        @view: memoryview, e.g. a slice of a larger bytearray
+        @Return int, received size
+    '''
+    view = memoryview(view)
+    total_size = 0
+    try:
+        while total_size < len(view):
+            nbytes = conn.recv_into(view[total_size:total_size + conn.chunk_size()])
+            if not nbytes:
+                raise ConnectionError('[-] Error: socket closed on remote end, '
+                                      'expect: %d, actual: %d' % (len(view), total_size))
+            total_size += nbytes
+    except (socket.error, socket.timeout) as e:
+        raise ConnectionError('[-] Error: while reading from socket: (%s)' \
+                              % (e.args,))
+    return total_size
 
 def tcp_send_data(conn, bytes_stream):
     """Send buffer to server.
@@ -201,7 +493,92 @@ def tcp_send_data(conn, bytes_stream):
         @Return bool
     """
     try:
-        conn._sock.sendall(bytes_stream)
+        conn.sendall(bytes_stream)
     except (socket.error, socket.timeout) as e:
         raise ConnectionError('[-] Error: while writting to socket: (%s)' \
-                              % e.args)
+                              % (e.args,))
+
+
+def tcp_relay(conn, out_sock, size, buffer_size=None):
+    '''Move response body from server to another socket.
+        It is not include tracker header. On linux, os.splice moves the bytes
+        through a pipe inside kernel, else a recv_into/sendall loop reuses one buffer.
+        arguments:
+        @conn: connection
+        @out_sock: socket, bytes are sent to it
+        @size: int, byte size of body
+        @buffer_size: int, bytes per move, default is max chunk size of conn
+        @Return int, relayed size
+    '''
+    buffer_size = buffer_size or conn.transport.max_chunk_size
+    conn._settimeout(conn.transport.read_timeout)
+    try:
+        # bytes already in read buffer of conn go first, the socket has the rest
+        buffered = conn.read_buffered(size)
+        if buffered:
+            out_sock.sendall(buffered)
+        if hasattr(os, 'splice'):
+            return len(buffered) + _tcp_relay_splice(conn, out_sock, size - len(buffered), buffer_size)
+        return len(buffered) + _tcp_relay_copy(conn, out_sock, size - len(buffered), buffer_size)
+    except (socket.error, socket.timeout) as e:
+        if isinstance(e, socket.timeout):
+            conn._timed_out()
+        raise ConnectionError('[-] Error: while relaying from socket: (%s)' % (e.args,))
+
+
+def _wait_fd(sock, write):
+    '''Wait until a non-blocking socket is ready, within its timeout.'''
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLOUT if write else select.POLLIN)
+    timeout = sock.gettimeout()
+    if not poller.poll(None if timeout is None else timeout * 1000):
+        raise socket.timeout('timed out')
+
+
+def _tcp_relay_splice(conn, out_sock, size, buffer_size):
+    in_sock = conn.get_sock()
+    pipe_r, pipe_w = os.pipe()
+    try:
+        try:
+            import fcntl
+            fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, buffer_size)
+        except (ImportError, AttributeError, OSError):
+            pass
+        relayed = 0
+        while relayed < size:
+            try:
+                nbytes = os.splice(in_sock.fileno(), pipe_w, min(buffer_size, size - relayed),
+                                   flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                # timeout is cut again to time left of deadline
+                conn._settimeout(conn.transport.read_timeout)
+                _wait_fd(in_sock, False)
+                continue
+            if not nbytes:
+                raise ConnectionError('[-] Error: socket closed on remote end, '
+                                      'expect: %d, actual: %d' % (size, relayed))
+            pending = nbytes
+            while pending:
+                try:
+                    pending -= os.splice(pipe_r, out_sock.fileno(), pending,
+                                         flags=os.SPLICE_F_MOVE)
+                except BlockingIOError:
+                    _wait_fd(out_sock, True)
+            relayed += nbytes
+        return relayed
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+
+def _tcp_relay_copy(conn, out_sock, size, buffer_size):
+    view = memoryview(bytearray(min(buffer_size, size) or 1))
+    relayed = 0
+    while relayed < size:
+        nbytes = conn.recv_into(view[:min(len(view), size - relayed)])
+        if not nbytes:
+            raise ConnectionError('[-] Error: socket closed on remote end, '
+                                  'expect: %d, actual: %d' % (size, relayed))
+        out_sock.sendall(view[:nbytes])
+        relayed += nbytes
+    return relayed
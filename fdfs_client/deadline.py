@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: deadline.py
+
+"""Per-call deadlines, bounding all socket operations of the calling thread."""
+
+import time
+import functools
+import threading
+from fdfs_client.exceptions import DeadlineExceeded
+
+_local = threading.local()
+
+
+class Deadline(object):
+    """
+    Context manager, all tracker and storage operations of this thread within it
+    must finish in seconds. Each socket operation waits at most the time left,
+    after that DeadlineExceeded is raised and the connection in use is closed.
+    Nested deadlines never extend the outer one.
+    """
+
+    def __init__(self, seconds=None, expires=None):
+        '''
+        arguments:
+        @seconds: float, time allowed from now
+        @expires: float, time.monotonic() of deadline, instead of seconds
+        '''
+        self.expires = expires if seconds is None else time.monotonic() + seconds
+        self._outer = None
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'expires', None)
+        if self._outer is not None and (self.expires is None or self._outer < self.expires):
+            _local.expires = self._outer
+        else:
+            _local.expires = self.expires
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.expires = self._outer
+
+
+def current_deadline():
+    '''@return float, time.monotonic() of deadline of this thread, None if no deadline'''
+    return getattr(_local, 'expires', None)
+
+
+def remaining():
+    '''@return float, seconds left of deadline of this thread, None if no deadline'''
+    expires = getattr(_local, 'expires', None)
+    if expires is None:
+        return None
+    left = expires - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded('[-] Error: deadline exceeded.')
+    return left
+
+
+def backoff_sleep(seconds):
+    '''
+    Sleep seconds, e.g. a backoff before retry. If deadline of this thread
+    expires first, DeadlineExceeded is raised at once instead of sleeping.
+    '''
+    left = remaining()
+    if left is not None and left < seconds:
+        raise DeadlineExceeded('[-] Error: deadline exceeded, %.3fs left for a backoff of %.3fs.'
+                               % (left, seconds))
+    time.sleep(seconds)
+
+
+def with_deadline(func):
+    '''Decorator, func takes keyword argument deadline, seconds its call may take.'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        seconds = kwargs.pop('deadline', None)
+        if seconds is None:
+            return func(*args, **kwargs)
+        with Deadline(seconds):
+            return func(*args, **kwargs)
+    return wrapper
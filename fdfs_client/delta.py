@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: delta.py
+
+"""Block manifests of appender files, for sending only changed extents."""
+
+import os
+import json
+import hashlib
+from fdfs_client.utils import fdfs_atomic_write
+
+
+class Block_manifest(object):
+    """
+    Size and sha1 digest of each fixed size block of an appender file, as last
+    synced to storage server.
+    """
+
+    def __init__(self, remote_file_id, block_size, file_size=0, digests=None):
+        '''
+        arguments:
+        @remote_file_id: string, appender file id the manifest belongs to
+        @block_size: int
+        @file_size: long
+        @digests: list of hex digest of each block
+        '''
+        self.remote_file_id = remote_file_id
+        self.block_size = block_size
+        self.file_size = file_size
+        self.digests = digests or []
+
+    @classmethod
+    def from_file(cls, remote_file_id, local_filename, block_size):
+        '''@return Block_manifest of content of local_filename'''
+        digests = []
+        file_size = 0
+        with open(local_filename, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                digests.append(hashlib.sha1(block).hexdigest())
+                file_size += len(block)
+        return cls(remote_file_id, block_size, file_size, digests)
+
+    @classmethod
+    def load(cls, filename):
+        '''@return Block_manifest, None if not exist or broken'''
+        try:
+            with open(filename, 'rb') as f:
+                state = json.loads(f.read().decode())
+            return cls(state['remote_file_id'], state['block_size'],
+                       state['file_size'], state['digests'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, filename):
+        '''Write manifest atomically.'''
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        state = {
+            'remote_file_id': self.remote_file_id,
+            'block_size': self.block_size,
+            'file_size': self.file_size,
+            'digests': self.digests
+        }
+        fdfs_atomic_write(filename, json.dumps(state).encode())
+
+    def unsynced(self, file_size, extents):
+        '''
+        State of remote file while a sync is under way: this manifest cut to
+        file_size, with no digest for a partial last block or blocks within
+        extents, as they may have been sent in part. The next sync sends them again.
+        @return Block_manifest
+        '''
+        digests = self.digests[:file_size // self.block_size]
+        for offset, length in extents:
+            for index in range(offset // self.block_size,
+                               min(len(digests), (offset + length - 1) // self.block_size + 1)):
+                digests[index] = None
+        return Block_manifest(self.remote_file_id, self.block_size, file_size, digests)
+
+    def diff(self, new, max_extent_size=4 * 1024 * 1024):
+        '''
+        Extents of new manifest that differ from this one, within the size both
+        files have. Adjacent changed blocks are merged up to max_extent_size.
+        Bytes beyond this file size are not included, they are appended.
+        @return list of (offset, length)
+        '''
+        common_size = min(self.file_size, new.file_size)
+        extents = []
+        for index, digest in enumerate(new.digests):
+            offset = index * new.block_size
+            if offset >= common_size:
+                break
+            if index < len(self.digests) and self.digests[index] == digest:
+                continue
+            length = min(new.block_size, common_size - offset)
+            if extents and extents[-1][0] + extents[-1][1] == offset and \
+                    extents[-1][1] + length <= max_extent_size:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((offset, length))
+        return extents
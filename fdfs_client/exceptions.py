@@ -19,3 +19,11 @@ class InvaildResponse(FDFSError):
 class DataError(FDFSError):
     pass
 
+class IntegrityError(DataError):
+    pass
+
+class QueueFullError(FDFSError):
+    pass
+
+class DeadlineExceeded(ConnectionError):
+    pass
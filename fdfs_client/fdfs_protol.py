@@ -99,6 +99,8 @@ FDFS_FIELD_SEPERATOR = b'\x02'
 
 # common constants
 FDFS_STORAGE_ID_MAX_SIZE = 16
+# with use_storage_id, file names encode server ids up to it instead of ip
+FDFS_MAX_SERVER_ID = (1 << 24) - 1
 FDFS_GROUP_NAME_MAX_LEN = 16
 IP_ADDRESS_SIZE = 16
 FDFS_PROTO_PKG_LEN_SIZE = 8
@@ -121,6 +123,11 @@ FDFS_TRUNK_FILE_INFO_LEN = 16
 FDFS_FILE_EXT_NAME_MAX_LEN = 6
 FDFS_SPACE_SIZE_BASE_INDEX = 2  # storage space size based (MB)
 
+# flag bits of the file size field encoded in remote file name
+FDFS_INFINITE_FILE_SIZE = 256 * 1024 * 1024 * 1024 * 1024 * 1024
+FDFS_APPENDER_FILE_SIZE = FDFS_INFINITE_FILE_SIZE
+FDFS_TRUNK_FILE_MARK_SIZE = 512 * 1024 * 1024 * 1024 * 1024 * 1024
+
 FDFS_UPLOAD_BY_BUFFER = 1
 FDFS_UPLOAD_BY_FILENAME = 2
 FDFS_UPLOAD_BY_FILE = 3
@@ -209,23 +216,32 @@ class Tracker_header(object):
            if sucess, class member (pkg_len, cmd, status) is response.
         """
         try:
-            header = conn.recv(self.header_len())
+            # exact length, a short read can not break parsing
+            header = conn.recv_exact(self.header_len())
         except (socket.error, socket.timeout) as e:
             raise ConnectionError('[-] Error: while reading from socket: %s' \
                                   % (e.args,))
-        if not header:
-            raise ConnectionError("Socket closed on remote end")
         self._unpack(header)
 
 
+def _fdfs_meta_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
 def fdfs_pack_metadata(meta_dict):
-    ret = b''
-    for key in meta_dict:
-        ret += b'%s%c%s%c' % (key, FDFS_FIELD_SEPERATOR, meta_dict[key], FDFS_RECORD_SEPERATOR)
-    return ret[0:-1]
+    # meta: |-key-\x02-value-| records joined by \x01
+    return FDFS_RECORD_SEPERATOR.join(
+        _fdfs_meta_bytes(key) + FDFS_FIELD_SEPERATOR + _fdfs_meta_bytes(value)
+        for key, value in meta_dict.items())
 
 
 def fdfs_unpack_metadata(bytes_stream):
-    li = bytes_stream.split(FDFS_RECORD_SEPERATOR)
-    res = [item.split(FDFS_FIELD_SEPERATOR) for item in li]
-    return map(lambda l: map(lambda ll: ll.decode(), l), res)
+    ret = {}
+    if not bytes_stream:
+        return ret
+    for item in bytes_stream.split(FDFS_RECORD_SEPERATOR):
+        key, _, value = item.partition(FDFS_FIELD_SEPERATOR)
+        ret[key.decode()] = value.decode()
+    return ret
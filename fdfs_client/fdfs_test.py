@@ -116,8 +116,9 @@ def upslavebuffer_func():
         prefix_name = sys.argv[4]
         with open(local_filename, 'rb') as f:
             filebuffer = f.read()
-            ret_dict = client.upload_slave_by_buffer(local_filename,
-                                                     remote_fileid, prefix_name)
+            ret_dict = client.upload_slave_by_buffer(filebuffer, remote_fileid,
+                                                     file_ext_name=get_file_ext_name(local_filename),
+                                                     prefix_name=prefix_name)
         for key in ret_dict:
             print('[+] %s : %s' % (key, ret_dict[key]))
     except (ConnectionError, ResponseError, DataError) as e:
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: fdfs_top.py
+
+import os, sys, time
+
+try:
+    from fdfs_client.client import *
+    from fdfs_client.stats import Stats_sampler, format_top
+except ImportError:
+    import_path = os.path.abspath('../')
+    sys.path.append(import_path)
+    from fdfs_client.client import *
+    from fdfs_client.stats import Stats_sampler, format_top
+
+
+def usage():
+    s = 'Usage: python fdfs_top.py [{client.conf}] [{interval}] [--json]\n'
+    s += '\tShow per server and per group rates of storage servers, refreshed every\n'
+    s += '\tinterval seconds (default 5). With --json, print one JSON line per interval.\n'
+    s += 'e.g.: python fdfs_top.py /etc/fdfs/client.conf 2'
+    print(s)
+    sys.exit(0)
+
+
+args = [arg for arg in sys.argv[1:] if arg != '--json']
+as_json = '--json' in sys.argv
+if args and args[0] in ('-h', '--help'):
+    usage()
+conf_path = args[0] if args else 'client.conf'
+interval = float(args[1]) if len(args) > 1 else 5.0
+
+client = Fdfs_client(conf_path)
+sampler = Stats_sampler(client.tracker_pool)
+try:
+    while True:
+        try:
+            sampler.sample()
+        except (ConnectionError, ResponseError, DataError) as e:
+            print(e)
+        if as_json:
+            print(sampler.to_json(window=interval * 2))
+        else:
+            # clear screen and move cursor home
+            sys.stdout.write('\x1b[2J\x1b[H' + format_top(sampler.rates(window=interval * 2)) + '\n')
+        sys.stdout.flush()
+        time.sleep(interval)
+except KeyboardInterrupt:
+    pass
+finally:
+    client.close()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: hedge.py
+
+"""Hedged requests across replicas of a group."""
+
+import time
+import socket
+import threading
+from collections import deque
+from fdfs_client.exceptions import ConnectionError
+from fdfs_client.deadline import Deadline, current_deadline
+
+
+class _Hedge_attempt(object):
+    """One request of a hedged call, runs in its own thread."""
+
+    def __init__(self, store_serv):
+        self.store_serv = store_serv
+        self.start_time = time.time()
+        self.conn = None
+        self.cancelled = False
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def cancel(self):
+        '''Shutdown socket of the attempt, a blocked recv returns at once.'''
+        self.cancelled = True
+        if self.conn is None:
+            return
+        sock = self.conn.get_sock()
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class Hedge_policy(object):
+    """
+    Policy of hedged downloads.
+
+    The request is sent to the first replica. If it has not received the response
+    header within the hedge delay, the same request is sent to the next replica.
+    The first one receiving a header wins, the others are cancelled. A replica that
+    fails before any header also moves on to the next one.
+    The delay is fixed, or the given percentile of observed header latency. Every
+    request deposits budget_ratio into the budget, a hedge takes one from it, so
+    hedging adds at most budget_ratio extra requests.
+    """
+
+    def __init__(self, delay=None, percentile=95, min_samples=20, default_delay=0.05,
+                 window=1000, budget_ratio=0.05, max_budget=10):
+        '''
+        arguments:
+        @delay: float, fixed hedge delay in seconds, null to derive from latency
+        @percentile: int, percentile of header latency used as hedge delay
+        @min_samples: int, samples needed before latency is used
+        @default_delay: float, hedge delay before min_samples are observed
+        @window: int, count of latency samples kept
+        @budget_ratio: float, max ratio of hedged requests
+        @max_budget: float, max budget saved while hedging is not needed
+        '''
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.budget_ratio = budget_ratio
+        self.max_budget = max_budget
+        self._latencies = deque(maxlen=window)
+        self._budget = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+
+    def record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def hedge_delay(self):
+        '''@return float, seconds to wait for header before hedging'''
+        if self.delay is not None:
+            return self.delay
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        index = min(len(samples) - 1, len(samples) * self.percentile // 100)
+        return samples[index]
+
+    def _deposit(self):
+        with self._lock:
+            self.requests += 1
+            self._budget = min(self.max_budget, self._budget + self.budget_ratio)
+
+    def _withdraw(self):
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+            self.hedges += 1
+            return True
+
+    def run(self, replicas, func):
+        '''
+        Run func on replicas, hedged.
+        arguments:
+        @replicas: list of Storage_server, tried in order
+        @func: function(store_serv, on_connect, on_header), request to store_serv,
+               on_connect(conn) and on_header() must be called as
+               Storage_client.storage_download_to_buffer does
+        @return result of func of the winner
+        '''
+        self._deposit()
+        # deadline of caller bounds requests in other threads as well
+        expires = current_deadline()
+        cond = threading.Condition()
+        attempts = []
+        race = {'winner': None}
+
+        def start(store_serv):
+            attempt = _Hedge_attempt(store_serv)
+            attempts.append(attempt)
+
+            def on_connect(conn):
+                with cond:
+                    attempt.conn = conn
+                    if attempt.cancelled:
+                        raise ConnectionError('[-] Error: hedged request cancelled.')
+
+            def on_header():
+                with cond:
+                    if race['winner'] is not None:
+                        raise ConnectionError('[-] Error: hedged request cancelled.')
+                    race['winner'] = attempt
+                    for other in attempts:
+                        if other is not attempt:
+                            other.cancel()
+                    cond.notify_all()
+                self.record_latency(time.time() - attempt.start_time)
+
+            def target():
+                try:
+                    with Deadline(expires=expires):
+                        attempt.result = func(store_serv, on_connect, on_header)
+                except Exception as e:
+                    attempt.error = e
+                finally:
+                    with cond:
+                        attempt.done = True
+                        cond.notify_all()
+
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+        next_replica = 1
+        hedge_time = time.time() + self.hedge_delay()
+        may_hedge = len(replicas) > 1
+        with cond:
+            start(replicas[0])
+            while True:
+                winner = race['winner']
+                if winner is not None:
+                    if winner.done:
+                        break
+                    cond.wait()
+                    continue
+                if all(attempt.done for attempt in attempts):
+                    # every request failed before header, move on to next replica
+                    if next_replica >= len(replicas):
+                        raise attempts[-1].error
+                    start(replicas[next_replica])
+                    next_replica += 1
+                    continue
+                now = time.time()
+                if may_hedge and next_replica < len(replicas) and now >= hedge_time:
+                    may_hedge = False
+                    if self._withdraw():
+                        start(replicas[next_replica])
+                        next_replica += 1
+                    continue
+                cond.wait(hedge_time - now if may_hedge and next_replica < len(replicas) else None)
+        if winner.error is not None:
+            raise winner.error
+        return winner.result
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: pack.py
+
+"""Small files packed into appender containers, addressed by virtual ids."""
+
+import threading
+from fdfs_client.exceptions import FDFSError, DataError
+from fdfs_client.utils import split_remote_fileid
+
+# pack_id: |-container_file_id-#-offset-+-length-|
+PACK_ID_SEPERATOR = '#'
+# meta data key of container, the file id of its index
+META_PACK_INDEX = 'fdfs_pack_index'
+
+
+def fdfs_pack_id(container_id, offset, length):
+    '''@return string, virtual id of length bytes at offset of container'''
+    return '%s%s%d+%d' % (container_id, PACK_ID_SEPERATOR, offset, length)
+
+
+def parse_pack_id(pack_id):
+    '''@return (container_id, offset, length)'''
+    container_id, sep, extent = pack_id.rpartition(PACK_ID_SEPERATOR)
+    try:
+        offset, length = [int(x) for x in extent.split('+')]
+    except ValueError:
+        sep = ''
+    if not sep or offset < 0 or length < 0 or not split_remote_fileid(container_id):
+        raise DataError('[-] Error: pack id is invalid.(%s)' % pack_id)
+    return container_id, offset, length
+
+
+class Pack_index(object):
+    """
+    Entries of a container, replayed from its index. The index is an appender
+    file of text records, 'A offset length' when a blob is added, 'D offset
+    length' when it is deleted.
+    """
+
+    def __init__(self):
+        # (offset, length) of blobs, in order added
+        self.entries = []
+        self.deleted = set()
+
+    @staticmethod
+    def records(kind, extents):
+        '''@return bytes, records of kind 'A' or 'D' of list of (offset, length)'''
+        return b''.join(b'%s %d %d\n' % (kind.encode(), offset, length)
+                        for offset, length in extents)
+
+    @classmethod
+    def parse(cls, data):
+        '''@return Pack_index of index content, an incomplete last record is ignored'''
+        index = cls()
+        for line in data.split(b'\n')[:-1]:
+            try:
+                kind, offset, length = line.split()
+                offset, length = int(offset), int(length)
+            except ValueError:
+                raise DataError('[-] Error: pack index record is invalid.(%r)' % line)
+            if kind == b'A':
+                index.entries.append((offset, length))
+            elif kind == b'D':
+                index.deleted.add((offset, length))
+        return index
+
+    def live(self):
+        '''@return list of (offset, length) not deleted'''
+        return [entry for entry in self.entries if entry not in self.deleted]
+
+    def live_size(self):
+        return sum(length for offset, length in self.live())
+
+    def dead_size(self):
+        return sum(length for offset, length in self.entries
+                   if (offset, length) in self.deleted)
+
+
+class Pack_store(object):
+    """
+    Packs small blobs into appender containers, so many of them cost one upload
+    request and one storage file. Each write appends a batch of blobs to the
+    current container and records them in its index, a second appender file
+    named by META_PACK_INDEX in meta data of the container. Blobs are addressed
+    by virtual ids, container file id plus offset and length, read by ranged
+    download. Deleting a blob only records it, compact copies live blobs of a
+    container into a new one and deletes the old.
+    """
+
+    def __init__(self, client, max_container_size=64 * 1024 * 1024, file_ext_name='pack'):
+        '''
+        arguments:
+        @client: Fdfs_client
+        @max_container_size: long, a new container is started beyond it
+        @file_ext_name: string, extension name of containers
+        '''
+        self.client = client
+        self.max_container_size = max_container_size
+        self.file_ext_name = file_ext_name
+        self._lock = threading.Lock()
+        self._container_id = None
+        self._index_id = None
+        self._size = 0
+        # container_id -> index_id
+        self._index_ids = {}
+
+    def write(self, blobs):
+        '''
+        Append blobs to the current container, in one request.
+        arguments:
+        @blobs: list of bytes
+        @return list of virtual ids, in order of blobs
+        '''
+        data = b''.join(blobs)
+        if not data:
+            raise DataError('[-] Error: argument blobs can not be empty.')
+        with self._lock:
+            if self._container_id is not None and \
+                    self._size + len(data) > self.max_container_size:
+                self._container_id = None
+            base = self._size if self._container_id is not None else 0
+            extents = []
+            offset = base
+            for blob in blobs:
+                extents.append((offset, len(blob)))
+                offset += len(blob)
+            records = Pack_index.records('A', extents)
+            if self._container_id is None:
+                return self._new_container(data, records, extents)
+            try:
+                self.client.append_by_buffer(data, self._container_id)
+                self.client.append_by_buffer(records, self._index_id)
+            except FDFSError:
+                # size of container is unknown now, start a new one next time
+                self._container_id = None
+                raise
+            self._size += len(data)
+            return [fdfs_pack_id(self._container_id, o, n) for o, n in extents]
+
+    def _new_container(self, data, records, extents):
+        ret = self.client.upload_appender_by_buffer(data, self.file_ext_name)
+        container_id = ret['Remote file_id']
+        index_id = self.client.upload_appender_by_buffer(records, 'idx')['Remote file_id']
+        self.client.set_meta_data(container_id, {META_PACK_INDEX: index_id})
+        self._container_id, self._index_id = container_id, index_id
+        self._size = len(data)
+        self._index_ids[container_id] = index_id
+        return [fdfs_pack_id(container_id, o, n) for o, n in extents]
+
+    def read(self, pack_id):
+        '''@return bytes, content of blob'''
+        container_id, offset, length = parse_pack_id(pack_id)
+        if not length:
+            return b''
+        return self.client.download_to_buffer(container_id, offset, length)['Content']
+
+    def read_many(self, pack_ids, gap=64 * 1024):
+        '''
+        Read blobs by read_ranges, one call per container.
+        @return list of memoryview, in order of pack_ids
+        '''
+        results = [None] * len(pack_ids)
+        by_container = {}
+        for i, pack_id in enumerate(pack_ids):
+            container_id, offset, length = parse_pack_id(pack_id)
+            by_container.setdefault(container_id, []).append((i, offset, length))
+        for container_id, items in by_container.items():
+            views = self.client.read_ranges(container_id, [(o, n) for i, o, n in items], gap,
+                                            raw=True)
+            for (i, o, n), view in zip(items, views):
+                results[i] = view
+        return results
+
+    def index_id(self, container_id):
+        '''@return string, file id of index of container'''
+        index_id = self._index_ids.get(container_id)
+        if index_id is None:
+            index_id = self.client.get_meta_data(container_id).get(META_PACK_INDEX)
+            if not index_id:
+                raise DataError('[-] Error: %s is not a pack container.' % container_id)
+            self._index_ids[container_id] = index_id
+        return index_id
+
+    def index(self, container_id):
+        '''@return Pack_index of container'''
+        data = self.client.download_to_buffer(self.index_id(container_id))['Content']
+        return Pack_index.parse(data)
+
+    def delete(self, pack_id):
+        '''Record blob as deleted, its space is reclaimed by compact.'''
+        container_id, offset, length = parse_pack_id(pack_id)
+        self.client.append_by_buffer(Pack_index.records('D', [(offset, length)]),
+                                     self.index_id(container_id))
+
+    def compact(self, container_id, min_dead_ratio=0.5):
+        '''
+        Copy live blobs of container into the current container, then delete the
+        old container and its index. Virtual ids of copied blobs change, callers
+        must update their references by the returned mapping.
+        arguments:
+        @container_id: string
+        @min_dead_ratio: float, container is kept if less of it is deleted
+        @return dictionary, old virtual id -> new virtual id, empty if not compacted
+        '''
+        index = self.index(container_id)
+        dead_size = index.dead_size()
+        total_size = dead_size + index.live_size()
+        if not total_size or float(dead_size) / total_size < min_dead_ratio:
+            return {}
+        with self._lock:
+            if self._container_id == container_id:
+                self._container_id = None
+        # empty blobs are read without container, their ids stay valid
+        live = [(offset, length) for offset, length in index.live() if length]
+        old_ids = [fdfs_pack_id(container_id, o, n) for o, n in live]
+        new_ids = []
+        if live:
+            blobs = [bytes(view) for view in self.read_many(old_ids)]
+            # keep each batch within one container
+            batch, batch_size = [], 0
+            for blob in blobs:
+                if batch and batch_size + len(blob) > self.max_container_size:
+                    new_ids.extend(self.write(batch))
+                    batch, batch_size = [], 0
+                batch.append(blob)
+                batch_size += len(blob)
+            new_ids.extend(self.write(batch))
+        self.client.delete_file(container_id)
+        self.client.delete_file(self.index_id(container_id))
+        self._index_ids.pop(container_id, None)
+        return dict(zip(old_ids, new_ids))
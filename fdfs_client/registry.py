@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: registry.py
+
+"""Process wide registry of connection pools, shared by clients of one configuration."""
+
+import os
+import threading
+
+
+class Shared_pools(object):
+    """
+    Parsed client.conf, tracker pool and storage clients of one configuration.
+    It is reference counted by Pool_registry, pools are destroyed when the last
+    client releases it.
+    """
+
+    def __init__(self, key, trackers, tracker_pool):
+        self.key = key
+        self.trackers = trackers
+        self.tracker_pool = tracker_pool
+        # (ip_addr, port) -> Storage_client
+        self.storages = {}
+        self.lock = threading.Lock()
+        self.refs = 0
+
+    def destroy(self):
+        '''Close all connections of tracker pool and storage pools.'''
+        with self.lock:
+            storages = list(self.storages.values())
+            self.storages.clear()
+        for store in storages:
+            store.pool.destroy()
+        self.tracker_pool.destroy()
+
+
+class Pool_registry(object):
+    """Shared_pools keyed by real path of client.conf and pool class."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, conf_path, poolclass, factory):
+        '''
+        Get Shared_pools of configuration, and add a reference to it.
+        arguments:
+        @conf_path: string, path of client.conf
+        @poolclass: class of connection pool
+        @factory: function(), returns (trackers, tracker_pool), called if not registered
+        @return Shared_pools
+        '''
+        key = (os.path.realpath(conf_path), poolclass)
+        with self._lock:
+            shared = self._entries.get(key)
+            if shared is None:
+                trackers, tracker_pool = factory()
+                shared = Shared_pools(key, trackers, tracker_pool)
+                self._entries[key] = shared
+            shared.refs += 1
+            return shared
+
+    def release(self, shared):
+        '''Drop a reference of shared, destroy its pools when none is left.'''
+        with self._lock:
+            shared.refs -= 1
+            if shared.refs > 0:
+                return
+            if self._entries.get(shared.key) is shared:
+                del self._entries[shared.key]
+        shared.destroy()
+
+    def clear(self):
+        '''Destroy pools of all configurations, e.g. at shutdown.'''
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for shared in entries:
+            shared.destroy()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+registry = Pool_registry()
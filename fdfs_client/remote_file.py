@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: remote_file.py
+
+"""Random access file object over a remote file, served by ranged downloads."""
+
+import io
+import threading
+from collections import OrderedDict
+
+
+class Remote_file(io.RawIOBase):
+    """
+    Read only, seekable file object of a remote file.
+
+    The file is read in blocks of block_size, each one a ranged download request.
+    The last cache_blocks blocks are kept in LRU order. Once reads go through
+    consecutive blocks, the next read_ahead blocks are requested together, so a
+    sequential scan costs one request per read_ahead blocks.
+    It can be wrapped by io.BufferedReader, or passed to zipfile and the like.
+    """
+
+    def __init__(self, fetch, size, name=None, block_size=256 * 1024, cache_blocks=32,
+                 read_ahead=4):
+        '''
+        arguments:
+        @fetch: function(offset, length), returns bytes of the range
+        @size: long, file size
+        @name: string, remote file id
+        @block_size: int
+        @cache_blocks: int, blocks kept in memory, at least read_ahead + 1
+        @read_ahead: int, blocks requested at once when reading sequentially, 0 to disable
+        '''
+        super(Remote_file, self).__init__()
+        self._fetch = fetch
+        self.size = size
+        self.name = name
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.cache_blocks = max(cache_blocks, read_ahead + 1)
+        # block index -> bytes
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self._pos = 0
+        self._last_block = None
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % (whence,))
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        self._checkClosed()
+        view = memoryview(b).cast('B')
+        count = 0
+        while count < len(view) and self._pos < self.size:
+            index, begin = divmod(self._pos, self.block_size)
+            block = self._get_block(index)
+            if begin >= len(block):
+                # file shrank under the reader, position is past its end now
+                break
+            nbytes = min(len(block) - begin, len(view) - count)
+            view[count:count + nbytes] = block[begin:begin + nbytes]
+            count += nbytes
+            self._pos += nbytes
+        return count
+
+    def _get_block(self, index):
+        with self._lock:
+            block = self._blocks.get(index)
+            if block is not None:
+                self._blocks.move_to_end(index)
+            sequential = self._last_block is not None and index == self._last_block + 1
+            self._last_block = index
+        if block is not None:
+            return block
+        last_index = (self.size - 1) // self.block_size
+        count = 1
+        if sequential and self.read_ahead:
+            count = min(1 + self.read_ahead, last_index - index + 1)
+        offset = index * self.block_size
+        data = self._fetch(offset, min(count * self.block_size, self.size - offset))
+        self.requests += 1
+        if len(data) < min(count * self.block_size, self.size - offset):
+            # file is shorter than expected, e.g. appender truncated
+            self.size = offset + len(data)
+            count = max(1, -(-len(data) // self.block_size))
+        with self._lock:
+            for i in range(count):
+                self._blocks[index + i] = data[i * self.block_size:(i + 1) * self.block_size]
+                self._blocks.move_to_end(index + i)
+            while len(self._blocks) > self.cache_blocks:
+                self._blocks.popitem(last=False)
+            return self._blocks[index]
+
+    def close(self):
+        self._blocks.clear()
+        super(Remote_file, self).close()
+
+    def __repr__(self):
+        return 'Remote_file(%r, size=%d)' % (self.name, self.size)
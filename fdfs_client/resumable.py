@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: resumable.py
+
+"""Checkpoint journals of resumable transfers."""
+
+import os
+import json
+from fdfs_client.utils import fdfs_atomic_write
+
+
+class Transfer_journal(object):
+    """
+    Checkpoint of a resumable upload or download, a small JSON file beside the
+    local file. It is rewritten atomically after every confirmed chunk, so after a
+    crash it holds the last offset known to be transferred.
+    """
+
+    def __init__(self, filename):
+        '''
+        arguments:
+        @filename: string, path of journal file
+        '''
+        self.filename = filename
+
+    def load(self):
+        '''@return dictionary, saved state, None if no journal or it is broken'''
+        try:
+            with open(self.filename, 'rb') as f:
+                state = json.loads(f.read().decode())
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(state, dict):
+            return None
+        return state
+
+    def save(self, state):
+        '''Write state, a JSON serializable dictionary.'''
+        fdfs_atomic_write(self.filename, json.dumps(state).encode())
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: stats.py
+
+"""Sampler of storage server counters, with rates per server and per group."""
+
+import json
+import time
+import socket
+import operator
+import threading
+from array import array
+from fdfs_client.tracker_client import Tracker_client, parse_storage_status
+from fdfs_client.exceptions import FDFSError
+
+# cumulative counters of Storage_info, sampled as one row
+OPS = ('upload', 'append', 'modify', 'truncate', 'setmeta', 'del', 'download',
+       'getmeta', 'create_link', 'del_link', 'file_open', 'file_read', 'file_write')
+BYTES = ('upload', 'append', 'modify', 'download', 'sync_in', 'sync_out')
+COUNTERS = tuple(['total_%s_count' % op for op in OPS] +
+                 ['success_%s_count' % op for op in OPS] +
+                 ['total_%s_bytes' % kind for kind in BYTES] +
+                 ['success_%s_bytes' % kind for kind in BYTES])
+_INDEX = dict((name, i) for i, name in enumerate(COUNTERS))
+_TOTAL_OPS = [_INDEX['total_%s_count' % op] for op in OPS]
+_SUCCESS_OPS = [_INDEX['success_%s_count' % op] for op in OPS]
+
+
+class Counter_ring(object):
+    """
+    Ring buffer of counter rows of one storage server. Rows are kept in one flat
+    array of 64 bit integers, capacity rows of len(COUNTERS) columns.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.width = len(COUNTERS)
+        self.times = array('d', [0.0]) * capacity
+        self.values = array('q', [0]) * (capacity * self.width)
+        self.count = 0
+        self.head = 0
+
+    def append(self, sample_time, storage_info):
+        begin = self.head * self.width
+        self.values[begin:begin + self.width] = array(
+            'q', [getattr(storage_info, name) for name in COUNTERS])
+        self.times[self.head] = sample_time
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def row(self, age):
+        '''@return (time, array of counters) of the row age samples before newest'''
+        index = (self.head - 1 - age) % self.capacity
+        begin = index * self.width
+        return self.times[index], self.values[begin:begin + self.width]
+
+    def deltas(self, window):
+        '''
+        Counter increase between newest row and the oldest row within window seconds.
+        A counter going down, when server restarted, counts as no increase.
+        @return (seconds, list of deltas), None if less than two rows
+        '''
+        if self.count < 2:
+            return None
+        newest_time, newest = self.row(0)
+        age = 1
+        while age + 1 < self.count and newest_time - self.row(age + 1)[0] <= window:
+            age += 1
+        oldest_time, oldest = self.row(age)
+        seconds = newest_time - oldest_time
+        if seconds <= 0:
+            return None
+        return seconds, [d if d > 0 else 0 for d in map(operator.sub, newest, oldest)]
+
+
+def _rates(seconds, deltas):
+    total_ops = sum(deltas[i] for i in _TOTAL_OPS)
+    failed_ops = total_ops - sum(deltas[i] for i in _SUCCESS_OPS)
+    rates = {
+        'Ops/s': total_ops / seconds,
+        'Upload/s': deltas[_INDEX['total_upload_count']] / seconds,
+        'Download/s': deltas[_INDEX['total_download_count']] / seconds,
+        'Delete/s': deltas[_INDEX['total_del_count']] / seconds,
+        'Error ratio': float(max(failed_ops, 0)) / total_ops if total_ops else 0.0,
+    }
+    for kind in BYTES:
+        rates['%s bytes/s' % kind.replace('_', ' ').capitalize()] = deltas[_INDEX['total_%s_bytes' % kind]] / seconds
+    return rates
+
+
+class Stats_sampler(object):
+    """
+    Poll counters of all storage servers of the cluster into ring buffers, and
+    compute rates: operations, bytes and error ratio per second, per server and
+    per group.
+    """
+
+    def __init__(self, tracker_pool, capacity=120, service=None):
+        '''
+        arguments:
+        @tracker_pool: ConnectionPool of tracker servers
+        @capacity: int, samples kept per server
+        @service: Topology_service, sample by its refresh, can be null
+        '''
+        self.tracker_pool = tracker_pool
+        self.capacity = capacity
+        self.service = service
+        # (group_name, ip_addr) -> Counter_ring
+        self._rings = {}
+        # (group_name, ip_addr) -> status of last sample
+        self._status = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        '''Poll counters of all servers once.'''
+        if self.service is not None:
+            snapshot = self.service.refresh()
+            listing = [(name, list(servers.values())) for name, servers in snapshot.servers.items()]
+        else:
+            tc = Tracker_client(self.tracker_pool)
+            listing = [(gi.group_name, tc.tracker_list_servers(gi.group_name)['Servers'])
+                       for gi in tc.tracker_list_all_groups()['Groups']]
+        now = time.time()
+        with self._lock:
+            seen = set()
+            for group_name, servers in listing:
+                for si in servers:
+                    key = (group_name, si.ip_addr)
+                    seen.add(key)
+                    ring = self._rings.get(key)
+                    if ring is None:
+                        ring = self._rings[key] = Counter_ring(self.capacity)
+                    ring.append(now, si)
+                    self._status[key] = parse_storage_status(si.status)
+            for key in set(self._rings) - seen:
+                del self._rings[key]
+                del self._status[key]
+
+    def rates(self, window=60):
+        '''
+        Rates over the last window seconds.
+        @return dictionary {
+            'Time'    : time of newest sample,
+            'Servers' : list of dictionary of rates, with 'Group name', 'IP' and 'Status',
+            'Groups'  : list of dictionary of rates summed over servers, with 'Group name'
+        }
+        '''
+        servers = []
+        groups = {}
+        newest = 0
+        with self._lock:
+            for (group_name, ip_addr), ring in sorted(self._rings.items()):
+                result = ring.deltas(window)
+                if result is None:
+                    continue
+                seconds, deltas = result
+                newest = max(newest, ring.row(0)[0])
+                rates = _rates(seconds, deltas)
+                rates.update({'Group name': group_name, 'IP': ip_addr,
+                              'Status': self._status[(group_name, ip_addr)]})
+                servers.append(rates)
+                # per group rates, summed as counter deltas normalized to one second
+                group = groups.setdefault(group_name, [0.0] * len(COUNTERS))
+                groups[group_name] = list(map(operator.add, group,
+                                              [d / seconds for d in deltas]))
+        group_rates = []
+        for group_name, per_second in sorted(groups.items()):
+            rates = _rates(1.0, per_second)
+            rates['Group name'] = group_name
+            group_rates.append(rates)
+        return {'Time': newest, 'Servers': servers, 'Groups': group_rates}
+
+    def to_json(self, window=60):
+        '''@return string, rates as JSON'''
+        return json.dumps(self.rates(window), sort_keys=True)
+
+    def start(self, interval=5):
+        '''Sample every interval seconds in a background thread.'''
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+
+        def run():
+            while not self._stopped.is_set():
+                try:
+                    self.sample()
+                except (FDFSError, socket.error):
+                    pass
+                self._stopped.wait(interval)
+        self._thread = threading.Thread(target=run, name='fdfs-stats')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+
+def _human(value):
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if abs(value) < 1024:
+            return '%.1f%s' % (value, unit)
+        value /= 1024.0
+    return '%.1fP' % value
+
+
+def format_top(rates):
+    '''
+    Format rates as a top style table, busiest server first.
+    arguments:
+    @rates: dictionary returned by Stats_sampler.rates
+    @return string
+    '''
+    header = '%-16s %-15s %-8s %8s %8s %8s %9s %9s %9s %6s' % (
+        'GROUP', 'IP', 'STATUS', 'OPS/S', 'UP/S', 'DOWN/S', 'UP B/S', 'DOWN B/S',
+        'SYNC B/S', 'ERR%')
+    lines = [time.strftime('fdfs_top - %H:%M:%S', time.localtime(rates['Time'] or time.time())),
+             '', header]
+
+    def line(group_name, ip_addr, status, r):
+        return '%-16s %-15s %-8s %8.1f %8.1f %8.1f %9s %9s %9s %6.2f' % (
+            group_name, ip_addr, status, r['Ops/s'], r['Upload/s'], r['Download/s'],
+            _human(r['Upload bytes/s']), _human(r['Download bytes/s']),
+            _human(r['Sync in bytes/s'] + r['Sync out bytes/s']), r['Error ratio'] * 100)
+
+    for r in sorted(rates['Servers'], key=lambda r: r['Ops/s'], reverse=True):
+        lines.append(line(r['Group name'], r['IP'], r['Status'], r))
+    lines.append('')
+    for r in rates['Groups']:
+        lines.append(line(r['Group name'], '*', '', r))
+    return '\n'.join(lines)
@@ -9,36 +9,38 @@ import datetime
 import errno
 from fdfs_client.fdfs_protol import *
 from fdfs_client.connection import *
-from fdfs_client.sendfile import *
 from fdfs_client.exceptions import (
     FDFSError,
     ConnectionError,
     ResponseError,
     InvaildResponse,
-    DataError
+    DataError,
+    DeadlineExceeded
 )
 from fdfs_client.utils import *
 
 
-def tcp_send_file(conn, filename, buffer_size=1024):
+def tcp_send_file(conn, filename, buffer_size=None):
     '''
     Send file to server, and split into multiple pkgs while sending.
     arguments:
     @conn: connection
     @filename: string
-    @buffer_size: int ,send buffer size
+    @buffer_size: int ,send buffer size, default is chunk size of conn
     @Return int: file size if success else raise ConnectionError.
     '''
     file_size = 0
     with open(filename, 'rb') as f:
         while 1:
             try:
-                send_buffer = f.read(buffer_size)
+                send_buffer = f.read(buffer_size or conn.chunk_size())
                 send_size = len(send_buffer)
                 if send_size == 0:
                     break
                 tcp_send_data(conn, send_buffer)
                 file_size += send_size
+            except DeadlineExceeded:
+                raise
             except ConnectionError as e:
                 raise ConnectionError('[-] Error while uploading file(%s).' % e.args)
             except IOError as e:
@@ -46,16 +48,22 @@ def tcp_send_file(conn, filename, buffer_size=1024):
     return file_size
 
 
-def tcp_send_file_ex(conn, filename, buffer_size=4096):
+def tcp_send_file_ex(conn, filename, buffer_size=None):
     '''
     Send file to server. Using linux system call 'sendfile'.
     arguments:
     @conn: connection
     @filename: string
+    @buffer_size: int, bytes per sendfile call, default is max chunk size of conn
     @return long, sended size
     '''
+    buffer_size = buffer_size or conn.transport.max_chunk_size
     if 'linux' not in sys.platform.lower():
         raise DataError('[-] Error: \'sendfile\' system call only available on linux.')
+    if hasattr(os, 'sendfile'):
+        sendfile = os.sendfile
+    else:
+        from fdfs_client.sendfile import sendfile
     nbytes = 0
     offset = 0
     sock_fd = conn.get_sock().fileno()
@@ -70,45 +78,44 @@ def tcp_send_file_ex(conn, filename, buffer_size=4096):
                 offset += sent
             except OSError as e:
                 if e.errno == errno.EAGAIN:
+                    conn.check_deadline()
                     continue
                 raise
     return nbytes
 
 
-def tcp_recv_file(conn, local_filename, file_size, buffer_size=1024):
+def tcp_recv_file(conn, local_filename, file_size, buffer_size=None, verifier=None):
     '''
     Receive file from server, fragmented it while receiving and write to disk.
     arguments:
     @conn: connection
-    @local_filename: string
+    @local_filename: string, or a binary file object written at its position
     @file_size: int, remote file size
-    @buffer_size: int, receive buffer size
+    @buffer_size: int, receive buffer size, default is chunk size of conn
+    @verifier: Crc32_verifier, updated with each received chunk, can be null
     @Return int: file size if success else raise ConnectionError.
     '''
     total_file_size = 0
-    flush_size = 0
-    remain_bytes = file_size
-    with open(local_filename, 'wb+') as f:
-        diff_size = remain_bytes
-        while diff_size > buffer_size:
-            diff_size = remain_bytes - total_file_size
+    own_file = not hasattr(local_filename, 'write')
+    f = open(local_filename, 'wb+') if own_file else local_filename
+    try:
+        while total_file_size < file_size:
+            recv_size = min(buffer_size or conn.chunk_size(), file_size - total_file_size)
             try:
-                if diff_size >= buffer_size:
-                    file_buffer, recv_size = tcp_recv_response(conn, buffer_size, \
-                                                               buffer_size)
-                else:
-                    file_buffer, recv_size = tcp_recv_response(conn, diff_size, \
-                                                               buffer_size)
+                file_buffer, recv_size = tcp_recv_response(conn, recv_size, recv_size)
                 f.write(file_buffer)
                 total_file_size += recv_size
-                flush_size += recv_size
-                if flush_size >= 4096:
-                    f.flush()
-                    flush_size = 0
+                if verifier is not None:
+                    verifier.update(file_buffer)
+            except DeadlineExceeded:
+                raise
             except ConnectionError as e:
                 raise ConnectionError('[-] Error: while downloading file(%s).' % e.args)
             except IOError as e:
                 raise DataError('[-] Error: while writting local file(%s).' % e.args)
+    finally:
+        if own_file:
+            f.close()
     return total_file_size
 
 
@@ -119,10 +126,13 @@ class Storage_client(object):
     """
 
     def __init__(self, *kwargs):
+        # kwargs: ip_addr, port, timeout and optional Transport_options
+        self.transport = kwargs[3] if len(kwargs) > 3 else None
         conn_kwargs = {
             'name': 'Storage Pool',
             'host_tuple': ((kwargs[0], kwargs[1]),),
-            'timeout': kwargs[2]
+            'timeout': kwargs[2],
+            'transport': self.transport
         }
         self.pool = ConnectionPool(**conn_kwargs)
         return None
@@ -146,7 +156,8 @@ class Storage_client(object):
         conn_kwargs = {
             'name': 'Storage_pool',
             'host_tuple': ((new_store_serv.ip_addr, new_store_serv.port),),
-            'timeout': timeout
+            'timeout': timeout,
+            'transport': self.transport
         }
         self.pool = ConnectionPool(**conn_kwargs)
         return True
@@ -181,13 +192,42 @@ class Storage_client(object):
 
         """
 
-        print('getting connection')
         store_conn = self.pool.get_connection()
-        print(store_conn)
+        try:
+            group_name, remote_filename, send_file_size = self._storage_send_upload(
+                store_conn, store_serv, file_buffer, file_size, upload_type, cmd,
+                master_filename, prefix_name, file_ext_name)
+        except ConnectionError:
+            store_conn.disconnect()
+            raise
+        finally:
+            self.pool.release(store_conn)
+        if meta_dict and len(meta_dict) > 0:
+            status = self.storage_set_metadata(tracker_client, store_serv, remote_filename, meta_dict)
+            if status != 0:
+                # rollback
+                self.storage_delete_file(tracker_client, store_serv, remote_filename)
+                raise DataError('[-] Error: %d, %s' % (status, os.strerror(status)))
+        ret_dic = {
+            'Group name': group_name,
+            'Remote file_id': group_name + os.sep + remote_filename,
+            'Status': 'Upload successed.',
+            'Local file name': file_buffer if (
+                upload_type == FDFS_UPLOAD_BY_FILENAME or upload_type == FDFS_UPLOAD_BY_FILE) \
+                else '',
+            'Uploaded size': appromix(send_file_size),
+            'Storage IP': store_serv.ip_addr
+        }
+        return ret_dic
+
+    def _storage_send_upload(self, store_conn, store_serv, file_buffer, file_size, upload_type, cmd,
+                             master_filename=None, prefix_name=None, file_ext_name=None):
+        '''
+        Send one upload request on store_conn and receive its response.
+        @Return (group_name, remote_filename, uploaded size)
+        '''
         th = Tracker_header()
-        print(th)
         master_filename_len = len(master_filename) if master_filename else 0
-        prefix_name_len = len(prefix_name) if prefix_name else 0
         upload_slave = len(store_serv.group_name) and master_filename_len
         file_ext_name = str(file_ext_name) if file_ext_name else ''
         # non_slave_fmt |-store_path_index(1)-file_size(8)-file_ext_name(6)-|
@@ -199,57 +239,104 @@ class Storage_client(object):
             else struct.calcsize(non_slave_fmt)
         th.pkg_len += file_size
         th.cmd = cmd
-        th.send_header(store_conn)
         if upload_slave:
-            send_buffer = struct.pack(slave_fmt, master_filename_len, file_size, prefix_name, file_ext_name,
-                                      master_filename)
+            send_buffer = struct.pack(slave_fmt, master_filename_len, file_size, (prefix_name or '').encode(),
+                                      file_ext_name.encode(), master_filename.encode())
         else:
             send_buffer = struct.pack(non_slave_fmt, store_serv.store_path_index, file_size, file_ext_name.encode())
+        th.send_header(store_conn)
+        tcp_send_data(store_conn, send_buffer)
+        if upload_type == FDFS_UPLOAD_BY_FILENAME:
+            send_file_size = tcp_send_file(store_conn, file_buffer)
+        elif upload_type == FDFS_UPLOAD_BY_BUFFER:
+            tcp_send_data(store_conn, file_buffer)
+            send_file_size = len(file_buffer)
+        elif upload_type == FDFS_UPLOAD_BY_FILE:
+            send_file_size = tcp_send_file_ex(store_conn, file_buffer)
+        th.recv_header(store_conn)
+        if th.status != 0:
+            raise DataError('[-] Error: %d, %s' % (th.status, os.strerror(th.status)))
+        recv_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
+        if recv_size <= FDFS_GROUP_NAME_MAX_LEN:
+            errmsg = '[-] Error: Storage response length is not match, '
+            errmsg += 'expect: %d, actual: %d' % (th.pkg_len, recv_size)
+            raise ResponseError(errmsg)
+        # recv_fmt: |-group_name(16)-remote_file_name(recv_size - 16)-|
+        recv_fmt = '!%ds %ds' % (FDFS_GROUP_NAME_MAX_LEN, \
+                                 th.pkg_len - FDFS_GROUP_NAME_MAX_LEN)
+        (group_name, remote_name) = struct.unpack(recv_fmt, recv_buffer)
+        return (group_name.strip(b'\x00').decode(), remote_name.strip(b'\x00').decode(),
+                send_file_size)
+
+    def storage_upload_with_slaves(self, tracker_client, store_serv, master_buffer, slaves,
+                                   file_ext_name=None, meta_dict=None):
+        '''
+        Upload master file by buffer, then its slave files, one request after
+        another on one connection. If any upload fails, the files already uploaded
+        are deleted.
+        arguments:
+        @master_buffer: bytes
+        @slaves: list of (prefix_name, buffer, file_ext_name)
+        @file_ext_name: string, of master
+        @meta_dict: dictionary, meta data of master, can be null
+        @Return dictionary
+            'Group name'      : group_name,
+            'Remote file_id'  : remote_file_id of master,
+            'Slaves'          : dictionary, prefix_name -> remote_file_id,
+            'Status'          : 'Upload successed.',
+            'Uploaded size'   : upload_size,
+            'Storage IP'      : storage_ip
+        '''
+        uploaded = []
+        total_size = 0
+        slave_ids = {}
+        store_conn = self.pool.get_connection()
         try:
-            tcp_send_data(store_conn, send_buffer)
-            if upload_type == FDFS_UPLOAD_BY_FILENAME:
-                send_file_size = tcp_send_file(store_conn, file_buffer)
-            elif upload_type == FDFS_UPLOAD_BY_BUFFER:
-                tcp_send_data(store_conn, file_buffer)
-            elif upload_type == FDFS_UPLOAD_BY_FILE:
-                send_file_size = tcp_send_file_ex(store_conn, file_buffer)
-            th.recv_header(store_conn)
-            if th.status != 0:
-                raise DataError('[-] Error: %d, %s' % (th.status, os.strerror(th.status)))
-            recv_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
-            if recv_size <= FDFS_GROUP_NAME_MAX_LEN:
-                errmsg = '[-] Error: Storage response length is not match, '
-                errmsg += 'expect: %d, actual: %d' % (th.pkg_len, recv_size)
-                raise ResponseError(errmsg)
-            # recv_fmt: |-group_name(16)-remote_file_name(recv_size - 16)-|
-            recv_fmt = '!%ds %ds' % (FDFS_GROUP_NAME_MAX_LEN, \
-                                     th.pkg_len - FDFS_GROUP_NAME_MAX_LEN)
-            (group_name, remote_name) = struct.unpack(recv_fmt, recv_buffer)
-            remote_filename = remote_name.strip(b'\x00').decode()
-            if meta_dict and len(meta_dict) > 0:
-                status = self.storage_set_metadata(tracker_client, store_serv, remote_filename, meta_dict)
-                if status != 0:
-                    # rollback
-                    self.storage_delete_file(tracker_client, store_serv, remote_filename)
-                    raise DataError('[-] Error: %d, %s' % (status, os.strerror(status)))
-        except:
+            try:
+                group_name, master_filename, send_size = self._storage_send_upload(
+                    store_conn, store_serv, master_buffer, len(master_buffer), FDFS_UPLOAD_BY_BUFFER,
+                    STORAGE_PROTO_CMD_UPLOAD_FILE, file_ext_name=file_ext_name)
+                uploaded.append(master_filename)
+                total_size += send_size
+                for prefix_name, filebuffer, slave_ext_name in slaves:
+                    remote_filename = self._storage_send_upload(
+                        store_conn, store_serv, filebuffer, len(filebuffer), FDFS_UPLOAD_BY_BUFFER,
+                        STORAGE_PROTO_CMD_UPLOAD_SLAVE_FILE, master_filename, prefix_name,
+                        slave_ext_name if slave_ext_name is not None else file_ext_name)[1]
+                    uploaded.append(remote_filename)
+                    total_size += len(filebuffer)
+                    slave_ids[prefix_name] = group_name + os.sep + remote_filename
+            except FDFSError as e:
+                # a rejected request leaves connection usable, others do not
+                if not isinstance(e, DataError):
+                    store_conn.disconnect()
+                raise
+            finally:
+                self.pool.release(store_conn)
+        except FDFSError:
+            self._storage_rollback(tracker_client, store_serv, uploaded)
             raise
-        finally:
-            self.pool.release(store_conn)
-        ret_dic = {
-            'Group name': group_name.strip(b'\x00').decode(),
-            'Remote file_id': group_name.strip(b'\x00').decode() + os.sep + \
-                              remote_filename,
+        if meta_dict:
+            status = self.storage_set_metadata(tracker_client, store_serv, master_filename, meta_dict)
+            if status != 0:
+                self._storage_rollback(tracker_client, store_serv, uploaded)
+                raise DataError('[-] Error: %d, %s' % (status, os.strerror(status)))
+        return {
+            'Group name': group_name,
+            'Remote file_id': group_name + os.sep + master_filename,
+            'Slaves': slave_ids,
             'Status': 'Upload successed.',
-            'Local file name': file_buffer if (
-                upload_type == FDFS_UPLOAD_BY_FILENAME or upload_type == FDFS_UPLOAD_BY_FILE) \
-                else '',
-            'Uploaded size': appromix(send_file_size) if (
-                upload_type == FDFS_UPLOAD_BY_FILENAME or upload_type == FDFS_UPLOAD_BY_FILE) else appromix(
-                len(file_buffer)),
+            'Uploaded size': appromix(total_size),
             'Storage IP': store_serv.ip_addr
         }
-        return ret_dic
+
+    def _storage_rollback(self, tracker_client, store_serv, remote_filenames):
+        '''Delete uploaded files, slaves before master, ignoring errors.'''
+        for remote_filename in reversed(remote_filenames):
+            try:
+                self.storage_delete_file(tracker_client, store_serv, remote_filename)
+            except FDFSError:
+                pass
 
     def storage_upload_by_filename(self, tracker_client, store_serv, filename, \
                                    meta_dict=None):
@@ -301,12 +388,12 @@ class Storage_client(object):
 
     def storage_upload_slave_by_buffer(self, tracker_client, store_serv,
                                        filebuffer, remote_filename, meta_dict,
-                                       file_ext_name):
+                                       file_ext_name, prefix_name=None):
         file_size = len(filebuffer)
         return self._storage_do_upload_file(tracker_client, store_serv,
                                             filebuffer, file_size, FDFS_UPLOAD_BY_BUFFER,
                                             meta_dict, STORAGE_PROTO_CMD_UPLOAD_SLAVE_FILE,
-                                            None, remote_filename, file_ext_name)
+                                            remote_filename, prefix_name, file_ext_name)
 
     def storage_upload_appender_by_filename(self, tracker_client, store_serv,
                                             filename, meta_dict=None):
@@ -355,7 +442,8 @@ class Storage_client(object):
             if th.status != 0:
                 raise DataError('Error: %d, %s' % (th.status, os.strerror(th.status)))
                 # recv_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
-        except:
+        except ConnectionError:
+            store_conn.disconnect()
             raise
         finally:
             self.pool.release(store_conn)
@@ -363,11 +451,16 @@ class Storage_client(object):
         return ('Delete file successed.', remote_filename, store_serv.ip_addr)
 
     def _storage_do_download_file(self, tracker_client, store_serv, file_buffer, \
-                                  offset, download_size, download_type, remote_filename):
+                                  offset, download_size, download_type, remote_filename,
+                                  on_connect=None, on_header=None, verifier=None):
         '''
         Core of download file from storage server.
         You can choice download type, optional FDFS_DOWNLOAD_TO_FILE or 
         FDFS_DOWNLOAD_TO_BUFFER. And you can choice file offset.
+        on_connect(conn) is called once connection is got from pool, on_header()
+        once a successful response header is received. Both can be null.
+        verifier is a Crc32_verifier, updated while receiving. It can be null. If whole
+        file is downloaded, it is checked and IntegrityError is raised on mismatch.
         @Return dictionary
             'Remote file name' : remote_filename,
             'Content' : local_filename or buffer,
@@ -375,32 +468,32 @@ class Storage_client(object):
             'Storage IP'      : storage_ip
         '''
         store_conn = self.pool.get_connection()
-        th = Tracker_header()
-        remote_filename_len = len(remote_filename)
-        th.pkg_len = FDFS_PROTO_PKG_LEN_SIZE * 2 + FDFS_GROUP_NAME_MAX_LEN + \
-                     remote_filename_len
-        th.cmd = STORAGE_PROTO_CMD_DOWNLOAD_FILE
         try:
-            th.send_header(store_conn)
-            # down_fmt: |-offset(8)-download_bytes(8)-group_name(16)-remote_filename(len)-|
-            down_fmt = '!Q Q %ds %ds' % (FDFS_GROUP_NAME_MAX_LEN, remote_filename_len)
-            send_buffer = struct.pack(down_fmt, offset, download_size, store_serv.group_name.encode(),
-                                      remote_filename.encode())
-            tcp_send_data(store_conn, send_buffer)
-            th.recv_header(store_conn)
-            # if th.status == 2:
-            #    raise DataError('[-] Error: remote file %s is not exist.' % 
-            #                    (store_serv.group_name + os.sep + remote_filename))
-            if th.status != 0:
-                raise DataError('Error: %d %s' % (th.status, os.strerror(th.status)))
-            if download_type == FDFS_DOWNLOAD_TO_FILE:
-                total_recv_size = tcp_recv_file(store_conn, file_buffer, th.pkg_len)
-            elif download_type == FDFS_DOWNLOAD_TO_BUFFER:
-                recv_buffer, total_recv_size = tcp_recv_response(store_conn, th.pkg_len)
-        except:
+            if on_connect is not None:
+                on_connect(store_conn)
+            th = self._storage_send_download(store_conn, store_serv, offset, download_size,
+                                             remote_filename)
+            try:
+                if on_header is not None:
+                    on_header()
+                if download_type == FDFS_DOWNLOAD_TO_FILE:
+                    total_recv_size = tcp_recv_file(store_conn, file_buffer, th.pkg_len,
+                                                    verifier=verifier)
+                elif download_type == FDFS_DOWNLOAD_TO_BUFFER:
+                    recv_buffer, total_recv_size = tcp_recv_response(store_conn, th.pkg_len)
+                    if verifier is not None:
+                        verifier.update(recv_buffer)
+            except Exception:
+                # rest of body is unread, e.g. writing local file failed
+                store_conn.disconnect()
+                raise
+        except ConnectionError:
+            store_conn.disconnect()
             raise
         finally:
             self.pool.release(store_conn)
+        if verifier is not None and not offset and not download_size:
+            verifier.verify(store_serv.ip_addr)
         ret_dic = {
             'Remote file_id': store_serv.group_name + os.sep + remote_filename,
             'Content': file_buffer if download_type == \
@@ -410,20 +503,137 @@ class Storage_client(object):
         }
         return ret_dic
 
+    def _storage_send_download(self, store_conn, store_serv, offset, download_size, remote_filename):
+        '''
+        Send download request and receive response header.
+        @Return Tracker_header, its pkg_len is size of file content that follows
+        '''
+        th = Tracker_header()
+        remote_filename_len = len(remote_filename)
+        th.pkg_len = FDFS_PROTO_PKG_LEN_SIZE * 2 + FDFS_GROUP_NAME_MAX_LEN + \
+                     remote_filename_len
+        th.cmd = STORAGE_PROTO_CMD_DOWNLOAD_FILE
+        th.send_header(store_conn)
+        # down_fmt: |-offset(8)-download_bytes(8)-group_name(16)-remote_filename(len)-|
+        down_fmt = '!Q Q %ds %ds' % (FDFS_GROUP_NAME_MAX_LEN, remote_filename_len)
+        send_buffer = struct.pack(down_fmt, offset, download_size, store_serv.group_name.encode(),
+                                  remote_filename.encode())
+        tcp_send_data(store_conn, send_buffer)
+        th.recv_header(store_conn)
+        # if th.status == 2:
+        #    raise DataError('[-] Error: remote file %s is not exist.' %
+        #                    (store_serv.group_name + os.sep + remote_filename))
+        if th.status != 0:
+            raise DataError('Error: %d %s' % (th.status, os.strerror(th.status)))
+        return th
+
+    def storage_relay_download(self, tracker_client, store_serv, remote_filename, out_sock,
+                               file_offset=0, download_bytes=0, header=None):
+        '''
+        Download file and send it to out_sock, e.g. socket of a http client, without
+        copying body through user space where os.splice is available.
+        arguments:
+        @out_sock: socket, body is sent to it
+        @header: bytes sent to out_sock before body, or function(content_length)
+                 returning them, can be null. Nothing is sent to out_sock until
+                 storage server accepted the request.
+        @Return dictionary
+            'Remote file_id' : remote_file_id,
+            'Download size'  : download_size,
+            'Storage IP'     : storage_ip
+        '''
+        store_conn = self.pool.get_connection()
+        try:
+            th = self._storage_send_download(store_conn, store_serv, file_offset, download_bytes,
+                                             remote_filename)
+            try:
+                if header is not None:
+                    if callable(header):
+                        header = header(th.pkg_len)
+                    out_sock.sendall(header)
+                total_relay_size = tcp_relay(store_conn, out_sock, th.pkg_len)
+            except Exception:
+                # rest of body is unread, connection can not be reused
+                store_conn.disconnect()
+                raise
+        except ConnectionError:
+            store_conn.disconnect()
+            raise
+        finally:
+            self.pool.release(store_conn)
+        return {
+            'Remote file_id': store_serv.group_name + os.sep + remote_filename,
+            'Download size': appromix(total_relay_size),
+            'Storage IP': store_serv.ip_addr
+        }
+
     def storage_download_to_file(self, tracker_client, store_serv, local_filename, \
-                                 file_offset, download_bytes, remote_filename):
+                                 file_offset, download_bytes, remote_filename, verifier=None,
+                                 on_header=None):
         return self._storage_do_download_file(tracker_client, store_serv, local_filename, \
                                               file_offset, download_bytes, \
-                                              FDFS_DOWNLOAD_TO_FILE, remote_filename)
+                                              FDFS_DOWNLOAD_TO_FILE, remote_filename,
+                                              on_header=on_header, verifier=verifier)
 
     def storage_download_to_buffer(self, tracker_client, store_serv, file_buffer, file_offset, download_bytes,
-                                   remote_filename):
+                                   remote_filename, on_connect=None, on_header=None, verifier=None):
         return self._storage_do_download_file(tracker_client, store_serv, file_buffer, file_offset, download_bytes,
-                                              FDFS_DOWNLOAD_TO_BUFFER, remote_filename)
+                                              FDFS_DOWNLOAD_TO_BUFFER, remote_filename,
+                                              on_connect, on_header, verifier)
+
+    def storage_download_ranges(self, tracker_client, store_serv, remote_filename, ranges, buffer):
+        '''
+        Download ranges of file into one buffer, pipelined on one connection: all
+        requests are sent at once, then responses are received in order, each one
+        straight into its place in buffer.
+        arguments:
+        @ranges: list of (offset, length, buffer_offset), length must not be 0
+        @buffer: writable buffer, e.g. bytearray
+        @Return dictionary
+            'Remote file_id' : remote_file_id,
+            'Download size'  : download_size,
+            'Storage IP'     : storage_ip
+        '''
+        remote_filename_len = len(remote_filename)
+        # down_fmt: |-offset(8)-download_bytes(8)-group_name(16)-remote_filename(len)-|
+        down_fmt = struct.Struct('!Q Q %ds %ds' % (FDFS_GROUP_NAME_MAX_LEN, remote_filename_len))
+        th = Tracker_header()
+        th.pkg_len = down_fmt.size
+        th.cmd = STORAGE_PROTO_CMD_DOWNLOAD_FILE
+        header = th._pack(th.pkg_len, th.cmd, th.status)
+        send_buffer = b''.join(header + down_fmt.pack(offset, length, store_serv.group_name.encode(),
+                                                      remote_filename.encode())
+                               for offset, length, buffer_offset in ranges)
+        view = memoryview(buffer)
+        total_recv_size = 0
+        store_conn = self.pool.get_connection()
+        try:
+            tcp_send_data(store_conn, send_buffer)
+            for offset, length, buffer_offset in ranges:
+                th.recv_header(store_conn)
+                if th.status != 0:
+                    raise DataError('Error: %d %s' % (th.status, os.strerror(th.status)))
+                if th.pkg_len != length:
+                    raise ResponseError('[-] Error: Storage response length is not match, '
+                                        'expect: %d, actual: %d' % (length, th.pkg_len))
+                total_recv_size += tcp_recv_into(store_conn, view[buffer_offset:buffer_offset + length])
+        except FDFSError:
+            # responses of the rest requests are still coming
+            store_conn.disconnect()
+            raise
+        finally:
+            self.pool.release(store_conn)
+        return {
+            'Remote file_id': store_serv.group_name + os.sep + remote_filename,
+            'Download size': appromix(total_recv_size),
+            'Storage IP': store_serv.ip_addr
+        }
 
     def storage_set_metadata(self, tracker_client, store_serv, remote_filename, meta_dict,
                              op_flag=STORAGE_SET_METADATA_FLAG_OVERWRITE):
         ret = 0
+        if isinstance(op_flag, str):
+            op_flag = op_flag.encode()
         conn = self.pool.get_connection()
         remote_filename_len = len(remote_filename)
         meta_buffer = fdfs_pack_metadata(meta_dict)
@@ -443,7 +653,8 @@ class Storage_client(object):
             th.recv_header(conn)
             if th.status != 0:
                 ret = th.status
-        except:
+        except ConnectionError:
+            conn.disconnect()
             raise
         finally:
             self.pool.release(conn)
@@ -470,13 +681,56 @@ class Storage_client(object):
             if th.pkg_len == 0:
                 ret_dict = {}
             meta_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
-        except:
+        except ConnectionError:
+            store_conn.disconnect()
             raise
         finally:
             self.pool.release(store_conn)
         ret_dict = fdfs_unpack_metadata(meta_buffer)
         return ret_dict
 
+    def storage_query_file_info(self, tracker_client, store_serv, remote_filename):
+        '''
+        Query size, create time, crc32 and source ip of file from storage server.
+        @Return dictionary
+            'File size'   : file_size,
+            'Create time' : timestamp,
+            'CRC32'       : crc32,
+            'Source IP'   : source_ip
+        '''
+        store_conn = self.pool.get_connection()
+        th = Tracker_header()
+        remote_filename_len = len(remote_filename)
+        th.pkg_len = FDFS_GROUP_NAME_MAX_LEN + remote_filename_len
+        th.cmd = STORAGE_PROTO_CMD_QUERY_FILE_INFO
+        try:
+            th.send_header(store_conn)
+            # query_fmt: |-group_name(16)-filename(remote_filename_len)-|
+            query_fmt = '!%ds %ds' % (FDFS_GROUP_NAME_MAX_LEN, remote_filename_len)
+            send_buffer = struct.pack(query_fmt, store_serv.group_name.encode(), remote_filename.encode())
+            tcp_send_data(store_conn, send_buffer)
+            th.recv_header(store_conn)
+            if th.status != 0:
+                raise DataError('[-] Error:%d, %s' % (th.status, os.strerror(th.status)))
+            recv_buffer, recv_size = tcp_recv_response(store_conn, th.pkg_len)
+        except ConnectionError:
+            store_conn.disconnect()
+            raise
+        finally:
+            self.pool.release(store_conn)
+        # info_fmt: |-file_size(8)-create_timestamp(8)-crc32(8)-source_ip(16)-|
+        info_fmt = '!Q Q Q %ds' % IP_ADDRESS_SIZE
+        if recv_size != struct.calcsize(info_fmt):
+            raise ResponseError('[-] Error: Storage response length is not match, '
+                                'expect: %d, actual: %d' % (struct.calcsize(info_fmt), recv_size))
+        file_size, timestamp, crc32, source_ip = struct.unpack(info_fmt, recv_buffer)
+        return {
+            'File size': file_size,
+            'Create time': timestamp,
+            'CRC32': crc32,
+            'Source IP': source_ip.strip(b'\x00').decode()
+        }
+
     def _storage_do_append_file(self, tracker_client, store_serv, file_buffer, \
                                 file_size, upload_type, appended_filename):
         store_conn = self.pool.get_connection()
@@ -500,7 +754,8 @@ class Storage_client(object):
             th.recv_header(store_conn)
             if th.status != 0:
                 raise DataError('[-] Error: %d, %s' % (th.status, os.strerror(th.status)))
-        except:
+        except ConnectionError:
+            store_conn.disconnect()
             raise
         finally:
             self.pool.release(store_conn)
@@ -548,7 +803,8 @@ class Storage_client(object):
             th.recv_header(store_conn)
             if th.status != 0:
                 raise DataError('[-] Error: %d, %s' % (th.status, os.strerror(th.status)))
-        except:
+        except ConnectionError:
+            store_conn.disconnect()
             raise
         finally:
             self.pool.release(store_conn)
@@ -565,26 +821,11 @@ class Storage_client(object):
     def _storage_do_modify_file(self, tracker_client, store_serv, upload_type, \
                                 filebuffer, offset, filesize, appender_filename):
         store_conn = self.pool.get_connection()
-        th = Tracker_header()
-        th.cmd = STORAGE_PROTO_CMD_MODIFY_FILE
-        appender_filename_len = len(appender_filename)
-        th.pkg_len = FDFS_PROTO_PKG_LEN_SIZE * 3 + appender_filename_len + filesize
         try:
-            th.send_header(store_conn)
-            # modify_fmt: |-filename_len(8)-offset(8)-filesize(8)-filename(len)-|
-            modify_fmt = '!Q Q Q %ds' % appender_filename_len
-            send_buffer = struct.pack(modify_fmt, appender_filename_len, offset, filesize, appender_filename.encode())
-            tcp_send_data(store_conn, send_buffer)
-            if upload_type == FDFS_UPLOAD_BY_FILENAME:
-                upload_size = tcp_send_file(store_conn, filebuffer)
-            elif upload_type == FDFS_UPLOAD_BY_BUFFER:
-                tcp_send_data(store_conn, filebuffer)
-            elif upload_type == FDFS_UPLOAD_BY_FILE:
-                upload_size = tcp_send_file_ex(store_conn, filebuffer)
-            th.recv_header(store_conn)
-            if th.status != 0:
-                raise DataError('[-] Error: %d, %s' % (th.status, os.strerror(th.status)))
-        except:
+            self._storage_send_modify(store_conn, upload_type, filebuffer, offset,
+                                      filesize, appender_filename)
+        except ConnectionError:
+            store_conn.disconnect()
             raise
         finally:
             self.pool.release(store_conn)
@@ -593,6 +834,58 @@ class Storage_client(object):
         ret_dict['Storage IP'] = store_serv.ip_addr
         return ret_dict
 
+    def _storage_send_modify(self, store_conn, upload_type, filebuffer, offset, filesize,
+                             appender_filename):
+        '''Send one modify request on store_conn and receive its response.'''
+        th = Tracker_header()
+        th.cmd = STORAGE_PROTO_CMD_MODIFY_FILE
+        appender_filename_len = len(appender_filename)
+        th.pkg_len = FDFS_PROTO_PKG_LEN_SIZE * 3 + appender_filename_len + filesize
+        th.send_header(store_conn)
+        # modify_fmt: |-filename_len(8)-offset(8)-filesize(8)-filename(len)-|
+        modify_fmt = '!Q Q Q %ds' % appender_filename_len
+        send_buffer = struct.pack(modify_fmt, appender_filename_len, offset, filesize, appender_filename.encode())
+        tcp_send_data(store_conn, send_buffer)
+        if upload_type == FDFS_UPLOAD_BY_FILENAME:
+            tcp_send_file(store_conn, filebuffer)
+        elif upload_type == FDFS_UPLOAD_BY_BUFFER:
+            tcp_send_data(store_conn, filebuffer)
+        elif upload_type == FDFS_UPLOAD_BY_FILE:
+            tcp_send_file_ex(store_conn, filebuffer)
+        th.recv_header(store_conn)
+        if th.status != 0:
+            raise DataError('[-] Error: %d, %s' % (th.status, os.strerror(th.status)))
+
+    def storage_modify_extents(self, tracker_client, store_serv, extents, appender_filename):
+        '''
+        Modify several extents of appender file, one request after another on one
+        connection.
+        arguments:
+        @extents: iterable of (offset, buffer)
+        @return dictionary {
+            'Status'        : 'Modify successed.',
+            'Modified size' : modified_size,
+            'Storage IP'    : storage_ip
+        }
+        '''
+        modified_size = 0
+        store_conn = self.pool.get_connection()
+        try:
+            for offset, filebuffer in extents:
+                self._storage_send_modify(store_conn, FDFS_UPLOAD_BY_BUFFER, filebuffer, offset,
+                                          len(filebuffer), appender_filename)
+                modified_size += len(filebuffer)
+        except ConnectionError:
+            store_conn.disconnect()
+            raise
+        finally:
+            self.pool.release(store_conn)
+        return {
+            'Status': 'Modify successed.',
+            'Modified size': appromix(modified_size),
+            'Storage IP': store_serv.ip_addr
+        }
+
     def storage_modify_by_filename(self, tracker_client, store_serv, filename, offset, filesize, appender_filename):
         return self._storage_do_modify_file(tracker_client, store_serv, FDFS_UPLOAD_BY_FILENAME, filename, offset,
                                             filesize, appender_filename)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: topology.py
+
+"""Client side view of storage servers in the cluster."""
+
+import json
+import time
+import logging
+import random
+import threading
+from types import MappingProxyType
+from fdfs_client.fdfs_protol import Storage_server
+from fdfs_client.tracker_client import Tracker_client, Group_info, Storage_info, \
+    parse_storage_status
+from fdfs_client.utils import fdfs_atomic_write
+from fdfs_client.exceptions import (
+    FDFSError,
+    ConnectionError,
+    ResponseError,
+    DataError
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Topology_snapshot(object):
+    """
+    Groups and storage servers of the cluster at one time. A snapshot is never
+    changed after it is published, so it is read without locks.
+    groups: {group_name: Group_info}
+    servers: {group_name: {ip_addr: Storage_info}}
+    """
+
+    def __init__(self, groups, servers, refresh_time):
+        self.groups = MappingProxyType(groups)
+        self.servers = MappingProxyType(dict((name, MappingProxyType(group_servers))
+                                             for name, group_servers in servers.items()))
+        self.refresh_time = refresh_time
+
+    def get_servers(self, group_name):
+        '''@return mapping {ip_addr: Storage_info}, None if group is unknown'''
+        return self.servers.get(group_name)
+
+    def get_server(self, group_name, ip_addr):
+        '''@return Storage_info, None if unknown'''
+        group_servers = self.servers.get(group_name)
+        if group_servers is None:
+            return None
+        return group_servers.get(ip_addr)
+
+    def to_dict(self):
+        return {
+            'refresh_time': self.refresh_time,
+            'groups': dict((name, vars(gi)) for name, gi in self.groups.items()),
+            'servers': dict((name, [vars(si) for si in group_servers.values()])
+                            for name, group_servers in self.servers.items())
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        def restore(klass, attrs):
+            obj = klass()
+            obj.__dict__.update(attrs)
+            return obj
+        groups = dict((name, restore(Group_info, attrs))
+                      for name, attrs in state['groups'].items())
+        servers = {}
+        for name, server_list in state['servers'].items():
+            servers[name] = dict((attrs['ip_addr'], restore(Storage_info, attrs))
+                                 for attrs in server_list)
+        return cls(groups, servers, state['refresh_time'])
+
+
+class Topology_service(object):
+    """
+    Background refresh of cluster topology.
+
+    A daemon thread lists all groups and their servers from tracker every interval
+    seconds and publishes a new Topology_snapshot, read by the snapshot attribute.
+    Listeners added by add_listener are called from that thread with
+    (event, group_name, ip_addr, old, new), event is one of:
+        'ADDED'          a server joined, old is None
+        'REMOVED'        a server is no longer listed, new is None
+        'STATUS_CHANGED' status of a server changed, e.g. ACTIVE to OFFLINE
+    old and new are Storage_info. The first refresh reports every server as ADDED,
+    unless a saved snapshot was loaded. With snapshot_filename, each snapshot is saved to
+    disk, and the saved one is loaded at construction, so routing works at once
+    after a cold start, before the first refresh finishes.
+    refresh() may also be called from other threads, e.g. by Stats_sampler, refreshes
+    run one at a time so each change is reported once. Listeners are called within
+    the refresh, they may call refresh_soon but not refresh.
+    """
+
+    def __init__(self, tracker_pool, interval=30, snapshot_filename=None):
+        '''
+        arguments:
+        @tracker_pool: ConnectionPool of tracker servers
+        @interval: int, seconds between refreshes
+        @snapshot_filename: string, file to persist snapshot, can be null
+        '''
+        self.tracker_pool = tracker_pool
+        self.interval = interval
+        self.snapshot_filename = snapshot_filename
+        self.snapshot = Topology_snapshot({}, {}, 0)
+        self._listeners = []
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        if snapshot_filename:
+            self._load_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_filename, 'rb') as f:
+                self.snapshot = Topology_snapshot.from_dict(json.loads(f.read().decode()))
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    def add_listener(self, callback):
+        '''Add callback(event, group_name, ip_addr, old, new) of server changes.'''
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def refresh(self):
+        '''
+        List groups and servers from tracker, publish new snapshot and call listeners.
+        @return Topology_snapshot
+        '''
+        with self._refresh_lock:
+            tc = Tracker_client(self.tracker_pool)
+            groups = {}
+            servers = {}
+            for gi in tc.tracker_list_all_groups()['Groups']:
+                groups[gi.group_name] = gi
+                servers[gi.group_name] = dict((si.ip_addr, si) for si in
+                                              tc.tracker_list_servers(gi.group_name)['Servers'])
+            old, new = self.snapshot, Topology_snapshot(groups, servers, time.time())
+            self.snapshot = new
+            if self.snapshot_filename:
+                try:
+                    fdfs_atomic_write(self.snapshot_filename, json.dumps(new.to_dict()).encode())
+                except (IOError, OSError, TypeError, ValueError) as e:
+                    logger.warning('saving topology snapshot to %s failed: %s',
+                                   self.snapshot_filename, e)
+            self._notify(old, new)
+            return new
+
+    def _notify(self, old, new):
+        events = []
+        for name in set(old.servers) | set(new.servers):
+            old_servers = old.servers.get(name, {})
+            new_servers = new.servers.get(name, {})
+            for ip_addr in set(old_servers) | set(new_servers):
+                old_si, new_si = old_servers.get(ip_addr), new_servers.get(ip_addr)
+                if old_si is None:
+                    events.append(('ADDED', name, ip_addr, None, new_si))
+                elif new_si is None:
+                    events.append(('REMOVED', name, ip_addr, old_si, None))
+                elif old_si.status != new_si.status:
+                    events.append(('STATUS_CHANGED', name, ip_addr, old_si, new_si))
+        for event in events:
+            for callback in list(self._listeners):
+                try:
+                    callback(*event)
+                except Exception:
+                    pass
+
+    def refresh_soon(self):
+        '''Wake background thread to refresh now, e.g. after a server failed.'''
+        self._wakeup.set()
+
+    def start(self):
+        '''Start background refresh thread, it refreshes at once.'''
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='fdfs-topology')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop background refresh thread.'''
+        self._stopped.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # the thread must outlive any failure, or routing keeps a stale snapshot
+            try:
+                self.refresh()
+            except (FDFSError, OSError) as e:
+                logger.debug('topology refresh failed: %s', e)
+            except Exception:
+                logger.exception('topology refresh failed')
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+
+class Cluster_topology(object):
+    """
+    Cache of storage servers of each group, listed by tracker_list_servers.
+
+    A group is listed again from tracker when its entry is older than ttl
+    seconds, or after a server of it is marked failed.
+    With a Topology_service, servers are read from its snapshot instead, and a
+    failed server makes the service refresh soon.
+    """
+
+    def __init__(self, tracker_pool, ttl=60, service=None):
+        '''
+        arguments:
+        @tracker_pool: ConnectionPool of tracker servers
+        @ttl: int, seconds a listed group is trusted
+        @service: Topology_service, can be null
+        '''
+        self.tracker_pool = tracker_pool
+        self.ttl = ttl
+        self.service = service
+        # group_name -> (list time, {ip_addr: Storage_info})
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def refresh_group(self, group_name):
+        '''
+        List storage servers of group from tracker.
+        @return dictionary {ip_addr: Storage_info}
+        '''
+        tc = Tracker_client(self.tracker_pool)
+        ret_dict = tc.tracker_list_servers(group_name)
+        servers = dict((si.ip_addr, si) for si in ret_dict['Servers'])
+        with self._lock:
+            self._groups[group_name] = (time.time(), servers)
+        return servers
+
+    def get_servers(self, group_name):
+        '''@return dictionary {ip_addr: Storage_info} of group'''
+        if self.service is not None:
+            servers = self.service.snapshot.get_servers(group_name)
+            if servers is not None:
+                return servers
+        entry = self._groups.get(group_name)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return self.refresh_group(group_name)
+        return entry[1]
+
+    def get_server(self, group_name, ip_addr):
+        '''@return Storage_info, None if server is not in group'''
+        try:
+            return self.get_servers(group_name).get(ip_addr)
+        except (ConnectionError, ResponseError, DataError):
+            return None
+
+    def get_active_server(self, group_name, ip_addr):
+        '''@return Storage_info, None if server is not in group or not ACTIVE'''
+        si = self.get_server(group_name, ip_addr)
+        if si is None or parse_storage_status(si.status) != 'ACTIVE':
+            return None
+        return si
+
+    def mark_failed(self, group_name, ip_addr):
+        '''Forget listed servers of group, after a server of it failed.'''
+        if self.service is not None:
+            self.service.refresh_soon()
+        with self._lock:
+            self._groups.pop(group_name, None)
+
+
+class Upload_scheduler(object):
+    """
+    Choose group, storage server and store path for upload locally, from a cached
+    view of group and server capacity, without query tracker server per upload.
+
+    The view is listed again by tracker_list_all_groups and tracker_list_servers
+    once it is older than refresh_interval seconds. A group is chosen weighted by
+    its free space, then a server among ACTIVE ones of best upload priority (the
+    smaller upload_prio, the higher), weighted by its free space. The server's
+    current write path is used as store_path_index.
+    choose() returns None when the view is older than max_age, or has no server
+    with more than min_free_mb free space, then caller should query tracker.
+    With a Topology_service, the view is taken from its snapshot instead of listed.
+    """
+
+    def __init__(self, tracker_pool, refresh_interval=30, max_age=120, min_free_mb=1024,
+                 service=None):
+        '''
+        arguments:
+        @tracker_pool: ConnectionPool of tracker servers
+        @refresh_interval: int, seconds between listing groups and servers
+        @max_age: int, seconds the view is trusted if it can not be listed
+        @min_free_mb: long, servers with less free space are not chosen
+        @service: Topology_service, can be null
+        '''
+        self.tracker_pool = tracker_pool
+        self.service = service
+        self._snapshot = None
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.min_free_mb = min_free_mb
+        # group_name -> (Group_info, [Storage_info of ACTIVE servers])
+        self._groups = {}
+        self._refresh_time = 0
+        self._next_refresh = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''List all groups and their servers from tracker.'''
+        tc = Tracker_client(self.tracker_pool)
+        groups = {}
+        for gi in tc.tracker_list_all_groups()['Groups']:
+            servers = tc.tracker_list_servers(gi.group_name)['Servers']
+            active = [si for si in servers if parse_storage_status(si.status) == 'ACTIVE']
+            groups[gi.group_name] = (gi, active)
+        with self._lock:
+            self._groups = groups
+            self._refresh_time = time.time()
+
+    def _use_snapshot(self, snapshot):
+        groups = {}
+        for name, gi in snapshot.groups.items():
+            servers = snapshot.get_servers(name) or {}
+            active = [si for si in servers.values() if parse_storage_status(si.status) == 'ACTIVE']
+            groups[name] = (gi, active)
+        with self._lock:
+            self._groups = groups
+            self._refresh_time = snapshot.refresh_time
+            self._snapshot = snapshot
+
+    def _maybe_refresh(self):
+        if self.service is not None:
+            snapshot = self.service.snapshot
+            if snapshot is not self._snapshot:
+                self._use_snapshot(snapshot)
+            return
+        # only one caller refreshes, and a failed refresh is not retried at once
+        with self._lock:
+            now = time.time()
+            if now < self._next_refresh:
+                return
+            self._next_refresh = now + self.refresh_interval
+        try:
+            self.refresh()
+        except (ConnectionError, ResponseError, DataError):
+            pass
+
+    def _weighted_choice(self, items, weight):
+        total = sum(weight(item) for item in items)
+        point = random.uniform(0, total)
+        for item in items:
+            point -= weight(item)
+            if point <= 0:
+                return item
+        return items[-1]
+
+    def choose(self, group_name=None):
+        '''
+        Choose storage server for upload.
+        arguments:
+        @group_name: string, upload to this group, can be null
+        @return Storage_server object, None if view is stale or no server fits
+        '''
+        self._maybe_refresh()
+        with self._lock:
+            if time.time() - self._refresh_time > self.max_age:
+                return None
+            groups = self._groups
+        candidates = []
+        for name, (gi, active) in groups.items():
+            if group_name and name != group_name:
+                continue
+            fit = [si for si in active if si.free_mb > self.min_free_mb]
+            if fit:
+                candidates.append((gi, fit))
+        if not candidates:
+            return None
+        gi, fit = self._weighted_choice(candidates, lambda c: c[0].free_mb)
+        best_prio = min(si.upload_prio for si in fit)
+        fit = [si for si in fit if si.upload_prio == best_prio]
+        si = self._weighted_choice(fit, lambda si: si.free_mb)
+        store_serv = Storage_server()
+        store_serv.ip_addr = si.ip_addr
+        store_serv.port = si.storage_port
+        store_serv.group_name = gi.group_name
+        store_serv.store_path_index = si.curr_write_path
+        return store_serv
+
+    def mark_failed(self, store_serv):
+        '''Drop server from view after an upload to it failed.'''
+        if self.service is not None:
+            self.service.refresh_soon()
+        with self._lock:
+            entry = self._groups.get(store_serv.group_name)
+            if entry is None:
+                return
+            gi, active = entry
+            active = [si for si in active if si.ip_addr != store_serv.ip_addr]
+            groups = dict(self._groups)
+            groups[store_serv.group_name] = (gi, active)
+            self._groups = groups
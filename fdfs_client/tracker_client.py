@@ -45,6 +45,8 @@ class Storage_info(object):
         self.version = ''
         self.totalMB = ''
         self.freeMB = ''
+        self.total_mb = 0
+        self.free_mb = 0
         self.upload_prio = 0
         self.join_time = datetime.fromtimestamp(0).isoformat()
         self.up_time = datetime.fromtimestamp(0).isoformat()
@@ -110,7 +112,7 @@ class Storage_info(object):
          self.total_truncate_count, self.success_truncate_count, self.total_setmeta_count, self.success_setmeta_count,
          self.total_del_count, self.success_del_count, self.total_download_count, self.success_download_count, self.total_getmeta_count, self.success_getmeta_count,
          self.total_create_link_count, self.success_create_link_count, self.total_del_link_count, self.success_del_link_count,
-         self.total_upload_bytes, self.success_upload_bytes, self.total_append_bytes, self.total_append_bytes, self.total_modify_bytes, self.success_modify_bytes,
+         self.total_upload_bytes, self.success_upload_bytes, self.total_append_bytes, self.success_append_bytes, self.total_modify_bytes, self.success_modify_bytes,
          self.total_download_bytes, self.success_download_bytes, self.total_sync_in_bytes, self.success_sync_in_bytes,
          self.total_sync_out_bytes, self.success_sync_out_bytes, self.total_file_open_count, self.success_file_open_count,
          self.total_file_read_count, self.success_file_read_count, self.total_file_write_count, self.success_file_write_count,
@@ -124,6 +126,8 @@ class Storage_info(object):
             self.src_ip_addr = src_ip_addr.strip(b'\x00').decode()
             self.totalMB = appromix(totalMB, FDFS_SPACE_SIZE_BASE_INDEX)
             self.freeMB = appromix(freeMB, FDFS_SPACE_SIZE_BASE_INDEX)
+            self.total_mb = totalMB
+            self.free_mb = freeMB
         except ValueError as e:
             raise ResponseError('[-] Error: disk space overrun, can not represented it.')
         self.join_time = datetime.fromtimestamp(join_time).isoformat()
@@ -209,6 +213,9 @@ class Group_info(object):
         self.totalMB = ''
         self.freeMB = ''
         self.trunk_freeMB = ''
+        self.total_mb = 0
+        self.free_mb = 0
+        self.trunk_free_mb = 0
         self.count = 0
         self.storage_port = 0
         self.store_http_port = 0
@@ -247,6 +254,9 @@ class Group_info(object):
             self.totalMB = appromix(totalMB, FDFS_SPACE_SIZE_BASE_INDEX)
             self.freeMB = appromix(freeMB, FDFS_SPACE_SIZE_BASE_INDEX)
             self.trunk_freeMB = appromix(trunk_freeMB, FDFS_SPACE_SIZE_BASE_INDEX)
+            self.total_mb = totalMB
+            self.free_mb = freeMB
+            self.trunk_free_mb = trunk_freeMB
         except ValueError:
             raise DataError('[-] Error disk space overrun, can not represented it.')
 
@@ -264,6 +274,10 @@ class Tracker_client(object):
         """
         List servers in a storage group
         """
+        if isinstance(group_name, str):
+            group_name = group_name.encode()
+        if isinstance(storage_ip, str):
+            storage_ip = storage_ip.encode()
         conn = self.pool.get_connection()
         th = Tracker_header()
         ip_len = len(storage_ip) if storage_ip else 0
@@ -272,7 +286,7 @@ class Tracker_client(object):
         th.pkg_len = FDFS_GROUP_NAME_MAX_LEN + ip_len
         th.cmd = TRACKER_PROTO_CMD_SERVER_LIST_STORAGE
         group_fmt = '!%ds' % FDFS_GROUP_NAME_MAX_LEN
-        store_ip_addr = storage_ip or ''
+        store_ip_addr = storage_ip or b''
         storage_ip_fmt = '!%ds' % ip_len
         try:
             th.send_header(conn)
@@ -295,7 +309,7 @@ class Tracker_client(object):
             raise
         finally:
             self.pool.release(conn)
-        num_storage = recv_size / si_fmt_size
+        num_storage = recv_size // si_fmt_size
         si_list = []
         i = 0
         while num_storage:
@@ -305,7 +319,7 @@ class Tracker_client(object):
             num_storage -= 1
             i += 1
         ret_dict = {}
-        ret_dict['Group name'] = group_name
+        ret_dict['Group name'] = group_name.decode()
         ret_dict['Servers'] = si_list
         return ret_dict
 
@@ -354,7 +368,7 @@ class Tracker_client(object):
             errmsg = '[-] Error: Response size is mismatch, except: %d, actul: %d' \
                      % (th.pkg_len, recv_size)
             raise ResponseError(errmsg)
-        num_groups = recv_size / gi_fmt_size
+        num_groups = recv_size // gi_fmt_size
         ret_dict = {}
         ret_dict['Groups count'] = num_groups
         gi_list = []
@@ -405,6 +419,8 @@ class Tracker_client(object):
         @group_name: string
         @Return Storage_server object
         """
+        if isinstance(group_name, str):
+            group_name = group_name.encode()
         conn = self.pool.get_connection()
         th = Tracker_header()
         th.cmd = TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITH_GROUP_ONE
@@ -489,3 +505,51 @@ class Tracker_client(object):
         Query storage server to download.
         """
         return self._tracker_do_query_storage(group_name, filename, TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE)
+
+    def tracker_query_storage_fetch_all(self, group_name, filename):
+        """
+        Query all storage servers which can download the file.
+        arguments:
+        @group_name: string
+        @filename: string, remote file name
+        @Return: list of Storage_server objects
+        """
+        conn = self.pool.get_connection()
+        th = Tracker_header()
+        file_name_len = len(filename)
+        th.pkg_len = FDFS_GROUP_NAME_MAX_LEN + file_name_len
+        th.cmd = TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL
+        # query_fmt: |-group_name(16)-filename(file_name_len)-|
+        query_fmt = '!%ds %ds' % (FDFS_GROUP_NAME_MAX_LEN, file_name_len)
+        send_buffer = struct.pack(query_fmt, group_name.encode(), filename.encode())
+        try:
+            th.send_header(conn)
+            tcp_send_data(conn, send_buffer)
+            th.recv_header(conn)
+            if th.status != 0:
+                raise DataError('Error: %d, %s' % (th.status, os.strerror(th.status)))
+            recv_buffer, recv_size = tcp_recv_response(conn, th.pkg_len)
+            if recv_size < TRACKER_QUERY_STORAGE_FETCH_BODY_LEN or \
+                    (recv_size - TRACKER_QUERY_STORAGE_FETCH_BODY_LEN) % (IP_ADDRESS_SIZE - 1) != 0:
+                errmsg = '[-] Error: Tracker response length is invaild, '
+                errmsg += 'expect: %d, actual: %d' % (th.pkg_len, recv_size)
+                raise ResponseError(errmsg)
+        except ConnectionError:
+            conn.disconnect()
+            raise
+        finally:
+            self.pool.release(conn)
+        # recv_fmt: |-group_name(16)-ip_addr(16-1)-port(8)-[ip_addr(16-1)]...-|
+        recv_fmt = '!%ds %ds Q' % (FDFS_GROUP_NAME_MAX_LEN, IP_ADDRESS_SIZE - 1)
+        (group, ipaddr, port) = struct.unpack(recv_fmt, recv_buffer[:TRACKER_QUERY_STORAGE_FETCH_BODY_LEN])
+        ip_list = [ipaddr]
+        for i in range(TRACKER_QUERY_STORAGE_FETCH_BODY_LEN, recv_size, IP_ADDRESS_SIZE - 1):
+            ip_list.append(recv_buffer[i:i + IP_ADDRESS_SIZE - 1])
+        store_servs = []
+        for ipaddr in ip_list:
+            store_serv = Storage_server()
+            store_serv.group_name = group.strip(b'\x00').decode()
+            store_serv.ip_addr = ipaddr.strip(b'\x00').decode()
+            store_serv.port = port
+            store_servs.append(store_serv)
+        return store_servs
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: uploader.py
+
+"""Write-behind upload queue, uploads run on worker threads."""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from fdfs_client.deadline import Deadline, current_deadline, backoff_sleep
+from fdfs_client.exceptions import ConnectionError, DataError, DeadlineExceeded, QueueFullError
+
+
+class Upload_queue(object):
+    """
+    Write-behind uploader. submit() queues a buffer and returns a Future at once,
+    worker threads upload it by upload_by_buffer, retrying uploads failed by a
+    ConnectionError with backoff, other errors fail the future at once. Bytes of queued and running uploads are limited by max_inflight_bytes,
+    beyond it submit() blocks, or raises QueueFullError if block is False or
+    timeout expires. A buffer larger than the budget is admitted only when
+    nothing else is in flight. A submit within a Deadline block bounds its upload,
+    retries and backoff included, by that deadline.
+    """
+
+    def __init__(self, client, workers=4, max_inflight_bytes=64 * 1024 * 1024, block=True,
+                 timeout=None, retries=3, backoff=0.5, max_backoff=10):
+        '''
+        arguments:
+        @client: Fdfs_client
+        @workers: int, count of worker threads
+        @max_inflight_bytes: long, budget of queued and running uploads
+        @block: bool, wait for budget in submit, else raise QueueFullError
+        @timeout: float, max seconds submit waits for budget, null for no limit
+        @retries: int, retries of an upload failed by a ConnectionError
+        @backoff: float, seconds before first retry, doubled each time
+        @max_backoff: float, seconds
+        '''
+        self.client = client
+        self.max_inflight_bytes = max_inflight_bytes
+        self.block = block
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.inflight_bytes = 0
+        self.pending = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='fdfs-upload-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, filebuffer, file_ext_name=None, meta_dict=None):
+        '''
+        Queue a buffer for upload.
+        @return Future, its result is the dictionary returned by upload_by_buffer
+        '''
+        if not filebuffer:
+            raise DataError('[-] Error: argument filebuffer can not be null.')
+        size = len(filebuffer)
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise DataError('[-] Error: upload queue is closed.')
+                if not self.inflight_bytes or self.inflight_bytes + size <= self.max_inflight_bytes:
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if not self.block or (remaining is not None and remaining <= 0):
+                    raise QueueFullError('[-] Error: upload queue is full, %d bytes in flight.'
+                                         % self.inflight_bytes)
+                self._cond.wait(remaining)
+            future = Future()
+            self.inflight_bytes += size
+            self.pending += 1
+            self._items.append((future, filebuffer, file_ext_name, meta_dict, current_deadline()))
+            self._cond.notify_all()
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+                if not self._items:
+                    return
+                future, filebuffer, file_ext_name, meta_dict, expires = self._items.popleft()
+            try:
+                if future.set_running_or_notify_cancel():
+                    with Deadline(expires=expires):
+                        self._upload(future, filebuffer, file_ext_name, meta_dict)
+            finally:
+                with self._cond:
+                    self.inflight_bytes -= len(filebuffer)
+                    self.pending -= 1
+                    self._cond.notify_all()
+
+    def _upload(self, future, filebuffer, file_ext_name, meta_dict):
+        failures = 0
+        while True:
+            try:
+                future.set_result(self.client.upload_by_buffer(filebuffer, file_ext_name,
+                                                               meta_dict))
+                return
+            except DeadlineExceeded as e:
+                future.set_exception(e)
+                return
+            except ConnectionError as e:
+                # only a broken connection is worth a retry, a rejected request fails again
+                failures += 1
+                if failures > self.retries:
+                    future.set_exception(e)
+                    return
+            except Exception as e:
+                future.set_exception(e)
+                return
+            try:
+                backoff_sleep(min(self.max_backoff, self.backoff * 2 ** (failures - 1)))
+            except DeadlineExceeded as e:
+                future.set_exception(e)
+                return
+
+    def flush(self, timeout=None):
+        '''
+        Wait until all submitted uploads are done.
+        @return bool, False if timeout expired first
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, wait=True):
+        '''
+        Stop accepting uploads, and stop workers once queue is empty.
+        arguments:
+        @wait: bool, wait for queued uploads, else they are cancelled
+        '''
+        with self._cond:
+            self._closed = True
+            if not wait:
+                for item in self._items:
+                    item[0].cancel()
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,13 +1,34 @@
 #!/usr/bin/env python
 # -*- coding = utf-8 -*-
 # filename: utils.py
-from configparser import DEFAULTSECT, MissingSectionHeaderError, ParsingError, RawConfigParser, \
-    NoSectionError
 import os
 import stat
-from mutagen._compat import StringIO
+import base64
+import socket
+import struct
+import tempfile
+import zlib
+from datetime import datetime
+from fdfs_client.exceptions import DataError, IntegrityError
+from fdfs_client.fdfs_protol import (
+    FDFS_LOGIC_FILE_PATH_LEN,
+    FDFS_FILENAME_BASE64_LENGTH,
+    FDFS_TRUNK_FILE_INFO_LEN,
+    FDFS_NORMAL_LOGIC_FILENAME_LENGTH,
+    FDFS_TRUNK_LOGIC_FILENAME_LENGTH,
+    FDFS_APPENDER_FILE_SIZE,
+    FDFS_TRUNK_FILE_MARK_SIZE,
+    FDFS_MAX_SERVER_ID
+)
+
+
+def __getattr__(name):
+    # the config parser is only needed while loading client.conf, import it on use
+    if name == 'Fdfs_ConfigParser':
+        from fdfs_client.config import Fdfs_ConfigParser
+        return Fdfs_ConfigParser
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-from requests.compat import basestring
 
 SUFFIX = ['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
 
@@ -45,183 +66,257 @@ def get_file_ext_name(filename, double_ext=True):
     return li[-1]
 
 
-class Fdfs_ConfigParser(RawConfigParser):
-    """ 
-    Extends ConfigParser to allow files without sections. 
- 
-    This is done by wrapping read files and prepending them with a placeholder 
-    section, which defaults to '__config__' 
+def split_remote_fileid(remote_file_id):
     """
+    Splite remote_file_id to (group_name, remote_file_name)
+    arguments:
+    @remote_file_id: string
+    @return tuple, (group_name, remote_file_name)
+    """
+    index = remote_file_id.find('/')
+    if -1 == index:
+        return None
+    return remote_file_id[0:index], remote_file_id[(index + 1):]
 
-    def __init__(self, default_section=None, *args, **kwargs):
-        RawConfigParser.__init__(self, *args, **kwargs)
-
-        self._default_section = None
-        self.set_default_section(default_section or '__config__')
-
-    def get_default_section(self):
-        return self._default_section
 
-    def set_default_section(self, section):
-        self.add_section(section)
+class FileId(object):
+    """
+    Decode remote file id locally, without query tracker or storage server.
+
+    remote_file_id: |-group_name-/-Mxx/xx/xx/-base64(27)-[trunk_info(16)]-[prefix]-[.ext]-|
+        Mxx is store path index in hex, then two levels of sub directory.
+        base64 is encoded from |-source_ip(4)-timestamp(4)-file_size(8)-crc32(4)-|
+        with use_storage_id on, source_ip is the numeric id of the source server
+        instead, it is then decoded to source_id and source_ip_addr is ''.
+        trunk_info is encoded from |-trunk_id(4)-offset(4)-alloc_size(4)-|
+    file_size and crc32 of appender and slave file are not encoded in file name,
+    they are None.
+    It can be unpacked as split_remote_fileid: group_name, remote_filename = FileId(id)
+    """
 
-        # move all values from the previous default section to the new one 
+    def __init__(self, remote_file_id):
+        tmp = split_remote_fileid(remote_file_id)
+        if not tmp:
+            raise DataError('[-] Error: remote_file_id is invalid.(%s)' % remote_file_id)
+        self.remote_file_id = remote_file_id
+        self.group_name, self.remote_filename = tmp
+        self.store_path = ''
+        self.store_path_index = 0
+        self.source_ip_addr = ''
+        self.source_id = ''
+        self.timestamp = 0
+        self.create_time = datetime.fromtimestamp(0).isoformat()
+        self.file_size = None
+        self.crc32 = None
+        self.is_appender = False
+        self.is_trunk = False
+        self.is_slave = False
+        self.trunk_id = 0
+        self.trunk_offset = 0
+        self.trunk_alloc_size = 0
+        self.ext_name = ''
+        self._decode()
+
+    def _decode(self):
+        name = self.remote_filename
+        path = name[0:FDFS_LOGIC_FILE_PATH_LEN]
+        # path: |-Mxx/xx/xx/-|
+        if len(path) != FDFS_LOGIC_FILE_PATH_LEN or path[0] != 'M' or \
+                path[3::3] != '///':
+            raise DataError('[-] Error: remote_file_id is invalid.(%s)' % self.remote_file_id)
         try:
-            default_section_items = self.items(self._default_section)
-            self.remove_section(self._default_section)
-        except NoSectionError:
-            pass
+            self.store_path_index = int(path[1:3], 16)
+            int(path[4:6], 16), int(path[7:9], 16)
+        except ValueError:
+            raise DataError('[-] Error: remote_file_id is invalid.(%s)' % self.remote_file_id)
+        self.store_path = path[0:3]
+        begin = FDFS_LOGIC_FILE_PATH_LEN
+        buff = self._b64decode(name, begin, FDFS_FILENAME_BASE64_LENGTH)
+        # buff: |-ip_addr(4)-timestamp(4)-file_size(8)-crc32(4)-|
+        ip_addr, self.timestamp, file_size, crc32 = struct.unpack('!4s I Q I', buff)
+        source = struct.unpack('!I', ip_addr)[0]
+        if source <= FDFS_MAX_SERVER_ID:
+            self.source_id = str(source)
         else:
-            for (key, value) in default_section_items:
-                self.set(section, key, value)
+            self.source_ip_addr = socket.inet_ntoa(ip_addr)
+        self.create_time = datetime.fromtimestamp(self.timestamp).isoformat()
+        if file_size >> 63:
+            # normal file, high 32 bits is random mask
+            file_size &= 0xFFFFFFFF
+        elif file_size & FDFS_APPENDER_FILE_SIZE:
+            self.is_appender = True
+        elif file_size & FDFS_TRUNK_FILE_MARK_SIZE:
+            self.is_trunk = True
+            file_size &= 0xFFFFFFFF
+        name_len = len(name)
+        self.is_slave = name_len > FDFS_TRUNK_LOGIC_FILENAME_LENGTH or \
+                        (name_len > FDFS_NORMAL_LOGIC_FILENAME_LENGTH and not self.is_trunk)
+        begin += FDFS_FILENAME_BASE64_LENGTH
+        if self.is_trunk:
+            trunk_buff = self._b64decode(name, begin, FDFS_TRUNK_FILE_INFO_LEN)
+            (self.trunk_id, self.trunk_offset, self.trunk_alloc_size) = \
+                struct.unpack('!I I I', trunk_buff)
+            begin += FDFS_TRUNK_FILE_INFO_LEN
+        index = name.rfind('.', begin)
+        if index != -1:
+            self.ext_name = name[index + 1:]
+        if not self.is_appender and not self.is_slave:
+            self.file_size = file_size
+            self.crc32 = crc32
+
+    def _b64decode(self, name, begin, length):
+        # fdfs base64 uses '-' and '_' for 62 and 63, without padding
+        encoded = name[begin:begin + length]
+        try:
+            buff = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+        except (TypeError, ValueError):
+            buff = b''
+        # characters out of the alphabet are discarded, check what is left
+        if len(encoded) != length or len(buff) != length * 3 // 4:
+            raise DataError('[-] Error: remote_file_id is invalid.(%s)' % self.remote_file_id)
+        return buff
 
-        self._default_section = section
+    def __iter__(self):
+        return iter((self.group_name, self.remote_filename))
 
-    def read(self, filenames):
-        if isinstance(filenames, basestring):
-            filenames = [filenames]
+    def __str__(self):
+        return self.remote_file_id
 
-        read_ok = []
-        for filename in filenames:
-            try:
-                with open(filename) as fp:
-                    self.readfp(fp)
-            except IOError as e:
-                continue
-            else:
-                read_ok.append(filename)
+    def __repr__(self):
+        return 'FileId(%r)' % self.remote_file_id
 
-        return read_ok
 
-    def readfp(self, fp, *args, **kwargs):
-        stream = StringIO()
+def parse_remote_fileid(remote_file_id):
+    """
+    Decode remote_file_id to FileId.
+    arguments:
+    @remote_file_id: string
+    @return FileId, None if remote_file_id is invalid
+    """
+    try:
+        return FileId(remote_file_id)
+    except DataError:
+        return None
 
-        try:
-            stream.name = fp.name
-        except AttributeError as e:
-            pass
 
-        stream.write('[' + self._default_section + ']\n')
-        stream.write(fp.read())
-        stream.seek(0, 0)
+class Crc32_verifier(object):
+    """
+    Streaming check of downloaded content, against CRC32 and size encoded in
+    remote file id. Call update() on each received chunk and verify() at end.
+    """
 
-        return self._read(stream, stream.name)
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.crc32 = 0
+        self.size = 0
 
-    def write(self, fp):
-        # Write the items from the default section manually and then remove them 
-        # from the data. They'll be re-added later. 
-        try:
-            default_section_items = self.items(self._default_section)
-            self.remove_section(self._default_section)
+    def update(self, data):
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.size += len(data)
 
-            for (key, value) in default_section_items:
-                fp.write("{0} = {1}\n".format(key, value))
+    def verify(self, ip_addr=None):
+        '''Raise IntegrityError if content does not match file id.'''
+        if self.size != self.file_id.file_size or self.crc32 != self.file_id.crc32:
+            raise IntegrityError('[-] Error: downloaded %s from %s is corrupt, '
+                                 'expect size %d crc32 %08x, actual size %d crc32 %08x.'
+                                 % (self.file_id, ip_addr, self.file_id.file_size,
+                                    self.file_id.crc32, self.size, self.crc32))
 
-            fp.write("\n")
-        except NoSectionError:
-            pass
 
-        RawConfigParser.write(self, fp)
-
-        self.add_section(self._default_section)
-        for (key, value) in default_section_items:
-            self.set(self._default_section, key, value)
-
-    def _read(self, fp, fpname):
-        """Parse a sectioned setup file.
-
-        The sections in setup file contains a title line at the top,
-        indicated by a name in square brackets (`[]'), plus key/value
-        options lines, indicated by `name: value' format lines.
-        Continuations are represented by an embedded newline then
-        leading whitespace.  Blank lines, lines beginning with a '#',
-        and just about everything else are ignored.
-        """
-        cursect = None  # None, or a dictionary
-        optname = None
-        lineno = 0
-        e = None  # None, or an exception
-        while True:
-            line = fp.readline()
-            if not line:
-                break
-            lineno += 1
-            # comment or blank line?
-            if line.strip() == '' or line[0] in '#;':
-                continue
-            if line.split(None, 1)[0].lower() == 'rem' and line[0] in "rR":
-                # no leading whitespace
-                continue
-            # continuation line?
-            if line[0].isspace() and cursect is not None and optname:
-                value = line.strip()
-                if value:
-                    cursect[optname] = "%s\n%s" % (cursect[optname], value)
-            # a section header or option header?
-            else:
-                # is it a section header?
-                mo = self.SECTCRE.match(line)
-                if mo:
-                    sectname = mo.group('header')
-                    if sectname in self._sections:
-                        cursect = self._sections[sectname]
-                    elif sectname == DEFAULTSECT:
-                        cursect = self._defaults
-                    else:
-                        cursect = self._dict()
-                        cursect['__name__'] = sectname
-                        self._sections[sectname] = cursect
-                    # So sections can't start with a continuation line
-                    optname = None
-                # no section header in the file?
-                elif cursect is None:
-                    raise MissingSectionHeaderError(fpname, lineno, line)
-                # an option line?
-                else:
-                    mo = self.OPTCRE.match(line)
-                    if mo:
-                        optname, vi, optval = mo.group('option', 'vi', 'value')
-                        if vi in ('=', ':') and ';' in optval:
-                            # ';' is a comment delimiter only if it follows
-                            # a spacing character
-                            pos = optval.find(';')
-                            if pos != -1 and optval[pos - 1].isspace():
-                                optval = optval[:pos]
-                        optval = optval.strip()
-                        # allow empty values
-                        if optval == '""':
-                            optval = ''
-                        optname = self.optionxform(optname.rstrip())
-                        if cursect.get(optname):
-                            if not isinstance(cursect[optname], list):
-                                cursect[optname] = [cursect[optname]]
-                            cursect[optname].append(optval)
-                        else:
-                            cursect[optname] = optval
-                    else:
-                        # a non-fatal parsing error occurred.  set up the
-                        # exception but keep going. the exception will be
-                        # raised at the end of the file and will contain a
-                        # list of all bogus lines
-                        if not e:
-                            e = ParsingError(fpname)
-                        e.append(lineno, repr(line))
-        # if any parsing errors occurred, raise an exception
-        if e:
-            raise e
+def fdfs_crc32_verifier(remote_file_id):
+    """
+    Create Crc32_verifier of whole content of remote_file_id.
+    arguments:
+    @remote_file_id: string
+    @return Crc32_verifier, None if CRC32 is not encoded in file id, as appender
+            and slave file
+    """
+    file_id = parse_remote_fileid(remote_file_id)
+    if file_id is None or file_id.crc32 is None:
+        return None
+    return Crc32_verifier(file_id)
 
 
-def split_remote_fileid(remote_file_id):
+def fdfs_file_crc32(filename, size, buffer_size=1024 * 1024):
     """
-    Splite remote_file_id to (group_name, remote_file_name)
+    CRC32 of first size bytes of local file.
+    arguments:
+    @filename: string
+    @size: long
+    @return int, None if file is shorter than size
+    """
+    crc32 = 0
+    with open(filename, 'rb') as f:
+        while size > 0:
+            data = f.read(min(buffer_size, size))
+            if not data:
+                return None
+            crc32 = zlib.crc32(data, crc32)
+            size -= len(data)
+    return crc32
+
+
+def fdfs_is_appender_fileid(remote_file_id):
+    """
+    Check the appender flag encoded in remote file name.
+    Appender files are mutable, so they must not be cached by file id.
     arguments:
     @remote_file_id: string
-    @return tuple, (group_name, remote_file_name)
+    @return bool, True if appender file or file id can not be decoded
     """
-    index = remote_file_id.find('/')
-    if -1 == index:
-        return None
-    return remote_file_id[0:index], remote_file_id[(index + 1):]
+    file_id = parse_remote_fileid(remote_file_id)
+    return file_id is None or file_id.is_appender
+
+
+def fdfs_coalesce_ranges(ranges, gap=0, max_size=None):
+    """
+    Merge byte ranges that overlap, or are apart by at most gap bytes, so one
+    request reads them all.
+    arguments:
+    @ranges: list of (offset, length)
+    @gap: int, max bytes between two ranges read by one request
+    @max_size: int, max size of a merged range, null for no limit
+    @return list of (offset, length, indices of ranges within it), by offset
+    """
+    merged = []
+    for index in sorted(range(len(ranges)), key=lambda i: ranges[i][0]):
+        offset, length = ranges[index]
+        if offset < 0 or length < 0:
+            raise DataError('[-] Error: invalid range (%d, %d).' % (offset, length))
+        end = offset + length
+        if merged:
+            last_offset, last_end, indices = merged[-1]
+            new_end = max(last_end, end)
+            # a range within the last one costs nothing, whatever max_size
+            if end <= last_end or offset <= last_end + gap and \
+                    (max_size is None or new_end - last_offset <= max_size):
+                merged[-1] = (last_offset, new_end, indices + [index])
+                continue
+        merged.append((offset, end, [index]))
+    return [(offset, end - offset, indices) for offset, end, indices in merged]
+
+
+def fdfs_atomic_write(filename, data):
+    """
+    Write data to filename atomically, via temp file in same directory plus rename.
+    arguments:
+    @filename: string
+    @data: bytes
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
 
 
 def fdfs_check_file(filename):
@@ -0,0 +1,31 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_fdfs import Fake_cluster
+from fdfs_client.client import Fdfs_client
+
+
+@pytest.fixture
+def cluster(request):
+    # parametrize indirectly by count of replicas
+    cluster = Fake_cluster(getattr(request, 'param', 1))
+    yield cluster
+    cluster.close()
+
+
+@pytest.fixture
+def make_client(cluster, tmp_path):
+    clients = []
+
+    def make(conf_options=None, **kwargs):
+        client = Fdfs_client(cluster.write_conf(str(tmp_path), **(conf_options or {})), **kwargs)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# filename: fake_fdfs.py
+
+"""In-memory tracker and storage servers speaking the FastDFS protocol, for tests."""
+
+import os
+import time
+import zlib
+import base64
+import random
+import socket
+import struct
+import threading
+from datetime import datetime
+from fdfs_client.fdfs_protol import *
+from fdfs_client.tracker_client import Storage_info
+
+HEADER = struct.Struct('!QBB')
+ENOENT = 2
+
+# 8 byte fields of a server listed by tracker, in order of the protocol
+STORAGE_INFO_FIELDS = (
+    'join_time', 'up_time', 'total_mb', 'free_mb', 'upload_prio', 'store_path_count',
+    'subdir_count_per_path', 'storage_port', 'storage_http_port', 'curr_write_path',
+    'total_upload_count', 'success_upload_count', 'total_append_count', 'success_append_count',
+    'total_modify_count', 'success_modify_count', 'total_truncate_count',
+    'success_truncate_count', 'total_setmeta_count', 'success_setmeta_count',
+    'total_del_count', 'success_del_count', 'total_download_count', 'success_download_count',
+    'total_getmeta_count', 'success_getmeta_count', 'total_create_link_count',
+    'success_create_link_count', 'total_del_link_count', 'success_del_link_count',
+    'total_upload_bytes', 'success_upload_bytes', 'total_append_bytes', 'success_append_bytes',
+    'total_modify_bytes', 'success_modify_bytes', 'total_download_bytes',
+    'success_download_bytes', 'total_sync_in_bytes', 'success_sync_in_bytes',
+    'total_sync_out_bytes', 'success_sync_out_bytes', 'total_file_open_count',
+    'success_file_open_count', 'total_file_read_count', 'success_file_read_count',
+    'total_file_write_count', 'success_file_write_count', 'last_source_sync',
+    'last_sync_update', 'last_synced_time', 'last_heartbeat_time')
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def fdfs_filename(ip_addr, data, appender=False, ext_name='txt'):
+    '''@return remote filename of data, with size and crc32 encoded as storage does'''
+    if appender:
+        file_size = FDFS_APPENDER_FILE_SIZE | random.getrandbits(32)
+        crc32 = 0
+    else:
+        file_size = (1 << 63) | (random.getrandbits(31) << 32) | len(data)
+        crc32 = zlib.crc32(data)
+    buff = struct.pack('!4s I Q I', socket.inet_aton(ip_addr), int(time.time()), file_size, crc32)
+    encoded = base64.urlsafe_b64encode(buff).decode().rstrip('=')
+    name = 'M00/%02X/%02X/%s' % (random.randrange(256), random.randrange(256), encoded)
+    return name + '.' + ext_name if ext_name else name
+
+
+class _Server(object):
+    """Threaded server calling handle(sock, cmd, body) per request."""
+
+    def __init__(self, ip_addr='127.0.0.1', port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((ip_addr, port))
+        self.sock.listen(64)
+        self.ip_addr, self.port = self.sock.getsockname()
+        self.commands = []
+        self._conns = []
+        self._closed = False
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            self._conns.append(sock)
+            t = threading.Thread(target=self._serve, args=(sock,))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, sock):
+        try:
+            while True:
+                pkg_len, cmd, status = HEADER.unpack(recv_exact(sock, HEADER.size))
+                if cmd == FDFS_PROTO_CMD_QUIT:
+                    break
+                self.commands.append(cmd)
+                if not self.handle(sock, cmd, pkg_len):
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            sock.close()
+
+    def reply(self, sock, body=b'', status=0):
+        sock.sendall(HEADER.pack(len(body), TRACKER_PROTO_CMD_RESP, status) + body)
+
+    def close(self):
+        self._closed = True
+        # wake up the blocked accept, close alone leaves the port listening
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for sock in self._conns:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class Fake_files(object):
+    """Files of one group, shared by its storage servers as if synced at once."""
+
+    def __init__(self):
+        self.data = {}
+        self.meta = {}
+        self.lock = threading.Lock()
+
+
+class Fake_storage(_Server):
+    """
+    Storage server of one group. before[cmd] is called as before[cmd](body)
+    before a request is handled, fail_download(sock, content) may replace the
+    response of a download, e.g. to drop the connection midway.
+    """
+
+    def __init__(self, files, group_name='group1', ip_addr='127.0.0.1', port=0):
+        super(Fake_storage, self).__init__(ip_addr, port)
+        self.files = files
+        self.group_name = group_name
+        self.before = {}
+        self.fail_download = None
+        # status and STORAGE_INFO_FIELDS values listed by tracker, see pack_info
+        self.status = FDFS_STORAGE_STATUS_ACTIVE
+        self.info = {}
+
+    def add_file(self, data, appender=False, ext_name='txt', meta_dict=None, source_ip_addr=None):
+        '''@return remote file id of data stored on this server, or named as source_ip_addr's'''
+        name = fdfs_filename(source_ip_addr or self.ip_addr, data, appender, ext_name)
+        with self.files.lock:
+            self.files.data[name] = bytearray(data)
+            self.files.meta[name] = dict(meta_dict or {})
+        return '%s/%s' % (self.group_name, name)
+
+    def content(self, remote_file_id):
+        return bytes(self.files.data[remote_file_id.split('/', 1)[1]])
+
+    def handle(self, sock, cmd, pkg_len):
+        body = recv_exact(sock, pkg_len)
+        hook = self.before.get(cmd)
+        if hook is not None:
+            hook(body)
+        group_len = FDFS_GROUP_NAME_MAX_LEN
+        files = self.files
+        if cmd in (STORAGE_PROTO_CMD_UPLOAD_FILE, STORAGE_PROTO_CMD_UPLOAD_APPENDER_FILE):
+            path_index, size, ext_name = struct.unpack('!B Q 6s', body[:15])
+            name = fdfs_filename(self.ip_addr, body[15:], cmd == STORAGE_PROTO_CMD_UPLOAD_APPENDER_FILE,
+                                 ext_name.strip(b'\x00').decode())
+            with files.lock:
+                files.data[name] = bytearray(body[15:])
+                files.meta[name] = {}
+            self.reply(sock, struct.pack('!16s', self.group_name.encode()) + name.encode())
+            return True
+        if cmd == STORAGE_PROTO_CMD_UPLOAD_SLAVE_FILE:
+            master_len, size, prefix_name, ext_name = struct.unpack('!Q Q 16s 6s', body[:38])
+            master = body[38:38 + master_len].decode()
+            ext_name = ext_name.strip(b'\x00').decode()
+            # slave name: master name without extension, prefix name, extension
+            name = os.path.splitext(master)[0] + prefix_name.strip(b'\x00').decode() + \
+                ('.' + ext_name if ext_name else '')
+            with files.lock:
+                if master not in files.data:
+                    self.reply(sock, status=ENOENT)
+                    return True
+                files.data[name] = bytearray(body[38 + master_len:])
+                files.meta[name] = {}
+            self.reply(sock, struct.pack('!16s', self.group_name.encode()) + name.encode())
+            return True
+        if cmd == STORAGE_PROTO_CMD_DOWNLOAD_FILE:
+            offset, length = struct.unpack('!Q Q', body[:16])
+            name = body[16 + group_len:].decode()
+            with files.lock:
+                data = files.data.get(name)
+                data = None if data is None else bytes(data)
+            if data is None or offset > len(data):
+                self.reply(sock, status=ENOENT)
+                return True
+            content = data[offset:offset + length] if length else data[offset:]
+            if self.fail_download is not None:
+                return self.fail_download(sock, content)
+            self.reply(sock, content)
+            return True
+        if cmd == STORAGE_PROTO_CMD_SET_METADATA:
+            name_len, meta_len, op_flag = struct.unpack('!Q Q c', body[:17])
+            name = body[17 + group_len:17 + group_len + name_len].decode()
+            meta = fdfs_unpack_metadata(body[17 + group_len + name_len:])
+            with files.lock:
+                if name not in files.data:
+                    self.reply(sock, status=ENOENT)
+                    return True
+                if op_flag == b'M':
+                    files.meta[name].update(meta)
+                else:
+                    files.meta[name] = meta
+            self.reply(sock)
+            return True
+        if cmd in (STORAGE_PROTO_CMD_DELETE_FILE, STORAGE_PROTO_CMD_GET_METADATA,
+                   STORAGE_PROTO_CMD_QUERY_FILE_INFO):
+            name = body[group_len:].decode()
+            with files.lock:
+                if name not in files.data:
+                    self.reply(sock, status=ENOENT)
+                    return True
+                data = bytes(files.data[name])
+                meta = files.meta[name]
+                if cmd == STORAGE_PROTO_CMD_DELETE_FILE:
+                    del files.data[name], files.meta[name]
+            if cmd == STORAGE_PROTO_CMD_GET_METADATA:
+                self.reply(sock, fdfs_pack_metadata(meta))
+            elif cmd == STORAGE_PROTO_CMD_QUERY_FILE_INFO:
+                self.reply(sock, struct.pack('!Q Q Q 16s', len(data), int(time.time()),
+                                             zlib.crc32(data), self.ip_addr.encode()))
+            else:
+                self.reply(sock)
+            return True
+        if cmd in (STORAGE_PROTO_CMD_APPEND_FILE, STORAGE_PROTO_CMD_TRUNCATE_FILE):
+            name_len, size = struct.unpack('!Q Q', body[:16])
+            name = body[16:16 + name_len].decode()
+            with files.lock:
+                data = files.data.get(name)
+                if data is not None:
+                    if cmd == STORAGE_PROTO_CMD_APPEND_FILE:
+                        data += body[16 + name_len:]
+                    else:
+                        del data[size:]
+            self.reply(sock, status=0 if data is not None else ENOENT)
+            return True
+        if cmd == STORAGE_PROTO_CMD_MODIFY_FILE:
+            name_len, offset, size = struct.unpack('!Q Q Q', body[:24])
+            name = body[24:24 + name_len].decode()
+            with files.lock:
+                data = files.data.get(name)
+                if data is not None:
+                    data[offset:offset + size] = body[24 + name_len:]
+            self.reply(sock, status=0 if data is not None else ENOENT)
+            return True
+        self.reply(sock, status=22)
+        return True
+
+    def storage_server(self):
+        '''@return Storage_server of this server, as answered by tracker'''
+        store_serv = Storage_server()
+        store_serv.ip_addr = self.ip_addr
+        store_serv.port = self.port
+        store_serv.group_name = self.group_name
+        return store_serv
+
+    def pack_info(self, status=None):
+        '''@return bytes of this server, as listed by tracker'''
+        now = int(time.time())
+        values = {
+            'join_time': now, 'up_time': now, 'total_mb': 100000, 'free_mb': 50000,
+            'store_path_count': 1, 'subdir_count_per_path': 256, 'storage_port': self.port,
+            'storage_http_port': 80, 'last_heartbeat_time': now,
+            # synced up to now, so it serves files created before
+            'last_synced_time': now + 1
+        }
+        values.update(self.info)
+        fmt = '!B %ds %ds %ds %ds %ds 52QB' % (FDFS_STORAGE_ID_MAX_SIZE, IP_ADDRESS_SIZE,
+                                               FDFS_DOMAIN_NAME_MAX_LEN, IP_ADDRESS_SIZE,
+                                               FDFS_VERSION_SIZE)
+        return struct.pack(fmt, self.status if status is None else status, b'',
+                           self.ip_addr.encode(), b'', b'', b'6.08',
+                           *[values.get(name, 0) for name in STORAGE_INFO_FIELDS] + [0])
+
+    def storage_info(self, status=None):
+        '''@return Storage_info of this server, as listed by tracker'''
+        si = Storage_info()
+        si.set_info(self.pack_info(status))
+        return si
+
+
+class Fake_tracker(_Server):
+    """Tracker server of one group, answering queries of store and fetch, and lists."""
+
+    def __init__(self, storages, group_name='group1'):
+        super(Fake_tracker, self).__init__()
+        self.storages = storages
+        self.group_name = group_name
+
+    def handle(self, sock, cmd, pkg_len):
+        recv_exact(sock, pkg_len)
+        group = struct.pack('!16s', self.group_name.encode())
+        first = self.storages[0]
+        if cmd in (TRACKER_PROTO_CMD_SERVER_LIST_ALL_GROUPS, TRACKER_PROTO_CMD_SERVER_LIST_ONE_GROUP):
+            # total, free and trunk free mb, count, ports, active count, ...
+            active = [store for store in self.storages if store.status == FDFS_STORAGE_STATUS_ACTIVE]
+            self.reply(sock, struct.pack('!%ds 11Q' % (FDFS_GROUP_NAME_MAX_LEN + 1),
+                                         self.group_name.encode(), 100000 * len(self.storages),
+                                         50000 * len(self.storages), 0, len(self.storages),
+                                         first.port, 80, len(active), 0, 1, 256, 0))
+        elif cmd == TRACKER_PROTO_CMD_SERVER_LIST_STORAGE:
+            self.reply(sock, b''.join(store.pack_info() for store in self.storages))
+        elif cmd in (TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITHOUT_GROUP_ONE,
+                   TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITH_GROUP_ONE):
+            self.reply(sock, group + struct.pack('!15s Q B', first.ip_addr.encode(), first.port, 0))
+        elif cmd in (TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE, TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE):
+            self.reply(sock, group + struct.pack('!15s Q', first.ip_addr.encode(), first.port))
+        elif cmd == TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL:
+            body = group + struct.pack('!15s Q', first.ip_addr.encode(), first.port)
+            for store in self.storages[1:]:
+                body += struct.pack('!15s', store.ip_addr.encode())
+            self.reply(sock, body)
+        else:
+            self.reply(sock, status=22)
+        return True
+
+
+class Fake_topology(object):
+    """Cluster_topology serving a fixed server list, recording failed servers."""
+
+    def __init__(self, group_name, storages):
+        self.servers = dict((store.ip_addr, store.storage_info()) for store in storages)
+        self.group_name = group_name
+        self.failed = []
+
+    def get_servers(self, group_name):
+        return self.servers if group_name == self.group_name else {}
+
+    def get_server(self, group_name, ip_addr):
+        return self.get_servers(group_name).get(ip_addr)
+
+    def get_active_server(self, group_name, ip_addr):
+        si = self.get_server(group_name, ip_addr)
+        if si is None or si.status != FDFS_STORAGE_STATUS_ACTIVE:
+            return None
+        return si
+
+    def mark_failed(self, group_name, ip_addr):
+        self.failed.append(ip_addr)
+
+
+class Fake_cluster(object):
+    """A tracker and replicas storage servers of group1, all on one port."""
+
+    def __init__(self, replicas=1):
+        files = Fake_files()
+        first = Fake_storage(files)
+        self.storages = [first]
+        for i in range(1, replicas):
+            self.storages.append(Fake_storage(files, ip_addr='127.0.0.%d' % (i + 1), port=first.port))
+        self.tracker = Fake_tracker(self.storages)
+        self.files = files
+
+    @property
+    def storage(self):
+        return self.storages[0]
+
+    def write_conf(self, dirname, **options):
+        '''@return path of client.conf of this cluster'''
+        path = os.path.join(dirname, 'client.conf')
+        with open(path, 'w') as f:
+            f.write('connect_timeout = 5\nnetwork_timeout = 5\n')
+            f.write('tracker_server = %s:%d\n' % (self.tracker.ip_addr, self.tracker.port))
+            for key, value in options.items():
+                f.write('%s = %s\n' % (key, value))
+        return path
+
+    def close(self):
+        self.tracker.close()
+        for store in self.storages:
+            store.close()
@@ -0,0 +1,59 @@
+import pytest
+from fdfs_client.cache import Memory_cache, Disk_cache
+from fdfs_client.exceptions import DataError, ConnectionError
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_DELETE_FILE, STORAGE_PROTO_CMD_APPEND_FILE
+
+
+def test_read_during_delete_is_not_cached(cluster, make_client, tmp_path):
+    client = make_client(mem_cache=Memory_cache(),
+                         disk_cache=Disk_cache(str(tmp_path / 'cache'), 1024 * 1024))
+    file_id = cluster.storage.add_file(b'old content')
+    assert client.download_to_buffer(file_id)['Content'] == b'old content'
+    reads = []
+    # a download reaching storage server just before the delete is done
+    cluster.storage.before[STORAGE_PROTO_CMD_DELETE_FILE] = \
+        lambda body: reads.append(client.download_to_buffer(file_id)['Content'])
+    client.delete_file(file_id)
+    assert reads == [b'old content']
+    assert client.mem_cache.get(file_id) is None
+    assert client.disk_cache.get_buffer(file_id) is None
+    with pytest.raises(DataError):
+        client.download_to_buffer(file_id)
+
+
+def test_read_during_append_is_not_cached(cluster, make_client):
+    client = make_client(mem_cache=Memory_cache(cache_appender=True))
+    file_id = client.upload_appender_by_buffer(b'abc')['Remote file_id']
+    cluster.storage.before[STORAGE_PROTO_CMD_APPEND_FILE] = \
+        lambda body: client.download_to_buffer(file_id)
+    client.append_by_buffer(b'def', file_id)
+    assert client.download_to_buffer(file_id)['Content'] == b'abcdef'
+
+
+def test_failed_update_drops_cache(cluster, make_client):
+    client = make_client(mem_cache=Memory_cache(cache_appender=True))
+    file_id = client.upload_appender_by_buffer(b'abc')['Remote file_id']
+    client.download_to_buffer(file_id)
+
+    def fail(body):
+        raise OSError('connection dropped')
+    cluster.storage.before[STORAGE_PROTO_CMD_APPEND_FILE] = fail
+    with pytest.raises(ConnectionError):
+        client.append_by_buffer(b'def', file_id)
+    assert client.mem_cache.get(file_id) is None
+
+
+def test_update_during_read_is_not_cached(cluster, make_client):
+    client = make_client(mem_cache=Memory_cache(cache_appender=True))
+    file_id = client.upload_appender_by_buffer(b'abc')['Remote file_id']
+
+    def append_then_reply(sock, content):
+        # content was read before the append, the reply is stale
+        cluster.storage.fail_download = None
+        client.append_by_buffer(b'def', file_id)
+        cluster.storage.reply(sock, content)
+        return True
+    cluster.storage.fail_download = append_then_reply
+    assert client.download_to_buffer(file_id)['Content'] == b'abc'
+    assert client.mem_cache.get(file_id) is None
+    assert client.download_to_buffer(file_id)['Content'] == b'abcdef'
@@ -0,0 +1,84 @@
+import socket
+import struct
+import threading
+import pytest
+from fdfs_client.exceptions import DataError
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_DOWNLOAD_FILE
+
+CONTENT = b''.join(b'line %d of a compressible file\n' % i for i in range(20000))
+
+
+def test_download_decompressed_to_buffer(cluster, make_client):
+    client = make_client({'io_chunk_size': 4096})
+    ret = client.upload_compressed_by_buffer(CONTENT, 'txt')
+    file_id = ret['Remote file_id']
+    assert len(cluster.storage.content(file_id)) < len(CONTENT)
+    ret = client.download_decompressed_to_buffer(file_id, verify=True)
+    assert ret['Content'] == CONTENT
+    assert ret['Download size'] == client.download_decompressed_to_buffer(file_id)['Download size']
+
+
+def test_download_decompressed_to_file(cluster, make_client, tmp_path):
+    client = make_client({'io_chunk_size': 4096})
+    src = tmp_path / 'src.txt'
+    src.write_bytes(CONTENT)
+    file_id = client.upload_compressed_by_filename(str(src))['Remote file_id']
+    dst = tmp_path / 'dst.txt'
+    client.download_decompressed_to_file(str(dst), file_id)
+    assert dst.read_bytes() == CONTENT
+
+
+def test_failed_decompression_drops_connection(cluster, make_client):
+    client = make_client({'io_chunk_size': 4096})
+    file_id = client.upload_compressed_by_buffer(CONTENT, 'txt')['Remote file_id']
+    stored = cluster.storage.content(file_id)
+
+    def corrupt(sock, content):
+        cluster.storage.fail_download = None
+        cluster.storage.reply(sock, b'\xff' * len(content))
+        return True
+    cluster.storage.fail_download = corrupt
+    with pytest.raises(DataError):
+        client.download_decompressed_to_buffer(file_id)
+    # rest of the bad body is not read as the next response
+    assert client.download_to_buffer(file_id)['Content'] == stored
+
+
+def test_ranges_of_compressed_file_raise(cluster, make_client):
+    client = make_client()
+    file_id = client.upload_compressed_by_buffer(CONTENT, 'txt')['Remote file_id']
+    stored = cluster.storage.content(file_id)
+    with pytest.raises(DataError):
+        client.read_ranges(file_id, [(0, 10)])
+    with pytest.raises(DataError):
+        client.open_remote(file_id)
+    assert [bytes(v) for v in client.read_ranges(file_id, [(0, 10)], raw=True)] == [stored[:10]]
+    with client.open_remote(file_id, raw=True) as f:
+        assert f.read() == stored
+
+
+def relay(client, file_id, **kwargs):
+    a, b = socket.socketpair()
+    received = []
+    t = threading.Thread(target=lambda: received.append(b.makefile('rb').read()))
+    t.start()
+    try:
+        ret = client.relay_download(file_id, a, header=lambda n: struct.pack('!Q', n), **kwargs)
+    finally:
+        a.close()
+        t.join()
+        b.close()
+    return ret, received[0]
+
+
+def test_relay_download_decompresses(cluster, make_client):
+    client = make_client()
+    file_id = client.upload_compressed_by_buffer(CONTENT, 'txt')['Remote file_id']
+    ret, received = relay(client, file_id)
+    assert struct.unpack('!Q', received[:8])[0] == len(CONTENT)
+    assert received[8:] == CONTENT
+    ret, received = relay(client, file_id, raw=True)
+    assert received[8:] == cluster.storage.content(file_id)
+    with pytest.raises(DataError):
+        client.relay_download(file_id, None, offset=10)
+    assert cluster.storage.commands.count(STORAGE_PROTO_CMD_DOWNLOAD_FILE) == 2
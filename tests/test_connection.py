@@ -0,0 +1,64 @@
+import socket
+import threading
+import time
+import pytest
+from fdfs_client.connection import Connection, Transport_options
+from fdfs_client.exceptions import ConnectionError
+
+
+@pytest.fixture
+def connect():
+    '''@return function(pieces, **transport) of a Connection to a server sending pieces'''
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    threads = []
+
+    def serve(pieces):
+        sock, _ = listener.accept()
+        for piece in pieces:
+            # apart in time, so each piece arrives by its own recv
+            time.sleep(0.02)
+            sock.sendall(piece)
+        sock.close()
+
+    def make(pieces, **transport):
+        t = threading.Thread(target=serve, args=(pieces,))
+        t.start()
+        threads.append(t)
+        conn = Connection(host_tuple=(listener.getsockname(),), timeout=5,
+                          transport=Transport_options(**transport))
+        conn.connect()
+        return conn
+
+    yield make
+    for t in threads:
+        t.join()
+    listener.close()
+
+
+def test_small_reads_across_buffer_fills(connect):
+    conn = connect([b'012', b'3456789', b'ABCDEF'], read_buffer_size=8)
+    assert conn.recv_exact(4) == b'0123'
+    # 456 are buffered, 789 come by the next fill
+    assert conn.recv_exact(6) == b'456789'
+    assert conn.recv_exact(2) == b'AB'
+    assert conn.buffered() == 4
+    assert conn.recv(10) == b'CDEF'
+    assert conn.recv(10) == b''
+
+
+def test_large_read_takes_buffered_bytes_first(connect):
+    body = bytes(range(256)) * 64
+    conn = connect([b'HDR' + body[:5], body[5:9000], body[9000:]], read_buffer_size=64)
+    assert conn.recv_exact(3) == b'HDR'
+    assert conn.buffered() == 5
+    assert conn.recv_exact(len(body)) == body
+    assert conn.buffered() == 0
+
+
+@pytest.mark.parametrize('size', [6, 100])
+def test_closed_midway(connect, size):
+    conn = connect([b'abc', b'de'], read_buffer_size=8)
+    with pytest.raises(ConnectionError):
+        conn.recv_exact(size)
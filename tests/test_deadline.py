@@ -0,0 +1,61 @@
+import time
+import pytest
+from fdfs_client.exceptions import DeadlineExceeded
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_DOWNLOAD_FILE
+
+CONTENT = b'0123456789' * 10000
+
+
+def slow_downloads(cluster, seconds):
+    cluster.storage.before[STORAGE_PROTO_CMD_DOWNLOAD_FILE] = lambda body: time.sleep(seconds)
+
+
+def test_download_resumable_deadline(cluster, make_client, tmp_path):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+    local = tmp_path / 'local'
+    client.download_resumable(str(local), file_id, deadline=5)
+    assert local.read_bytes() == CONTENT
+    slow_downloads(cluster, 0.5)
+    local.unlink()
+    with pytest.raises(DeadlineExceeded):
+        client.download_resumable(str(local), file_id, deadline=0.1)
+
+
+def test_upload_resumable_deadline(cluster, make_client, tmp_path):
+    client = make_client()
+    local = tmp_path / 'local'
+    local.write_bytes(CONTENT)
+    file_id = client.upload_resumable(str(local), chunk_size=4096, deadline=5)['Remote file_id']
+    assert cluster.storage.content(file_id) == CONTENT
+
+
+def test_decompressed_deadline(cluster, make_client):
+    client = make_client()
+    file_id = client.upload_compressed_by_buffer(CONTENT, 'txt', deadline=5)['Remote file_id']
+    assert client.download_decompressed_to_buffer(file_id, deadline=5)['Content'] == CONTENT
+    slow_downloads(cluster, 0.5)
+    with pytest.raises(DeadlineExceeded):
+        client.download_decompressed_to_buffer(file_id, deadline=0.1)
+
+
+def test_open_remote_deadline_bounds_open_only(cluster, make_client):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+    f = client.open_remote(file_id, deadline=0.1)
+    slow_downloads(cluster, 0.2)
+    with f:
+        assert f.read(10) == CONTENT[:10]
+
+
+def test_backoff_is_bounded_by_deadline(cluster, make_client, tmp_path):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+
+    def drop(sock, content):
+        return False
+    cluster.storage.fail_download = drop
+    start = time.time()
+    with pytest.raises(DeadlineExceeded):
+        client.download_resumable(str(tmp_path / 'local'), file_id, backoff=30, deadline=1)
+    assert time.time() - start < 1
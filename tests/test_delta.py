@@ -0,0 +1,95 @@
+import os
+import pytest
+from fdfs_client.delta import Block_manifest
+from fdfs_client.utils import appromix
+from fdfs_client.exceptions import ConnectionError
+from fdfs_client.fdfs_protol import (
+    STORAGE_PROTO_CMD_MODIFY_FILE, STORAGE_PROTO_CMD_TRUNCATE_FILE, STORAGE_PROTO_CMD_APPEND_FILE
+)
+
+BLOCK = 1024
+
+
+def blocks(*seeds):
+    return b''.join(bytes(bytearray((seed + i) % 256 for i in range(BLOCK))) for seed in seeds)
+
+
+@pytest.fixture
+def sync(cluster, make_client, tmp_path):
+    client = make_client()
+    file_id = client.upload_appender_by_buffer(b'initial')['Remote file_id']
+    local = tmp_path / 'local'
+    manifests = str(tmp_path / 'manifests')
+
+    def sync(content):
+        local.write_bytes(content)
+        start = len(cluster.storage.commands)
+        ret = client.delta_sync(str(local), file_id, manifests, block_size=BLOCK)
+        assert cluster.storage.content(file_id) == content
+        return ret, cluster.storage.commands[start:]
+    sync.file_id = file_id
+    sync.local = local
+    sync.manifests = manifests
+    return sync
+
+
+def test_first_sync_sends_all(sync):
+    ret, commands = sync(blocks(1, 2, 3) + b'tail')
+    assert ret['Appended size'] == appromix(3 * BLOCK + 4)
+    assert commands[0] == STORAGE_PROTO_CMD_TRUNCATE_FILE
+    assert STORAGE_PROTO_CMD_MODIFY_FILE not in commands
+
+
+def test_unchanged_sync_sends_nothing(sync):
+    sync(blocks(1, 2, 3))
+    ret, commands = sync(blocks(1, 2, 3))
+    assert commands == []
+    assert ret['Modified size'] == appromix(0) and ret['Appended size'] == appromix(0)
+
+
+def test_changed_block_is_modified(sync):
+    sync(blocks(1, 2, 3))
+    ret, commands = sync(blocks(1, 9, 3))
+    assert commands == [STORAGE_PROTO_CMD_MODIFY_FILE]
+    assert ret['Modified size'] == appromix(BLOCK)
+
+
+def test_grow(sync):
+    sync(blocks(1, 2) + b'half')
+    ret, commands = sync(blocks(1, 2, 3, 4))
+    # the partial last block is modified, the rest appended
+    assert commands == [STORAGE_PROTO_CMD_TRUNCATE_FILE, STORAGE_PROTO_CMD_MODIFY_FILE,
+                        STORAGE_PROTO_CMD_APPEND_FILE]
+    assert ret['Modified size'] == appromix(4)
+    assert ret['Appended size'] == appromix(2 * BLOCK - 4)
+
+
+def test_shrink(sync):
+    sync(blocks(1, 2, 3, 4))
+    ret, commands = sync(blocks(1, 9))
+    assert commands == [STORAGE_PROTO_CMD_TRUNCATE_FILE, STORAGE_PROTO_CMD_MODIFY_FILE]
+    assert ret['Modified size'] == appromix(BLOCK) and ret['Appended size'] == appromix(0)
+
+
+def test_failed_modify_after_shrink(cluster, sync, make_client):
+    sync(blocks(*range(10)))
+
+    def fail(body):
+        raise OSError('connection dropped')
+    cluster.storage.before[STORAGE_PROTO_CMD_MODIFY_FILE] = fail
+    sync.local.write_bytes(blocks(0, 9, 2, 3, 4))
+    with pytest.raises(ConnectionError):
+        make_client().delta_sync(str(sync.local), sync.file_id, sync.manifests, block_size=BLOCK)
+    del cluster.storage.before[STORAGE_PROTO_CMD_MODIFY_FILE]
+    # the manifest does not describe more than the truncated remote file
+    manifest = Block_manifest.load(os.path.join(sync.manifests, os.listdir(sync.manifests)[0]))
+    assert manifest.file_size == 5 * BLOCK
+    assert manifest.digests[1] is None
+    sync(blocks(*range(9)) + blocks(42))
+
+
+def test_unsynced_manifest():
+    manifest = Block_manifest('group1/M00/00/00/x', BLOCK, 4 * BLOCK, ['a', 'b', 'c', 'd'])
+    assert manifest.unsynced(2 * BLOCK + 10, []).digests == ['a', 'b']
+    assert manifest.unsynced(4 * BLOCK, [(BLOCK + 1, BLOCK)]).digests == ['a', None, None, 'd']
+    assert manifest.unsynced(0, []).file_size == 0
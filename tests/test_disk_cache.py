@@ -0,0 +1,69 @@
+import os
+from fake_fdfs import fdfs_filename
+from fdfs_client.cache import Disk_cache
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_DOWNLOAD_FILE
+
+
+def file_id(data=b'x', appender=False):
+    return 'group1/' + fdfs_filename('127.0.0.1', data, appender)
+
+
+def downloads(cluster):
+    return cluster.storage.commands.count(STORAGE_PROTO_CMD_DOWNLOAD_FILE)
+
+
+def test_read_through(cluster, make_client, tmp_path):
+    cache = Disk_cache(str(tmp_path / 'cache'), 1024 * 1024)
+    client = make_client(disk_cache=cache)
+    fid = cluster.storage.add_file(b'cached content')
+    assert client.download_to_buffer(fid)['Content'] == b'cached content'
+    assert client.download_to_buffer(fid)['Content'] == b'cached content'
+    local = tmp_path / 'local'
+    client.download_to_file(str(local), fid)
+    assert local.read_bytes() == b'cached content'
+    assert downloads(cluster) == 1
+    # ranges and appender files are not cached
+    client.download_to_buffer(fid, offset=1, down_bytes=3)
+    appender_id = cluster.storage.add_file(b'mutable', appender=True)
+    client.download_to_buffer(appender_id)
+    client.download_to_buffer(appender_id)
+    assert downloads(cluster) == 4
+    assert len(cache) == 1
+
+
+def test_segmented_lru(tmp_path):
+    cache = Disk_cache(str(tmp_path), 300, protected_ratio=0.5)
+    hot, cold, new = file_id(b'hot'), file_id(b'cold'), file_id(b'new')
+    cache.put_buffer(hot, b'h' * 100)
+    cache.put_buffer(cold, b'c' * 100)
+    # a second hit protects hot, so the newer cold entry is evicted first
+    assert cache.get_buffer(hot) == b'h' * 100
+    cache.put_buffer(new, b'n' * 100)
+    cache.put_buffer(file_id(b'another'), b'a' * 100)
+    assert cache.get_buffer(cold) is None
+    assert cache.get_buffer(hot) == b'h' * 100
+    assert cache.size() <= 300
+    assert not cache.put_buffer(file_id(b'big'), b'b' * 301)
+    assert not cache.put_buffer(file_id(appender=True), b'a')
+
+
+def test_index_is_reloaded(tmp_path):
+    cache = Disk_cache(str(tmp_path), 1024)
+    kept, broken = file_id(b'kept'), file_id(b'broken')
+    cache.put_buffer(kept, b'kept')
+    cache.put_buffer(broken, b'broken')
+    cache.close()
+    # a file changed behind the index, a stray data file and a temp file
+    with open(cache._entry_filename(broken), 'wb') as f:
+        f.write(b'short')
+    stray = cache._entry_filename(file_id(b'stray'))
+    os.makedirs(os.path.dirname(stray), exist_ok=True)
+    with open(stray, 'wb') as f:
+        f.write(b'stray')
+    open(os.path.join(str(tmp_path), '.tmp-x'), 'wb').close()
+    cache = Disk_cache(str(tmp_path), 1024)
+    assert cache.get_buffer(kept) == b'kept'
+    assert cache.get_buffer(broken) is None
+    assert not os.path.exists(stray)
+    assert not os.path.exists(os.path.join(str(tmp_path), '.tmp-x'))
+    assert len(cache) == 1 and cache.size() == 4
@@ -0,0 +1,67 @@
+import base64
+import socket
+import struct
+import zlib
+import pytest
+from fake_fdfs import fdfs_filename
+from fdfs_client.exceptions import DataError
+from fdfs_client.fdfs_protol import FDFS_TRUNK_FILE_MARK_SIZE
+from fdfs_client.utils import FileId, parse_remote_fileid, fdfs_is_appender_fileid
+
+
+def b64(buff):
+    return base64.urlsafe_b64encode(buff).decode().rstrip('=')
+
+
+def test_normal_file():
+    file_id = FileId('group1/' + fdfs_filename('10.0.0.7', b'content'))
+    assert file_id.group_name == 'group1'
+    assert file_id.store_path == 'M00'
+    assert file_id.source_ip_addr == '10.0.0.7'
+    assert file_id.file_size == 7
+    assert file_id.crc32 == zlib.crc32(b'content')
+    assert file_id.ext_name == 'txt'
+    assert not (file_id.is_appender or file_id.is_trunk or file_id.is_slave)
+    group_name, remote_filename = file_id
+    assert 'group1/' + remote_filename == str(file_id)
+
+
+def test_appender_file():
+    remote_file_id = 'group2/' + fdfs_filename('10.0.0.8', b'', appender=True, ext_name='')
+    file_id = parse_remote_fileid(remote_file_id)
+    assert file_id.is_appender and not file_id.is_slave
+    assert file_id.file_size is None and file_id.crc32 is None
+    assert file_id.ext_name == ''
+    assert fdfs_is_appender_fileid(remote_file_id)
+
+
+def test_trunk_file():
+    buff = struct.pack('!4s I Q I', socket.inet_aton('10.0.0.9'), 1500000000,
+                       FDFS_TRUNK_FILE_MARK_SIZE | 1234, 0xCAFE)
+    trunk_info = b64(struct.pack('!I I I', 3, 4096, 2048))
+    file_id = FileId('group1/M01/0A/0B/%s%s.jpg' % (b64(buff), trunk_info))
+    assert file_id.is_trunk and not file_id.is_slave
+    assert file_id.store_path_index == 1
+    assert (file_id.trunk_id, file_id.trunk_offset, file_id.trunk_alloc_size) == (3, 4096, 2048)
+    assert (file_id.file_size, file_id.crc32) == (1234, 0xCAFE)
+    assert file_id.timestamp == 1500000000
+    assert file_id.ext_name == 'jpg'
+
+
+def test_slave_file():
+    master = fdfs_filename('10.0.0.7', b'master', ext_name='')
+    file_id = FileId('group1/%s_150x150.jpg' % master)
+    assert file_id.is_slave and not file_id.is_appender
+    assert file_id.file_size is None and file_id.crc32 is None
+    assert file_id.ext_name == 'jpg'
+
+
+@pytest.mark.parametrize('remote_file_id', [
+    'no_group', 'group1/X00/00/00/abc', 'group1/M0G/00/00/' + 'A' * 27,
+    'group1/M00/00/00/' + '*' * 27, 'group1/M00/00/00/AAAA',
+])
+def test_invalid(remote_file_id):
+    with pytest.raises(DataError):
+        FileId(remote_file_id)
+    assert parse_remote_fileid(remote_file_id) is None
+    assert fdfs_is_appender_fileid(remote_file_id)
@@ -0,0 +1,42 @@
+import pytest
+from fake_fdfs import Fake_topology
+from fdfs_client.hedge import Hedge_policy
+from fdfs_client.fdfs_protol import TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL, \
+    FDFS_STORAGE_STATUS_OFFLINE
+
+
+def make_hedged_client(cluster, make_client):
+    client = make_client(route_direct=True, hedge=Hedge_policy(delay=0, budget_ratio=1))
+    client.topology = Fake_topology('group1', cluster.storages)
+    return client
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_hedged_read_takes_replicas_from_topology(cluster, make_client):
+    client = make_hedged_client(cluster, make_client)
+    file_id = cluster.storage.add_file(b'x' * 1000)
+    for i in range(3):
+        assert client.download_to_buffer(file_id)['Content'] == b'x' * 1000
+    assert TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL not in cluster.tracker.commands
+    assert client._direct_replicas(file_id)[0].ip_addr == cluster.storage.ip_addr
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_hedged_read_skips_unsynced_and_inactive(cluster, make_client):
+    client = make_hedged_client(cluster, make_client)
+    file_id = cluster.storage.add_file(b'abc')
+    replica = client.topology.servers[cluster.storages[1].ip_addr]
+    replica.last_synced_time = '1970-01-01T00:00:00'
+    assert [s.ip_addr for s in client._direct_replicas(file_id)] == [cluster.storage.ip_addr]
+    replica.last_synced_time = '2999-01-01T00:00:00'
+    client.topology.servers[cluster.storage.ip_addr].status = FDFS_STORAGE_STATUS_OFFLINE
+    assert [s.ip_addr for s in client._direct_replicas(file_id)] == [replica.ip_addr]
+
+
+def test_hedged_read_falls_back_to_tracker(cluster, make_client):
+    client = make_hedged_client(cluster, make_client)
+    file_id = cluster.storage.add_file(b'abc')
+    # topology does not know the group
+    client.topology.group_name = 'group2'
+    assert client.download_to_buffer(file_id)['Content'] == b'abc'
+    assert TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ALL in cluster.tracker.commands
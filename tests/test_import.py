@@ -0,0 +1,32 @@
+import os
+import sys
+import subprocess
+
+# milliseconds a cold import of fdfs_client.client may take, best of a few runs
+IMPORT_BUDGET_MS = 100
+THIRD_PARTY = ('requests', 'urllib3', 'mutagen', 'chardet', 'charset_normalizer', 'idna')
+
+CODE = '''
+import sys, time
+t = time.perf_counter()
+import fdfs_client.client
+print((time.perf_counter() - t) * 1000)
+print(' '.join(sorted(m for m in sys.modules if m.split('.')[0] in %r)))
+''' % (THIRD_PARTY,)
+
+
+def cold_import():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', CODE], env=env).decode()
+    elapsed, modules = out.split('\n')[:2]
+    return float(elapsed), modules.split()
+
+
+def test_no_third_party_modules():
+    assert cold_import()[1] == []
+
+
+def test_import_time_budget():
+    best = min(cold_import()[0] for i in range(5))
+    assert best < IMPORT_BUDGET_MS, 'import took %.1fms' % best
@@ -0,0 +1,75 @@
+import pytest
+from fdfs_client.exceptions import ConnectionError, DataError
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_APPEND_FILE
+from fdfs_client.pack import Pack_store, Pack_index, fdfs_pack_id, parse_pack_id
+
+
+def container_of(pack_id):
+    return parse_pack_id(pack_id)[0]
+
+
+def test_pack_id():
+    pack_id = fdfs_pack_id('group1/M00/00/00/abc.pack', 10, 20)
+    assert parse_pack_id(pack_id) == ('group1/M00/00/00/abc.pack', 10, 20)
+    for invalid in ('group1/M00/00/00/abc.pack', 'abc#1+2', 'group1/abc#1', 'group1/abc#-1+2'):
+        with pytest.raises(DataError):
+            parse_pack_id(invalid)
+
+
+def test_index_parse():
+    index = Pack_index.parse(Pack_index.records('A', [(0, 5), (5, 3), (8, 0)]) +
+                             Pack_index.records('D', [(5, 3)]) + b'A 8 1')
+    assert index.live() == [(0, 5), (8, 0)]
+    assert (index.live_size(), index.dead_size()) == (5, 3)
+    with pytest.raises(DataError):
+        Pack_index.parse(b'A 1\n')
+
+
+def test_write_and_read(cluster, make_client):
+    store = Pack_store(make_client(), max_container_size=100)
+    first = store.write([b'alpha', b'', b'beta'])
+    second = store.write([b'gamma'])
+    assert len(set(map(container_of, first + second))) == 1
+    assert [store.read(pack_id) for pack_id in first + second] == [b'alpha', b'', b'beta', b'gamma']
+    ids = second + first
+    assert [bytes(view) for view in store.read_many(ids)] == [b'gamma', b'alpha', b'', b'beta']
+    # beyond max_container_size a new container is started
+    third = store.write([b'x' * 90])
+    assert container_of(third[0]) != container_of(first[0])
+    assert store.read(third[0]) == b'x' * 90
+    assert store.index(container_of(first[0])).live() == [(0, 5), (5, 0), (5, 4), (9, 5)]
+    with pytest.raises(DataError):
+        store.write([b''])
+
+
+def test_failed_append_starts_new_container(cluster, make_client):
+    store = Pack_store(make_client())
+    first = store.write([b'one'])
+
+    def fail(body):
+        del cluster.storage.before[STORAGE_PROTO_CMD_APPEND_FILE]
+        raise OSError('dropped')
+    cluster.storage.before[STORAGE_PROTO_CMD_APPEND_FILE] = fail
+    with pytest.raises(ConnectionError):
+        store.write([b'two'])
+    second = store.write([b'three'])
+    assert container_of(second[0]) != container_of(first[0])
+    assert store.read(second[0]) == b'three'
+
+
+def test_delete_and_compact(cluster, make_client):
+    client = make_client()
+    store = Pack_store(client)
+    ids = store.write([b'keep', b'drop', b'', b'also dropped'])
+    container_id = container_of(ids[0])
+    store.delete(ids[1])
+    assert store.compact(container_id) == {}
+    store.delete(ids[3])
+    index_id = store.index_id(container_id)
+    # a fresh store finds the index by meta data of the container
+    mapping = Pack_store(client).compact(container_id)
+    assert sorted(mapping) == [ids[0]]
+    assert store.read(mapping[ids[0]]) == b'keep'
+    assert store.read(ids[2]) == b''
+    stored = ['group1/' + name for name in cluster.files.data]
+    assert container_id not in stored and index_id not in stored
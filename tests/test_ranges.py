@@ -0,0 +1,94 @@
+import time
+import pytest
+from fake_fdfs import ENOENT, HEADER
+from fdfs_client.utils import fdfs_coalesce_ranges
+from fdfs_client.exceptions import ConnectionError, DataError, DeadlineExceeded
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_DOWNLOAD_FILE
+
+CONTENT = bytes(bytearray(i % 251 for i in range(256 * 1024)))
+RANGES = [(200000, 100), (0, 10), (5, 20), (40, 0), (1000, 24), (100000, 50000), (150000, 4)]
+
+
+def downloads(store):
+    return store.commands.count(STORAGE_PROTO_CMD_DOWNLOAD_FILE)
+
+
+def test_coalesce_ranges():
+    # overlapping, and apart by at most gap, are merged, indices keep input order
+    assert fdfs_coalesce_ranges([(100, 10), (0, 10), (5, 10), (20, 5)], gap=4) == \
+        [(0, 15, [1, 2]), (20, 5, [3]), (100, 10, [0])]
+    assert fdfs_coalesce_ranges([(0, 10), (20, 5)], gap=10) == [(0, 25, [0, 1])]
+    # a merged range is not grown beyond max_size
+    assert fdfs_coalesce_ranges([(0, 10), (10, 10), (20, 10)], max_size=20) == \
+        [(0, 20, [0, 1]), (20, 10, [2])]
+    assert fdfs_coalesce_ranges([(0, 100), (10, 10)], max_size=50) == [(0, 100, [0, 1])]
+    assert fdfs_coalesce_ranges([]) == []
+    with pytest.raises(DataError):
+        fdfs_coalesce_ranges([(-1, 10)])
+
+
+def check(results):
+    assert [bytes(view) for view in results] == [CONTENT[o:o + n] for o, n in RANGES]
+
+
+def test_read_ranges(cluster, make_client):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+    check(client.read_ranges(file_id, RANGES, gap=1024, raw=True))
+    # merged into 0-1024, 100000-150004 and 200000-200100, the second is split
+    # by max_request_size, a single range is not
+    assert downloads(cluster.storage) == 3
+    check(client.read_ranges(file_id, RANGES, gap=1024, max_request_size=16 * 1024, raw=True))
+    assert downloads(cluster.storage) == 3 + 4
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_spread_read_ranges(cluster, make_client):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+    check(client.read_ranges(file_id, RANGES, gap=1024, spread=True, raw=True))
+    assert downloads(cluster.storages[0]) == 2 and downloads(cluster.storages[1]) == 1
+
+
+def fail_with(store, fail):
+    store.fail_download = fail
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+@pytest.mark.parametrize('fail', [
+    lambda sock, content: False,
+    lambda sock, content: sock.sendall(HEADER.pack(len(content), 100, 0) + content[:10]),
+    'enoent'])
+def test_spread_failure_is_read_from_other_replica(cluster, make_client, fail):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+    # the replica tracker returns fails, so it must not be asked again
+    replica = cluster.storages[0]
+    if fail == 'enoent':
+        # the file is not synced to this replica yet
+        fail = lambda sock, content: replica.reply(sock, status=ENOENT) or True
+    fail_with(replica, fail)
+    check(client.read_ranges(file_id, RANGES, gap=1024, spread=True, raw=True))
+    assert downloads(cluster.storages[1]) == 3
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_spread_failure_of_all_replicas_raises(cluster, make_client):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+    for store in cluster.storages:
+        fail_with(store, lambda sock, content: False)
+    with pytest.raises(ConnectionError):
+        client.read_ranges(file_id, RANGES, gap=1024, spread=True, raw=True)
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_spread_deadline_is_not_retried(cluster, make_client):
+    client = make_client()
+    file_id = cluster.storage.add_file(CONTENT)
+    cluster.storages[1].before[STORAGE_PROTO_CMD_DOWNLOAD_FILE] = lambda body: time.sleep(0.5)
+    start = time.time()
+    with pytest.raises(DeadlineExceeded):
+        client.read_ranges(file_id, RANGES, gap=1024, spread=True, raw=True, deadline=0.2)
+    assert time.time() - start < 0.5
+    assert downloads(cluster.storages[0]) == 2
@@ -0,0 +1,97 @@
+import sys
+import threading
+import pytest
+from fdfs_client.registry import registry
+from fdfs_client.connection import ConnectionPool
+from fdfs_client.exceptions import ConnectionError
+
+
+def test_shared_clients_share_pools(cluster, make_client):
+    first = make_client(shared=True)
+    second = make_client(shared=True)
+    assert first.tracker_pool is second.tracker_pool
+    assert first.storages is second.storages
+    assert first._shared.refs == 2
+    file_id = first.upload_by_buffer(b'shared', 'txt')['Remote file_id']
+    first.close()
+    # pools stay open for the other client
+    assert second.download_to_buffer(file_id)['Content'] == b'shared'
+    shared = second._shared
+    second.close()
+    assert shared.refs == 0 and shared.key not in registry._entries
+    assert make_client(shared=True)._shared is not shared
+
+
+def tracker_pool(cluster, **kwargs):
+    return ConnectionPool(name='Tracker Pool', timeout=5,
+                          host_tuple=((cluster.tracker.ip_addr, cluster.tracker.port),), **kwargs)
+
+
+def test_pool_is_thread_safe(cluster):
+    pool = tracker_pool(cluster, max_conn=4)
+    errors = []
+
+    def use():
+        try:
+            for i in range(50):
+                conn = pool.get_connection()
+                pool.release(conn)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=use) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # more threads than max_conn may fail to get one, but never pass the limit
+    assert all(isinstance(e, ConnectionError) for e in errors)
+    assert pool._conns_created <= 4
+    assert pool._conns_created == pool.idle_count()
+    pool.destroy()
+
+
+def test_concurrent_warm_up(cluster):
+    pool = tracker_pool(cluster)
+    opened = []
+    threads = [threading.Thread(target=lambda: opened.append(pool.warm_up(4))) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(opened) == 4 and pool.idle_count() == 4
+    assert pool.warm_up(4) == 0
+    pool.destroy()
+
+
+def test_destroy_during_use(cluster):
+    # switch threads often, so destroy iterates while others change the pool
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    pool = tracker_pool(cluster)
+    stop = threading.Event()
+    errors = []
+
+    def use():
+        while not stop.is_set():
+            try:
+                conns = [pool.get_connection() for i in range(4)]
+                for conn in conns:
+                    pool.release(conn)
+            except ConnectionError:
+                pass
+            except Exception as e:
+                errors.append(e)
+    threads = [threading.Thread(target=use) for i in range(4)]
+    for t in threads:
+        t.start()
+    try:
+        for i in range(50000):
+            pool.destroy()
+    except Exception as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        sys.setswitchinterval(interval)
+    assert errors == []
@@ -0,0 +1,86 @@
+import os
+import socket
+import threading
+import pytest
+from fake_fdfs import Fake_topology
+from fdfs_client import connection
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_GET_METADATA
+
+DATA = os.urandom(3 * 1024 * 1024 + 17)
+
+
+class Receiver(object):
+    """Other end of the relay's out socket, reading until it is closed."""
+
+    def __init__(self):
+        self.out, self._in = socket.socketpair()
+        self.chunks = []
+        self._thread = threading.Thread(target=self._read)
+        self._thread.start()
+
+    def _read(self):
+        while True:
+            data = self._in.recv(65536)
+            if not data:
+                break
+            self.chunks.append(data)
+
+    def received(self):
+        self.out.close()
+        self._thread.join()
+        self._in.close()
+        return b''.join(self.chunks)
+
+
+@pytest.fixture(params=['splice', 'copy'])
+def relay_path(request, monkeypatch):
+    '''@return list of the paths body was relayed by, request.param only'''
+    if request.param == 'copy':
+        monkeypatch.delattr(connection.os, 'splice', raising=False)
+    elif not hasattr(os, 'splice'):
+        pytest.skip('os.splice is not available')
+    used = []
+    for path in ('splice', 'copy'):
+        func = getattr(connection, '_tcp_relay_' + path)
+        monkeypatch.setattr(connection, '_tcp_relay_' + path,
+                            lambda *args, _func=func, _path=path: used.append(_path) or _func(*args))
+    yield used
+    assert set(used) == {request.param}
+
+
+def test_relay_download(cluster, make_client, relay_path):
+    client = make_client({'io_chunk_size': 65536})
+    file_id = cluster.storage.add_file(DATA)
+    receiver = Receiver()
+    ret = client.relay_download(file_id, receiver.out, raw=True,
+                                header=lambda length: b'length %d\n' % length)
+    assert receiver.received() == b'length %d\n' % len(DATA) + DATA
+    assert ret['Storage IP'] == cluster.storage.ip_addr
+    assert STORAGE_PROTO_CMD_GET_METADATA not in cluster.storage.commands
+    receiver = Receiver()
+    client.relay_download(file_id, receiver.out, offset=100, length=70000, header=b'range\n')
+    assert receiver.received() == b'range\n' + DATA[100:70100]
+
+
+def test_relay_decompressed(cluster, make_client):
+    client = make_client()
+    content = b'compressible line\n' * 50000
+    file_id = client.upload_compressed_by_buffer(content, 'txt')['Remote file_id']
+    receiver = Receiver()
+    client.relay_download(file_id, receiver.out, header=lambda length: b'%d\n' % length)
+    assert receiver.received() == b'%d\n' % len(content) + content
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_relay_retried_before_header(cluster, make_client, relay_path):
+    client = make_client(route_direct=True)
+    client.topology = Fake_topology('group1', cluster.storages)
+    source = cluster.storages[1]
+    file_id = source.add_file(DATA)
+    # the source server drops the request without answer
+    source.fail_download = lambda sock, content: False
+    receiver = Receiver()
+    ret = client.relay_download(file_id, receiver.out, raw=True, header=b'once\n')
+    assert receiver.received() == b'once\n' + DATA
+    assert ret['Storage IP'] == cluster.storage.ip_addr
+    assert client.topology.failed == [source.ip_addr]
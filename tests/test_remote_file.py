@@ -0,0 +1,29 @@
+import os
+import io
+
+
+def test_read_after_file_shrank(cluster, make_client):
+    client = make_client()
+    data = os.urandom(1024 * 1024)
+    file_id = client.upload_appender_by_buffer(data)['Remote file_id']
+    f = client.open_remote(file_id, block_size=64 * 1024)
+    assert f.read(100) == data[:100]
+    client.truncate_file(100 * 1024, file_id)
+    # block 1 comes back short, the position is past the new end
+    f.seek(120 * 1024)
+    assert f.read(100) == b''
+    assert f.tell() == 120 * 1024
+    assert f.size == 100 * 1024
+    f.seek(90 * 1024)
+    assert f.read() == data[90 * 1024:100 * 1024]
+    assert f.read(10) == b''
+
+
+def test_buffered_read_after_file_shrank(cluster, make_client):
+    client = make_client()
+    data = os.urandom(300 * 1024)
+    file_id = client.upload_appender_by_buffer(data)['Remote file_id']
+    raw = client.open_remote(file_id, block_size=64 * 1024, read_ahead=0)
+    client.truncate_file(70 * 1024, file_id)
+    f = io.BufferedReader(raw)
+    assert f.read() == data[:70 * 1024]
@@ -0,0 +1,105 @@
+import os
+import struct
+import pytest
+from fake_fdfs import Fake_topology, HEADER
+from fdfs_client.exceptions import ConnectionError
+from fdfs_client.fdfs_protol import (
+    TRACKER_PROTO_CMD_RESP, STORAGE_PROTO_CMD_APPEND_FILE, STORAGE_PROTO_CMD_TRUNCATE_FILE,
+    STORAGE_PROTO_CMD_DELETE_FILE
+)
+
+
+def drop_download(cluster, nth):
+    '''Drop connection halfway through body of the nth download from now.'''
+    count = [0]
+
+    def fail(sock, content):
+        count[0] += 1
+        if count[0] < nth:
+            cluster.storage.reply(sock, content)
+            return True
+        cluster.storage.fail_download = None
+        sock.sendall(HEADER.pack(len(content), TRACKER_PROTO_CMD_RESP, 0) +
+                     content[:len(content) // 2])
+        return False
+    cluster.storage.fail_download = fail
+
+
+@pytest.mark.parametrize('appender', [False, True])
+@pytest.mark.parametrize('route_direct', [False, True])
+def test_download_resumable_drop_midway(cluster, make_client, tmp_path, appender, route_direct):
+    # small fixed chunks, so part of the dropped segment is written
+    client = make_client({'io_chunk_size': 4096}, route_direct=route_direct)
+    if route_direct:
+        # the failed direct download is retried through tracker by _storage_call
+        client.topology = Fake_topology('group1', cluster.storages)
+    data = os.urandom(100000)
+    file_id = cluster.storage.add_file(data, appender=appender)
+    # an appender file is downloaded by one request
+    drop_download(cluster, 1 if appender else 2)
+    local_filename = str(tmp_path / 'out')
+    ret = client.download_resumable(local_filename, file_id, segment_size=30000, backoff=0)
+    with open(local_filename, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(local_filename + '.fdfs-download')
+    assert client.download_resumable(local_filename, file_id)['Download size'] == ret['Download size']
+
+
+def drop_append(cluster, nth):
+    '''Append half of the chunk of the nth append from now, then drop connection.'''
+    count = [0]
+
+    def fail(body):
+        count[0] += 1
+        if count[0] < nth:
+            return
+        del cluster.storage.before[STORAGE_PROTO_CMD_APPEND_FILE]
+        name_len, size = struct.unpack('!Q Q', body[:16])
+        name = body[16:16 + name_len].decode()
+        cluster.files.data[name] += body[16 + name_len:16 + name_len + size // 2]
+        raise OSError('dropped')
+    cluster.storage.before[STORAGE_PROTO_CMD_APPEND_FILE] = fail
+
+
+def test_upload_resumable_in_chunks(cluster, make_client, tmp_path):
+    client = make_client()
+    data = os.urandom(100000)
+    local = tmp_path / 'big.bin'
+    local.write_bytes(data)
+    ret = client.upload_resumable(str(local), chunk_size=30000)
+    assert cluster.storage.content(ret['Remote file_id']) == data
+    assert cluster.storage.commands.count(STORAGE_PROTO_CMD_APPEND_FILE) == 3
+    assert not os.path.exists(str(local) + '.fdfs-upload')
+
+
+def test_upload_resumable_after_failure(cluster, make_client, tmp_path):
+    client = make_client()
+    data = os.urandom(100000)
+    local = tmp_path / 'big.bin'
+    local.write_bytes(data)
+    drop_append(cluster, 2)
+    with pytest.raises(ConnectionError):
+        client.upload_resumable(str(local), chunk_size=30000)
+    assert os.path.exists(str(local) + '.fdfs-upload')
+    ret = client.upload_resumable(str(local), chunk_size=30000)
+    # the half appended chunk is cut, then sent again with the rest
+    assert STORAGE_PROTO_CMD_TRUNCATE_FILE in cluster.storage.commands
+    assert cluster.storage.content(ret['Remote file_id']) == data
+    assert list(cluster.files.data) == [ret['Remote file_id'].split('/', 1)[1]]
+    assert not os.path.exists(str(local) + '.fdfs-upload')
+
+
+def test_upload_resumable_starts_over_if_changed(cluster, make_client, tmp_path):
+    client = make_client()
+    local = tmp_path / 'big.bin'
+    local.write_bytes(os.urandom(100000))
+    drop_append(cluster, 1)
+    with pytest.raises(ConnectionError):
+        client.upload_resumable(str(local), chunk_size=30000)
+    data = os.urandom(90000)
+    local.write_bytes(data)
+    ret = client.upload_resumable(str(local), chunk_size=30000)
+    assert STORAGE_PROTO_CMD_DELETE_FILE in cluster.storage.commands
+    assert STORAGE_PROTO_CMD_TRUNCATE_FILE not in cluster.storage.commands
+    assert cluster.storage.content(ret['Remote file_id']) == data
+    assert len(cluster.files.data) == 1
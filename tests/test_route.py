@@ -0,0 +1,68 @@
+import pytest
+from fake_fdfs import fdfs_filename
+from fdfs_client.fdfs_protol import (
+    STORAGE_PROTO_CMD_DOWNLOAD_FILE, STORAGE_PROTO_CMD_DELETE_FILE,
+    TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE, TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE,
+    TRACKER_PROTO_CMD_SERVER_LIST_STORAGE, FDFS_STORAGE_STATUS_OFFLINE
+)
+from fdfs_client.utils import FileId
+
+QUERIES = (TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE, TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE)
+
+
+def tracker_queries(cluster):
+    return [cmd for cmd in cluster.tracker.commands if cmd in QUERIES]
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_direct_to_source_server(cluster, make_client):
+    client = make_client(route_direct=True)
+    source = cluster.storages[1]
+    file_id = source.add_file(b'direct')
+    for i in range(3):
+        assert client.download_to_buffer(file_id)['Content'] == b'direct'
+    client.delete_file(file_id)
+    assert tracker_queries(cluster) == []
+    assert cluster.tracker.commands.count(TRACKER_PROTO_CMD_SERVER_LIST_STORAGE) == 1
+    assert source.commands.count(STORAGE_PROTO_CMD_DOWNLOAD_FILE) == 3
+    assert STORAGE_PROTO_CMD_DELETE_FILE in source.commands
+    assert cluster.storage.commands == []
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_falls_back_to_tracker(cluster, make_client):
+    client = make_client(route_direct=True)
+    source = cluster.storages[1]
+    file_id = source.add_file(b'fallback')
+    source.status = FDFS_STORAGE_STATUS_OFFLINE
+    assert client.download_to_buffer(file_id)['Content'] == b'fallback'
+    assert tracker_queries(cluster) == [TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE]
+    # the server is listed ACTIVE again, but does not accept connections
+    source.status = cluster.storage.status
+    client.topology.refresh_group('group1')
+    source.close()
+    assert client.download_to_buffer(file_id)['Content'] == b'fallback'
+    client.delete_file(file_id)
+    assert tracker_queries(cluster) == [TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE] * 2 + \
+        [TRACKER_PROTO_CMD_SERVICE_QUERY_UPDATE]
+    assert STORAGE_PROTO_CMD_DELETE_FILE in cluster.storage.commands
+
+
+@pytest.mark.parametrize('source_ip_addr', ['10.9.9.9', '0.1.134.161'])
+def test_unknown_source_server(cluster, make_client, source_ip_addr):
+    client = make_client(route_direct=True)
+    # a server since removed from the group, or server id 100001 of use_storage_id
+    file_id = cluster.storage.add_file(b'unknown', source_ip_addr=source_ip_addr)
+    assert client.download_to_buffer(file_id)['Content'] == b'unknown'
+    assert tracker_queries(cluster) == [TRACKER_PROTO_CMD_SERVICE_QUERY_FETCH_ONE]
+    # a server id is not looked up in the topology
+    listed = TRACKER_PROTO_CMD_SERVER_LIST_STORAGE in cluster.tracker.commands
+    assert listed == (source_ip_addr == '10.9.9.9')
+
+
+def test_storage_id_is_not_an_ip():
+    name = fdfs_filename('0.1.134.161', b'data')
+    file_id = FileId('group1/' + name)
+    assert (file_id.source_id, file_id.source_ip_addr) == ('100001', '')
+    file_id = FileId('group1/' + fdfs_filename('10.0.0.1', b'data'))
+    assert (file_id.source_id, file_id.source_ip_addr) == ('', '10.0.0.1')
@@ -0,0 +1,55 @@
+import pytest
+from fdfs_client.fdfs_protol import (
+    STORAGE_PROTO_CMD_UPLOAD_FILE, TRACKER_PROTO_CMD_SERVER_LIST_ALL_GROUPS,
+    TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITHOUT_GROUP_ONE, FDFS_STORAGE_STATUS_OFFLINE
+)
+
+STORE_QUERY = TRACKER_PROTO_CMD_SERVICE_QUERY_STORE_WITHOUT_GROUP_ONE
+
+
+@pytest.mark.parametrize('cluster', [3], indirect=True)
+def test_choose_active_server_of_best_priority(cluster, make_client):
+    client = make_client(upload_schedule=True)
+    low, best, offline = cluster.storages
+    low.info['upload_prio'] = 10
+    best.info['curr_write_path'] = 2
+    offline.status = FDFS_STORAGE_STATUS_OFFLINE
+    path_indexes = []
+    best.before[STORAGE_PROTO_CMD_UPLOAD_FILE] = lambda body: path_indexes.append(body[0])
+    for i in range(5):
+        ret = client.upload_by_buffer(b'scheduled %d' % i, 'txt')
+        assert ret['Storage IP'] == best.ip_addr
+    assert path_indexes == [2] * 5
+    assert STORE_QUERY not in cluster.tracker.commands
+    assert cluster.tracker.commands.count(TRACKER_PROTO_CMD_SERVER_LIST_ALL_GROUPS) == 1
+    assert client.scheduler.choose('group2') is None
+
+
+def test_query_tracker_when_no_server_fits(cluster, make_client):
+    client = make_client(upload_schedule=True)
+    cluster.storage.info['free_mb'] = 100
+    assert client.scheduler.choose() is None
+    client.upload_by_buffer(b'full', 'txt')
+    assert STORE_QUERY in cluster.tracker.commands
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_failed_server_is_dropped(cluster, make_client):
+    client = make_client(upload_schedule=True)
+    cluster.storage.info['upload_prio'] = 10
+    chosen = cluster.storages[1]
+    assert client.scheduler.choose().ip_addr == chosen.ip_addr
+    chosen.close()
+    ret = client.upload_by_buffer(b'fallback', 'txt')
+    assert ret['Storage IP'] == cluster.storage.ip_addr
+    assert cluster.tracker.commands.count(STORE_QUERY) == 1
+    # the view now has the other server only
+    assert client.scheduler.choose().ip_addr == cluster.storage.ip_addr
+
+
+def test_stale_view_is_not_used(cluster, make_client):
+    client = make_client(upload_schedule=True)
+    assert client.scheduler.choose() is not None
+    # listed long ago, and the next listing is not due yet
+    client.scheduler._refresh_time -= client.scheduler.max_age + 1
+    assert client.scheduler.choose() is None
@@ -0,0 +1,62 @@
+import struct
+import pytest
+from fdfs_client.exceptions import ConnectionError, DataError
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_UPLOAD_SLAVE_FILE, STORAGE_PROTO_CMD_DELETE_FILE
+from fdfs_client.utils import FileId
+
+
+def fail_slave(cluster, nth, fail):
+    '''Call fail(body) before the nth slave upload from now.'''
+    count = [0]
+
+    def before(body):
+        count[0] += 1
+        if count[0] == nth:
+            fail(body)
+    cluster.storage.before[STORAGE_PROTO_CMD_UPLOAD_SLAVE_FILE] = before
+
+
+def test_upload_with_slaves(cluster, make_client):
+    client = make_client()
+    ret = client.upload_with_slaves(b'master image', {'_small': b'small', '_icon': (b'icon', 'png')},
+                                    'jpg', {'width': '1024'})
+    master_id = ret['Remote file_id']
+    assert cluster.storage.content(master_id) == b'master image'
+    assert client.get_meta_data(master_id) == {'width': '1024'}
+    stem = master_id[:-len('.jpg')]
+    assert ret['Slaves'] == {'_small': stem + '_small.jpg', '_icon': stem + '_icon.png'}
+    assert cluster.storage.content(ret['Slaves']['_icon']) == b'icon'
+    assert FileId(ret['Slaves']['_small']).is_slave
+    assert ret['Uploaded size'] == '21B'
+    # master and slaves went over one connection
+    assert len(cluster.storage._conns) == 1
+    with pytest.raises(DataError):
+        client.upload_with_slaves(b'master', {'': b'no prefix'})
+
+
+def test_rejected_slave_rolls_back(cluster, make_client):
+    client = make_client()
+
+    def delete_master(body):
+        master_len = struct.unpack('!Q', body[:8])[0]
+        with cluster.files.lock:
+            del cluster.files.data[body[38:38 + master_len].decode()]
+    # the master is gone when the second slave is uploaded, it is rejected
+    fail_slave(cluster, 2, delete_master)
+    with pytest.raises(DataError):
+        client.upload_with_slaves(b'master', {'_a': b'a', '_b': b'b', '_c': b'c'}, 'jpg')
+    assert cluster.files.data == {}
+    assert cluster.storage.commands.count(STORAGE_PROTO_CMD_DELETE_FILE) == 2
+    assert len(cluster.storage._conns) == 1
+
+
+def test_dropped_connection_rolls_back(cluster, make_client):
+    client = make_client()
+
+    def drop(body):
+        raise OSError('dropped')
+    fail_slave(cluster, 2, drop)
+    with pytest.raises(ConnectionError):
+        client.upload_with_slaves(b'master', {'_a': b'a', '_b': b'b'}, 'jpg')
+    assert cluster.files.data == {}
+    assert cluster.storage.commands.count(STORAGE_PROTO_CMD_DELETE_FILE) == 2
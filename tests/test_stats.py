@@ -0,0 +1,73 @@
+import json
+import time
+import pytest
+from fdfs_client import stats
+from fdfs_client.stats import Counter_ring, Stats_sampler, COUNTERS, format_top
+
+
+class Clock(object):
+    """The time module, with time() set by the test."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class Info(object):
+    def __init__(self, **values):
+        for name in COUNTERS:
+            setattr(self, name, values.get(name, 0))
+
+
+def test_ring_deltas():
+    ring = Counter_ring(3)
+    ring.append(0, Info(total_upload_count=5))
+    assert ring.deltas(60) is None
+    for t, count in ((10, 15), (20, 20), (30, 40)):
+        ring.append(t, Info(total_upload_count=count))
+    # the row of time 0 is overwritten, 10 is the oldest kept
+    seconds, deltas = ring.deltas(60)
+    assert (seconds, deltas[COUNTERS.index('total_upload_count')]) == (20, 25)
+    seconds, deltas = ring.deltas(10)
+    assert (seconds, deltas[COUNTERS.index('total_upload_count')]) == (10, 20)
+    # a restarted server counts from zero again
+    ring.append(40, Info(total_upload_count=3))
+    assert ring.deltas(10)[1][COUNTERS.index('total_upload_count')] == 0
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_sampler_rates(cluster, make_client, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(stats, 'time', clock)
+    client = make_client()
+    sampler = Stats_sampler(client.tracker_pool)
+    first, second = cluster.storages
+    first.info.update(total_upload_count=10, success_upload_count=10, total_download_bytes=0)
+    sampler.sample()
+    assert sampler.rates()['Servers'] == []
+    clock.now += 10
+    first.info.update(total_upload_count=30, success_upload_count=28, total_download_bytes=10240)
+    second.info.update(total_download_count=50, success_download_count=50)
+    sampler.sample()
+    rates = sampler.rates()
+    assert rates['Time'] == clock.now
+    by_ip = dict((r['IP'], r) for r in rates['Servers'])
+    assert by_ip[first.ip_addr]['Upload/s'] == 2.0
+    assert by_ip[first.ip_addr]['Error ratio'] == pytest.approx(0.1)
+    assert by_ip[first.ip_addr]['Download bytes/s'] == 1024.0
+    assert by_ip[second.ip_addr]['Download/s'] == 5.0
+    assert by_ip[second.ip_addr]['Status'] == 'ACTIVE'
+    group, = rates['Groups']
+    assert group['Group name'] == 'group1'
+    assert group['Ops/s'] == 7.0
+    assert json.loads(sampler.to_json()) == json.loads(json.dumps(rates))
+    assert first.ip_addr in format_top(rates)
+    # a server gone from the listing is dropped
+    cluster.tracker.storages = [first]
+    sampler.sample()
+    assert [r['IP'] for r in sampler.rates()['Servers']] == [first.ip_addr]
@@ -0,0 +1,98 @@
+import time
+import threading
+import pytest
+from fdfs_client import topology
+from fdfs_client.topology import Topology_service
+from fdfs_client.tracker_client import Tracker_client
+from fdfs_client.fdfs_protol import FDFS_STORAGE_STATUS_ACTIVE, FDFS_STORAGE_STATUS_OFFLINE
+
+
+def record(service):
+    events = []
+    service.add_listener(lambda event, group_name, ip_addr, old, new:
+                         events.append((event, group_name, ip_addr)))
+    return events
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_refresh_reports_changes(cluster, make_client):
+    client = make_client()
+    service = Topology_service(client.tracker_pool)
+    events = record(service)
+    snapshot = service.refresh()
+    assert sorted(events) == [('ADDED', 'group1', '127.0.0.1'), ('ADDED', 'group1', '127.0.0.2')]
+    si = snapshot.get_server('group1', '127.0.0.1')
+    assert si.storage_port == cluster.storage.port and si.status == FDFS_STORAGE_STATUS_ACTIVE
+    assert snapshot.groups['group1'].count == 2
+
+    del events[:]
+    cluster.storage.status = FDFS_STORAGE_STATUS_OFFLINE
+    service.refresh()
+    assert events == [('STATUS_CHANGED', 'group1', '127.0.0.1')]
+    service.refresh()
+    assert len(events) == 1
+    cluster.tracker.storages = cluster.storages[:1]
+    service.refresh()
+    assert events[1:] == [('REMOVED', 'group1', '127.0.0.2')]
+    assert list(service.snapshot.get_servers('group1')) == ['127.0.0.1']
+
+
+def test_snapshot_is_reloaded(cluster, make_client, tmp_path):
+    client = make_client()
+    filename = str(tmp_path / 'topology.json')
+    Topology_service(client.tracker_pool, snapshot_filename=filename).refresh()
+    service = Topology_service(client.tracker_pool, snapshot_filename=filename)
+    si = service.snapshot.get_server('group1', '127.0.0.1')
+    assert si is not None and si.storage_port == cluster.storage.port
+    events = record(service)
+    service.refresh()
+    assert events == []
+
+
+def test_concurrent_refreshes_report_once(cluster, make_client, monkeypatch):
+    client = make_client()
+    service = Topology_service(client.tracker_pool)
+    service.refresh()
+    events = record(service)
+
+    class Slow_snapshot(topology.Topology_snapshot):
+        # widen the window between reading the old snapshot and publishing
+        def __init__(self, *args):
+            time.sleep(0.05)
+            super(Slow_snapshot, self).__init__(*args)
+    monkeypatch.setattr(topology, 'Topology_snapshot', Slow_snapshot)
+    cluster.storage.status = FDFS_STORAGE_STATUS_OFFLINE
+    threads = [threading.Thread(target=service.refresh) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert events == [('STATUS_CHANGED', 'group1', '127.0.0.1')]
+
+
+def test_thread_survives_unexpected_error(cluster, make_client, monkeypatch):
+    client = make_client()
+    service = Topology_service(client.tracker_pool, interval=60)
+    list_servers = Tracker_client.tracker_list_servers
+    failures = []
+
+    def broken_list_servers(self, *args):
+        if not failures:
+            failures.append(1)
+            raise TypeError('bad field')
+        return list_servers(self, *args)
+    monkeypatch.setattr(Tracker_client, 'tracker_list_servers', broken_list_servers)
+    service.start()
+    try:
+        for i in range(100):
+            if failures:
+                break
+            time.sleep(0.01)
+        service.refresh_soon()
+        for i in range(100):
+            if service.snapshot.get_servers('group1'):
+                break
+            time.sleep(0.01)
+        assert service.snapshot.get_server('group1', '127.0.0.1') is not None
+    finally:
+        service.stop()
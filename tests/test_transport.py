@@ -0,0 +1,57 @@
+import socket
+from fdfs_client.connection import Transport_options, Chunk_sizer
+
+
+def pooled_conn(pool):
+    return pool._conns_available[-1]
+
+
+def test_options_reach_socket(cluster, make_client):
+    client = make_client({'tcp_keepalive': 'true', 'keepalive_idle': 7, 'so_rcvbuf': 65536,
+                          'read_timeout': 0.5, 'storage_read_timeout': 2.5,
+                          'tracker_connect_timeout': 0.25})
+    file_id = client.upload_by_buffer(b'x' * 1000, 'txt')['Remote file_id']
+    client.download_to_buffer(file_id)
+    tracker_sock = pooled_conn(client.tracker_pool).get_sock()
+    store_sock = pooled_conn(client.get_storage(cluster.storage.storage_server()).pool).get_sock()
+    for sock in (tracker_sock, store_sock):
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 7
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+    # last operation of both was a read, the timeouts are per pool
+    assert tracker_sock.gettimeout() == 0.5
+    assert store_sock.gettimeout() == 2.5
+    assert client.tracker_pool.conn_kwargs['transport'].connect_timeout == 0.25
+    assert client.transport.connect_timeout == 5
+
+
+def test_fixed_chunk_size(cluster, make_client):
+    client = make_client({'io_chunk_size': 8192, 'storage_io_chunk_size': 16384})
+    assert client.tracker_pool.conn_kwargs['transport'].chunk_size == 8192
+    file_id = cluster.storage.add_file(b'x' * 1024 * 1024)
+    client.download_to_buffer(file_id)
+    assert pooled_conn(client.get_storage(cluster.storage.storage_server()).pool).chunk_size() == 16384
+
+
+def test_chunk_size_adapts(cluster, make_client, tmp_path):
+    client = make_client()
+    file_id = cluster.storage.add_file(b'x' * 4 * 1024 * 1024)
+    client.download_to_file(str(tmp_path / 'local'), file_id)
+    conn = pooled_conn(client.get_storage(cluster.storage.storage_server()).pool)
+    assert conn.chunk_size() > client.transport.min_chunk_size
+
+
+def test_chunk_sizer():
+    transport = Transport_options(min_chunk_size=4096, max_chunk_size=1024 * 1024, chunk_time=0.01)
+    sizer = Chunk_sizer(transport)
+    assert sizer.size == 4096
+    sizer.observe(1024 * 1024, 0.001)
+    assert sizer.size == 1024 * 1024
+    for i in range(50):
+        sizer.observe(1000, 0.1)
+    assert sizer.size == 4096
+    fixed = Chunk_sizer(Transport_options(adaptive=False, chunk_size=8192))
+    fixed.observe(1024 * 1024, 0.001)
+    assert fixed.size == 8192
@@ -0,0 +1,136 @@
+import threading
+import pytest
+from fdfs_client.uploader import Upload_queue
+from fdfs_client.exceptions import ConnectionError, DataError, DeadlineExceeded, QueueFullError
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_UPLOAD_FILE
+
+
+class Stub_client(object):
+    """upload_by_buffer raising errors in turn, then blocking until released."""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def upload_by_buffer(self, filebuffer, file_ext_name=None, meta_dict=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.release.wait()
+        return {'Remote file_id': 'group1/%d' % len(filebuffer)}
+
+
+def test_submit_rejects_over_budget():
+    client = Stub_client()
+    client.release.clear()
+    queue = Upload_queue(client, workers=1, max_inflight_bytes=10, block=False)
+    try:
+        first = queue.submit(b'x' * 8)
+        with pytest.raises(QueueFullError):
+            queue.submit(b'x' * 8)
+        assert queue.inflight_bytes == 8
+        client.release.set()
+        assert first.result(5) == {'Remote file_id': 'group1/8'}
+        assert queue.submit(b'x' * 8).result(5)
+    finally:
+        client.release.set()
+        queue.close()
+
+
+def test_submit_blocks_until_budget_is_free():
+    client = Stub_client()
+    client.release.clear()
+    queue = Upload_queue(client, workers=1, max_inflight_bytes=10, timeout=0.1)
+    try:
+        queue.submit(b'x' * 8)
+        with pytest.raises(QueueFullError):
+            queue.submit(b'x' * 8)
+        # the upload in flight finishes while submit waits
+        threading.Timer(0.05, client.release.set).start()
+        queue.timeout = 5
+        assert queue.submit(b'x' * 8).result(5)
+    finally:
+        client.release.set()
+        queue.close()
+
+
+def test_oversized_buffer_is_admitted_alone():
+    queue = Upload_queue(Stub_client(), workers=1, max_inflight_bytes=4, block=False)
+    with queue:
+        assert queue.submit(b'x' * 8).result(5)
+
+
+def test_flush_and_close():
+    client = Stub_client()
+    client.release.clear()
+    queue = Upload_queue(client, workers=2)
+    futures = [queue.submit(b'abc') for i in range(5)]
+    assert not queue.flush(0.05)
+    client.release.set()
+    assert queue.flush(5)
+    assert queue.pending == 0 and queue.inflight_bytes == 0
+    assert all(f.done() for f in futures)
+    queue.close()
+    with pytest.raises(DataError):
+        queue.submit(b'abc')
+
+
+def test_close_without_wait_cancels_queued():
+    client = Stub_client()
+    client.release.clear()
+    queue = Upload_queue(client, workers=1)
+    running = queue.submit(b'abc')
+    queued = queue.submit(b'abc')
+    while not running.running():
+        pass
+    threading.Timer(0.05, client.release.set).start()
+    queue.close(wait=False)
+    assert running.result(5) and queued.cancelled()
+
+
+def test_connection_error_is_retried():
+    client = Stub_client([ConnectionError('dropped'), ConnectionError('dropped')])
+    with Upload_queue(client, workers=1, retries=2, backoff=0.01) as queue:
+        assert queue.submit(b'abc').result(5)
+    assert client.calls == 3
+
+
+def test_retries_are_limited():
+    client = Stub_client([ConnectionError('dropped')] * 3)
+    with Upload_queue(client, workers=1, retries=2, backoff=0.01) as queue:
+        with pytest.raises(ConnectionError):
+            queue.submit(b'abc').result(5)
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize('error', [DataError('rejected'), DeadlineExceeded('late')])
+def test_other_errors_fail_at_once(error):
+    client = Stub_client([error])
+    with Upload_queue(client, workers=1, retries=3, backoff=10) as queue:
+        future = queue.submit(b'abc')
+        with pytest.raises(type(error)):
+            future.result(5)
+        assert queue.flush(5) and queue.inflight_bytes == 0
+    assert client.calls == 1
+
+
+def test_upload_through_cluster(cluster, make_client):
+    client = make_client()
+    with Upload_queue(client, workers=2) as queue:
+        futures = [queue.submit(b'content %d' % i, 'txt') for i in range(4)]
+        file_ids = [f.result(5)['Remote file_id'] for f in futures]
+    assert [cluster.storage.content(fid) for fid in file_ids] == [b'content %d' % i for i in range(4)]
+    assert cluster.storage.commands.count(STORAGE_PROTO_CMD_UPLOAD_FILE) == 4
+
+
+def test_backoff_is_bounded_by_deadline_of_submit():
+    from fdfs_client.deadline import Deadline
+    client = Stub_client([ConnectionError('dropped')] * 3)
+    with Upload_queue(client, workers=1, retries=3, backoff=30) as queue:
+        with Deadline(0.2):
+            future = queue.submit(b'abc')
+        with pytest.raises(DeadlineExceeded):
+            future.result(5)
+    assert client.calls == 1
@@ -0,0 +1,59 @@
+import pytest
+from fdfs_client.exceptions import IntegrityError
+
+
+def corrupt(store):
+    def fail_download(sock, content):
+        store.reply(sock, content[:-1] + bytes([content[-1] ^ 1]))
+        return True
+    store.fail_download = fail_download
+
+
+@pytest.mark.parametrize('to_file', [False, True])
+def test_corrupt_download_raises(cluster, make_client, tmp_path, to_file):
+    client = make_client()
+    file_id = cluster.storage.add_file(b'original content')
+    cluster.files.data[file_id.split('/', 1)[1]][:8] = b'modified'
+
+    def download(**kwargs):
+        if to_file:
+            client.download_to_file(str(tmp_path / 'local'), file_id, **kwargs)
+            return (tmp_path / 'local').read_bytes()
+        return client.download_to_buffer(file_id, **kwargs)['Content']
+
+    assert download() == b'modified content'
+    with pytest.raises(IntegrityError):
+        download(verify=True)
+    # a range has no CRC32 to check against
+    assert client.download_to_buffer(file_id, offset=9, verify=True)['Content'] == b'content'
+
+
+def test_short_download_raises(cluster, make_client):
+    client = make_client()
+    file_id = cluster.storage.add_file(b'original content')
+    del cluster.files.data[file_id.split('/', 1)[1]][-1]
+    with pytest.raises(IntegrityError):
+        client.download_to_buffer(file_id, verify=True)
+
+
+@pytest.mark.parametrize('cluster', [3], indirect=True)
+def test_corrupt_replica_is_skipped(cluster, make_client, tmp_path):
+    client = make_client()
+    file_id = cluster.storage.add_file(b'x' * 10000)
+    corrupt(cluster.storages[0])
+    corrupt(cluster.storages[1])
+    ret = client.download_to_buffer(file_id, verify=True)
+    assert ret['Content'] == b'x' * 10000
+    assert ret['Storage IP'] == cluster.storages[2].ip_addr
+    client.download_to_file(str(tmp_path / 'local'), file_id, verify=True)
+    assert (tmp_path / 'local').read_bytes() == b'x' * 10000
+    corrupt(cluster.storages[2])
+    with pytest.raises(IntegrityError):
+        client.download_to_buffer(file_id, verify=True)
+
+
+def test_appender_is_not_verified(cluster, make_client):
+    client = make_client()
+    file_id = cluster.storage.add_file(b'appender', appender=True)
+    corrupt(cluster.storage)
+    assert client.download_to_buffer(file_id, verify=True)['Content'] == b'appendes'
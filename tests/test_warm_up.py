@@ -0,0 +1,40 @@
+import logging
+import pytest
+from fdfs_client.fdfs_protol import STORAGE_PROTO_CMD_DOWNLOAD_FILE, FDFS_STORAGE_STATUS_OFFLINE
+
+
+@pytest.mark.parametrize('cluster', [3], indirect=True)
+def test_warm_up_counts(cluster, make_client):
+    client = make_client()
+    cluster.storages[2].status = FDFS_STORAGE_STATUS_OFFLINE
+    ret = client.warm_up(tracker_conns=2, storage_conns=3)
+    assert ret == {'Tracker connections': 2, 'Storage servers': 2,
+                   'Storage connections': 6, 'Complete': True}
+    # a second call tops the pools up to the counts, it does not add to them
+    assert client.warm_up(tracker_conns=2, storage_conns=3) == ret
+
+
+def test_warm_up_from_conf(cluster, make_client):
+    client = make_client({'warm_up': 'true', 'warm_up_storage_connections': 2})
+    store = client.get_storage(cluster.storage.storage_server())
+    assert store.pool.idle_count() == 2
+    file_id = cluster.storage.add_file(b'warm')
+    client.download_to_buffer(file_id)
+    assert cluster.storage.commands == [STORAGE_PROTO_CMD_DOWNLOAD_FILE]
+    assert store.pool.idle_count() == 2
+
+
+@pytest.mark.parametrize('cluster', [2], indirect=True)
+def test_warm_up_failures_are_reported(cluster, make_client, caplog):
+    client = make_client()
+    cluster.storages[1].close()
+    with caplog.at_level(logging.WARNING, logger='fdfs_client.client'):
+        ret = client.warm_up(storage_conns=2)
+    assert ret['Storage servers'] == 2 and ret['Storage connections'] == 2
+    assert not ret['Complete']
+    assert 'warm up failed' in caplog.text
+    # discovery itself fails when the tracker is down
+    cluster.tracker.close()
+    ret = make_client().warm_up()
+    assert ret['Storage servers'] == 0
+    assert not ret['Complete']